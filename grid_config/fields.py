@@ -0,0 +1,28 @@
+# fields.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Defines which fields of the NEXRAD radar objects are gridded around
+#   each pirep. The gridding, the model inputs (NetCDF files and the
+#   dataloader), and the number of input channels of the models all follow
+#   from this list, so adding a field only requires adding it here
+
+# The fields to grid, in the order they are stored as channels of the model input
+GRID_FIELDS = ["reflectivity", "spectrum_width", "velocity", "differential_reflectivity"]
+
+# The value to replace nan (cells with no valid data) with for each field when
+# creating the dataloader. Reflectivity uses a value out of range (-32 dBZ) to
+# represent undetectable reflectivity, the others use the value with no signal
+FIELD_FILL_VALUES = {
+    "reflectivity": -32.0,              # dBZ
+    "spectrum_width": 0.0,              # m/s
+    "velocity": 0.0,                    # m/s
+    "differential_reflectivity": 0.0,   # dB
+}
+DEFAULT_FILL_VALUE = 0.0
+
+
+def get_fill_value(field):
+    """
+    Returns the value to replace nan with for the given field
+    """
+    return FIELD_FILL_VALUES.get(field, DEFAULT_FILL_VALUE)
@@ -0,0 +1,133 @@
+# grid_spec.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Defines the GridSpec class, which describes the shape, size, and
+#   fields of the grid created around each pirep. A GridSpec is serialized into
+#   every NetCDF model input and into the dataloader, and is used to build the
+#   models, so the gridding, the dataset, and the model input shape always agree
+
+import json
+import os
+from dataclasses import asdict, dataclass
+from grid_config.fields import GRID_FIELDS
+
+# The name of the NetCDF attribute a GridSpec is stored in
+GRID_SPEC_ATTR = "GRID_SPEC"
+
+
+@dataclass(frozen=True)
+class GridSpec:
+    """
+    The shape (number of points in each dimension), size (in degrees of
+    latitude/longitude and meters of altitude), and fields of a grid
+    """
+    n_alt: int = 10
+    n_lat: int = 16
+    n_lon: int = 16
+    degrees: float = 0.25   # Width of the grid in degrees of latitude and longitude
+    z_size: float = 3048    # Height of the grid in meters (3048m = 10000 ft)
+    fields: tuple = tuple(GRID_FIELDS)
+
+    def __post_init__(self):
+        # Lists (e.g., from JSON) are stored as tuples so the spec is hashable
+        object.__setattr__(self, "fields", tuple(self.fields))
+
+    @property
+    def grid_shape(self):
+        """(z, y, x) The number of points in each dimension of the grid"""
+        return (self.n_alt, self.n_lat, self.n_lon)
+
+    @property
+    def alt_range(self):
+        """The min and max altitude offset (in meters) from the grid origin"""
+        return (-self.z_size / 2.0, self.z_size / 2.0)
+
+    @property
+    def lat_range(self):
+        """The min and max latitude offset (in degrees) from the grid origin"""
+        return (-self.degrees / 2.0, self.degrees / 2.0)
+
+    @property
+    def lon_range(self):
+        """The min and max longitude offset (in degrees) from the grid origin"""
+        return (-self.degrees / 2.0, self.degrees / 2.0)
+
+    @property
+    def num_fields(self):
+        return len(self.fields)
+
+    @property
+    def num_grid_points(self):
+        """The number of cells in the grid for a single field"""
+        return self.n_alt * self.n_lat * self.n_lon
+
+    @property
+    def num_grid_features(self):
+        """The number of gridded values (over all fields) in a model input"""
+        return self.num_grid_points * self.num_fields
+
+    def validate(self):
+        """
+        Raises a ValueError if this is not a valid grid spec
+        """
+        for name in ("n_alt", "n_lat", "n_lon"):
+            value = getattr(self, name)
+            if not isinstance(value, int) or value <= 0:
+                raise ValueError(f"GridSpec {name} must be a positive int, got {value}")
+        if self.degrees <= 0 or self.z_size <= 0:
+            raise ValueError(f"GridSpec degrees and z_size must be positive, got {self.degrees} and {self.z_size}")
+        if self.num_fields == 0:
+            raise ValueError("GridSpec must have at least one field")
+        if len(set(self.fields)) != self.num_fields:
+            raise ValueError(f"GridSpec fields must be unique, got {self.fields}")
+        return self
+
+    def to_json(self):
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, json_str):
+        return cls(**json.loads(json_str)).validate()
+
+    def to_attrs(self):
+        """
+        Returns a dictionary to add to the attributes of a NetCDF file
+        (NetCDF attributes cannot be nested, so the spec is stored as JSON)
+        """
+        return {GRID_SPEC_ATTR: self.to_json()}
+
+    @classmethod
+    def from_attrs(cls, attrs, fields=None):
+        """
+        Reads the GridSpec from the attributes of a NetCDF file. Files created
+        before the spec was stored use the original 10x16x16 grid, so for those
+        the spec is inferred from fields (the data variables of the file)
+        """
+        if GRID_SPEC_ATTR in attrs:
+            return cls.from_json(attrs[GRID_SPEC_ATTR])
+        return cls(fields=tuple(fields) if fields else ("reflectivity",)).validate()
+
+
+# Named grid specs that can be chosen on the command line. "full" is used for
+# production, "low_res" for fast experiments, and "reflectivity" is the spec of
+# the original model inputs (and of the models trained on them)
+GRID_SPECS = {
+    "full": GridSpec(),
+    "low_res": GridSpec(n_alt=5, n_lat=8, n_lon=8),
+    "reflectivity": GridSpec(fields=("reflectivity",)),
+}
+DEFAULT_GRID_SPEC = GRID_SPECS["full"]
+REFLECTIVITY_GRID_SPEC = GRID_SPECS["reflectivity"]
+
+
+def get_grid_spec(name_or_path):
+    """
+    Returns the GridSpec with the given name in GRID_SPECS, or reads it from
+    the given path to a JSON file (e.g., one written by GridSpec.to_json)
+    """
+    if name_or_path in GRID_SPECS:
+        return GRID_SPECS[name_or_path]
+    if os.path.isfile(name_or_path):
+        with open(name_or_path) as spec_file:
+            return GridSpec.from_json(spec_file.read())
+    raise ValueError(f"Unknown grid spec: {name_or_path}. Expected one of {list(GRID_SPECS)} or a path to a JSON file")
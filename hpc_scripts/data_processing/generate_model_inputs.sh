@@ -4,6 +4,9 @@
 # Authors: Team Celestial Blue
 # Spring 2025
 # Overview: Generate all compressed model inputs by gridding radar data from split csv data sets. 
+# Usage: sbatch generate_model_inputs.sh [grid_spec]
+#       grid_spec: Optionally the name of a grid spec in grid_config/grid_spec.py
+#                  (e.g., full or low_res) or a path to a JSON grid spec
 
 #SBATCH -J generate_model_inputs       
 #SBATCH --time=02-00:00:00   
@@ -20,6 +23,7 @@ cd $REPO_PATH
 source $REPO_PATH/hpc_scripts/load_modules.sh
 
 OUTPUT_DIR=$REPO_PATH/model_inputs
+GRID_SPEC=${1:-full}
 
 idx=$(printf "%03d" ${SLURM_ARRAY_TASK_ID})
 echo "Operating on $idx"
@@ -28,7 +32,7 @@ echo "Making directory $OUTPUT_DIR/$idx"
 mkdir -p $OUTPUT_DIR/$idx
 
 echo "Running radar_data_to_model_input on $REPO_PATH/radars/split_radar_data/part_"$idx".csv"
-python3 $REPO_PATH/radars/radar_data_to_model_input.py $REPO_PATH/radars/split_radar_data/part_"$idx".csv $OUTPUT_DIR/$idx
+python3 $REPO_PATH/radars/radar_data_to_model_input.py $REPO_PATH/radars/split_radar_data/part_"$idx".csv $OUTPUT_DIR/$idx $GRID_SPEC
 
 echo "Finished running radar_data_to_model_input.py on part! Compressing output directory into $OUTPUT_DIR/compressed/$idx.tar.xz"
 tar -cvJf $OUTPUT_DIR/compressed/$idx.tar.xz -C "$OUTPUT_DIR" "$idx"
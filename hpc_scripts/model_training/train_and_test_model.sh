@@ -16,6 +16,8 @@
 #SBATCH --output=train_and_test_model.%j.%N.out
 #SBATCH --mail-type=ALL 
 #SBATCH --mail-user=
+#SBATCH --requeue                  # Restart the job (resuming from its checkpoint) when it is preempted
+#SBATCH --signal=B:TERM@120        # Send SIGTERM 2 minutes before the time limit, so it can checkpoint
 
 cd $REPO_PATH
 source $REPO_PATH/hpc_scripts/load_modules.sh 
@@ -24,10 +26,27 @@ nvidia-smi
 model_type=$1
 loss_function=$2
 seed=$3
+# Any further arguments are optional flags (e.g., -sweep_workers 8)
+options="${@:4}"
 
-echo "About to train the $model_type model with $loss_function loss with seed $seed"
-python -u $REPO_PATH/model_training/train_and_test_model.py $model_type $loss_function $seed
-echo "Finished training and testing the model!"
+echo "About to train the $model_type model with $loss_function loss with seed $seed $options"
+# Run in the background and pass SIGTERM (from preemption or --signal) on to
+# the script, which finishes its current batch, saves a checkpoint, and exits
+python -u $REPO_PATH/model_training/train_and_test_model.py $model_type $loss_function $seed $options &
+train_pid=$!
+trap 'kill -TERM $train_pid' TERM
+wait $train_pid
+exit_code=$?
+# wait returns as soon as the trap runs, so wait again for the checkpoint
+if kill -0 $train_pid 2> /dev/null; then
+    wait $train_pid
+    exit_code=$?
+fi
+if [ $exit_code -eq 75 ]; then
+    echo "Saved a checkpoint after SIGTERM: resubmit with the same arguments to resume"
+else
+    echo "Finished training and testing the model!"
+fi
 
 source $REPO_PATH/hpc_scripts/unload_modules.sh
 
@@ -0,0 +1,44 @@
+#!/bin/bash -l
+
+# train_and_test_model_ddp.sh
+# Authors: Team Celestial Blue
+# Spring 2025
+# Overview: Run train_and_test_model with DistributedDataParallel across
+#   CPU-only nodes, with one torchrun per node launching PROCS_PER_NODE
+#   processes (which split the node's cores between them)
+
+#SBATCH -J train_and_test_model_ddp
+#SBATCH --time=02-00:00:00
+#SBATCH -p batch
+#SBATCH -N 2                         # Number of nodes
+#SBATCH --ntasks-per-node=1          # One torchrun per node
+#SBATCH -c 16                        # Cores per node
+#SBATCH --mem=32g
+#SBATCH --output=train_and_test_model_ddp.%j.%N.out
+#SBATCH --mail-type=ALL
+#SBATCH --mail-user=
+
+cd $REPO_PATH
+source $REPO_PATH/hpc_scripts/load_modules.sh
+
+model_type=$1
+loss_function=$2
+seed=$3
+# Any further arguments are optional flags (e.g., -tensor_dataset float32)
+options="${@:4}"
+# The number of processes on each node, e.g., 2 processes of 8 cores each
+procs_per_node=${PROCS_PER_NODE:-2}
+
+# The ranks find each other through a rendezvous on the first node
+head_node=$(scontrol show hostnames $SLURM_JOB_NODELIST | head -n 1)
+
+echo "About to train the $model_type model with $loss_function loss with seed $seed $options" \
+     "on $SLURM_NNODES nodes with $procs_per_node processes each"
+srun torchrun --nnodes=$SLURM_NNODES --nproc_per_node=$procs_per_node \
+    --rdzv_id=$SLURM_JOB_ID --rdzv_backend=c10d --rdzv_endpoint=$head_node:29500 \
+    $REPO_PATH/model_training/train_and_test_model.py $model_type $loss_function $seed $options
+echo "Finished training and testing the model!"
+
+source $REPO_PATH/hpc_scripts/unload_modules.sh
+
+echo "All done!"
@@ -0,0 +1,164 @@
+# export_model.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Exports a model trained by train_and_test_model.py for inference,
+#   as a torch.export program (.pt2, the default) or a TorchScript module
+#   (.pt), either of which can be loaded without the model's Python code. It
+#   then benchmarks the single-input and batched latency on CPU of the exported
+#   model against the eager model (and optionally against torch.compile), and
+#   checks that their outputs match
+# Usage: python export_model.py MODEL_PATH [-format export|torchscript] [-output OUTPUT_PATH]
+#                               [-batch BATCH_SIZE] [-runs NUM_RUNS] [-compile]
+#       MODEL_PATH: A model saved by train_and_test_model.py (*.pth)
+#       -format: export (torch.export, default) or torchscript (torch.jit.trace)
+#       -output: Where to save the exported model (default: MODEL_PATH with a
+#                .pt2 or .pt extension). Its grid spec is saved next to it
+#       -batch: The number of inputs in each batch of the batched benchmark (default 256)
+#       -runs: The number of timed runs of each benchmark (default 50)
+#       -compile: Also benchmark the model compiled with torch.compile
+
+import os
+import statistics
+import sys
+import time
+import torch
+
+from trained_model import get_grid_spec_path, load_trained_model, make_example_inputs, save_grid_spec
+
+EXPORT_FORMATS = {
+    "export": ".pt2",
+    "torchscript": ".pt",
+}
+# The batch size the model is traced or exported with. The batch dimension of
+# exported programs is dynamic, and TorchScript traces do not fix it
+EXPORT_BATCH_SIZE = 2
+MAX_BATCH_SIZE = 2**20
+NUM_WARMUP_RUNS = 3
+# The largest difference from the eager model's outputs allowed
+OUTPUT_TOLERANCE = 1e-4
+
+
+def usage():
+    print(f"Usage: python {sys.argv[0]} MODEL_PATH [-format export|torchscript] [-output OUTPUT_PATH] "
+          "[-batch BATCH_SIZE] [-runs NUM_RUNS] [-compile]")
+    exit(1)
+
+
+def export_model(model, grid_spec, export_format, output_path):
+    """
+    Exports a model and saves it to output_path
+    Parameters:
+        model -- The model, in eval mode
+        grid_spec -- The GridSpec of the model's inputs
+        export_format -- "export" or "torchscript"
+        output_path -- Where to save the exported model
+    """
+    example_inputs = make_example_inputs(grid_spec, EXPORT_BATCH_SIZE)
+    if export_format == "export":
+        batch = torch.export.Dim("batch", min=1, max=MAX_BATCH_SIZE)
+        program = torch.export.export(model, (example_inputs,), dynamic_shapes={"x": {0: batch}})
+        torch.export.save(program, output_path)
+    else:
+        with torch.no_grad():
+            # Freezing inlines the weights as constants, so they can be folded
+            traced = torch.jit.freeze(torch.jit.trace(model, example_inputs))
+        torch.jit.save(traced, output_path)
+
+
+def load_exported_model(path):
+    """
+    Loads a model saved by export_model, returning a callable module
+    """
+    if path.endswith(EXPORT_FORMATS["export"]):
+        return torch.export.load(path).module()
+    return torch.jit.load(path, map_location="cpu")
+
+
+def time_model(model, x, num_runs):
+    """
+    Returns the median time (in seconds) of running model on x
+    """
+    times = []
+    with torch.inference_mode():
+        for _ in range(NUM_WARMUP_RUNS):
+            model(x)
+        for _ in range(num_runs):
+            start_time = time.perf_counter()
+            model(x)
+            times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+def get_max_diff(model, eager_model, x):
+    with torch.inference_mode():
+        return (model(x) - eager_model(x)).abs().max().item()
+
+
+def main():
+    if len(sys.argv) < 2:
+        usage()
+    model_path = sys.argv[1]
+    export_format = "export"
+    output_path = None
+    batch_size = 256
+    num_runs = 50
+    use_compile = False
+    i = 2
+    while i < len(sys.argv):
+        if sys.argv[i] == "-compile":
+            use_compile = True
+            i += 1
+            continue
+        if i + 1 >= len(sys.argv):
+            usage()
+        try:
+            if sys.argv[i] == "-format":
+                export_format = sys.argv[i + 1]
+            elif sys.argv[i] == "-output":
+                output_path = sys.argv[i + 1]
+            elif sys.argv[i] == "-batch":
+                batch_size = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-runs":
+                num_runs = int(sys.argv[i + 1])
+            else:
+                usage()
+        except ValueError:
+            usage()
+        i += 2
+    if export_format not in EXPORT_FORMATS:
+        usage()
+    output_path = output_path or os.path.splitext(model_path)[0] + EXPORT_FORMATS[export_format]
+
+    model, grid_spec = load_trained_model(model_path)
+    print(f"Loaded {type(model).__name__} with grid spec {grid_spec}")
+    export_model(model, grid_spec, export_format, output_path)
+    # Saved next to the exported model, which does not record its grid spec
+    save_grid_spec(output_path, grid_spec)
+    print(f"Saved the {export_format} model to {output_path}, and its grid spec to {get_grid_spec_path(output_path)}")
+
+    models = {
+        "eager": model,
+        export_format: load_exported_model(output_path),
+    }
+    if use_compile:
+        models["torch.compile"] = torch.compile(model)
+
+    single_input = make_example_inputs(grid_spec, 1, seed=1)
+    batch_inputs = make_example_inputs(grid_spec, batch_size, seed=2)
+    print(f"Median latency over {num_runs} runs on {torch.get_num_threads()} CPU threads")
+    print(f"{'model':<15}{'1 input (ms)':>14}{f'{batch_size} inputs (ms)':>18}{'inputs/sec':>12}"
+          f"{'speedup':>9}{'max diff':>10}")
+    base_time = None
+    for name, exported in models.items():
+        # Compiling happens on the first run, so check the outputs before timing
+        max_diff = max(get_max_diff(exported, model, single_input), get_max_diff(exported, model, batch_inputs))
+        single_time = time_model(exported, single_input, num_runs)
+        batch_time = time_model(exported, batch_inputs, num_runs)
+        base_time = base_time or batch_time
+        flag = "" if max_diff <= OUTPUT_TOLERANCE else "  <-- outputs differ from eager"
+        print(f"{name:<15}{single_time * 1000:>14.3f}{batch_time * 1000:>18.2f}{batch_size / batch_time:>12.0f}"
+              f"{base_time / batch_time:>8.2f}x{max_diff:>10.1e}{flag}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+# lattice_inference.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Predicts turbulence over a map rather than only at pilot reports.
+#   Given one radar volume (the scans of one or more radars at one time) and a
+#   lattice of (lat, lon, flight level) points, it grids the radar data around
+#   every point using one shared index of the volume's gates (see
+#   radars/volume_index.py), runs the model on the points in large batches,
+#   and writes one NetCDF raster of the predicted turbulence per flight level.
+#   It reports the time spent indexing, gridding, and predicting, and the
+#   points/sec. Without radar files it uses synthetic radars, for benchmarking
+# Usage: python lattice_inference.py MODEL_PATH OUTPUT_DIR [-radar_files FILE1,FILE2,...]
+#                                    [-lat MIN,MAX] [-lon MIN,MAX] [-step DEGREES] [-fl FL1,FL2,...]
+#                                    [-delta_t SECONDS] [-batch BATCH_SIZE] [-check NUM_POINTS]
+#       MODEL_PATH: A model saved by train_and_test_model.py (*.pth)
+#       OUTPUT_DIR: The directory to write the rasters to
+#       -radar_files: NEXRAD files of the volume (default: 4 synthetic radars)
+#       -lat, -lon: The range of the lattice (default: the extent of the radar data)
+#       -step: The spacing of the lattice in degrees (default: the width of
+#              the model's grid, so the grids of neighboring points touch)
+#       -fl: The flight levels (in hundreds of feet) to predict at (default 100,200,300)
+#       -delta_t: The time since the radar scans, in seconds (default 0)
+#       -batch: The number of points gridded and predicted at once (default 4096)
+#       -check: Also grid this many points with create_grid, one at a time,
+#               to check the grids match and compare the time (default 0)
+
+import os
+import sys
+import time
+import numpy as np
+import torch
+import xarray as xr
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+# Append to sys path to import the gridding code from radars
+sys.path.append(os.path.join(DIRNAME, "..", "radars"))
+
+from trained_model import load_trained_model
+from evaluation import get_predicted_classes
+import quiet_pyart as pyart
+from create_grid import create_grid
+from synthetic_radar import make_synthetic_radar
+from volume_index import VolumeIndex
+from grid_config.fields import get_fill_value
+
+DEFAULT_FLIGHT_LEVELS = [100, 200, 300]
+# The synthetic radars are placed on a square this many degrees apart
+SYNTHETIC_RADAR_CENTER = (36.5, -97.5)
+SYNTHETIC_RADAR_SPACING = 2.0
+# The predicted class of points without any radar data around them, which the
+# model was never trained on
+NO_DATA_CLASS = -1
+
+
+def usage():
+    print(f"Usage: python {sys.argv[0]} MODEL_PATH OUTPUT_DIR [-radar_files FILE1,FILE2,...] [-lat MIN,MAX] "
+          "[-lon MIN,MAX] [-step DEGREES] [-fl FL1,FL2,...] [-delta_t SECONDS] [-batch BATCH_SIZE] [-check NUM_POINTS]")
+    exit(1)
+
+
+def ft_to_meters(dist_in_ft):
+    return dist_in_ft/3.281
+
+
+def make_synthetic_volume(fields):
+    """
+    Returns 4 synthetic radars on a square around SYNTHETIC_RADAR_CENTER
+    """
+    center_lat, center_lon = SYNTHETIC_RADAR_CENTER
+    offset = SYNTHETIC_RADAR_SPACING / 2
+    return tuple(make_synthetic_radar(latitude=center_lat + lat_sign * offset, longitude=center_lon + lon_sign * offset,
+                                      coverage=0.5, fields=fields, seed=seed)
+                 for seed, (lat_sign, lon_sign) in enumerate([(-1, -1), (-1, 1), (1, -1), (1, 1)]))
+
+
+def make_lattice(lat_range, lon_range, step):
+    """
+    Returns the latitudes and longitudes of a lattice of points step degrees
+    apart, starting at the minimum of each range
+    """
+    lats = np.arange(lat_range[0], lat_range[1] + step / 2, step)
+    lons = np.arange(lon_range[0], lon_range[1] + step / 2, step)
+    return lats, lons
+
+
+def make_features(grids, lats, lons, altitude_ft, delta_t, fields):
+    """
+    Turns the grids around a batch of points into model inputs, in the same
+    way as the dataloader turns NetCDF files into model inputs
+    Parameters:
+        grids -- An array (npoints x n_alt x n_lat x n_lon x nfields) of grids
+        lats, lons -- Arrays of the latitude and longitude of each point
+        altitude_ft -- The altitude of the points in feet (one value, or one per point)
+        delta_t -- The time since the radar scans in seconds (one value, or one per point)
+        fields -- The fields of the grids
+    Returns:
+        A float32 tensor (npoints x num_features)
+    """
+    linear_features = np.column_stack([lats, lons, np.broadcast_to(altitude_ft, len(lats)),
+                                       np.broadcast_to(delta_t, len(lats))])
+    # Each field is flattened in (alt, lat, lon) order, with empty cells filled
+    grid_features = [np.nan_to_num(grids[..., i].reshape(len(grids), -1), nan=get_fill_value(field))
+                     for i, field in enumerate(fields)]
+    return torch.from_numpy(np.concatenate([linear_features] + grid_features, axis=1).astype(np.float32))
+
+
+def predict_flight_level(model, grid_spec, volume_index, lats, lons, flight_level, delta_t, batch_size, timings):
+    """
+    Predicts the turbulence at every point of the lattice at one flight level
+    Parameters:
+        model -- The model, in eval mode
+        grid_spec -- The GridSpec of the model's inputs
+        volume_index -- The VolumeIndex of the radar volume
+        lats, lons -- The latitudes and longitudes of the lattice
+        flight_level -- The flight level, in hundreds of feet
+        delta_t -- The time since the radar scans, in seconds
+        batch_size -- The number of points gridded and predicted at once
+        timings -- A dictionary the time spent gridding and predicting is added to
+    Returns:
+        An int8 array (len(lats) x len(lons)) of the predicted class at each
+        point, which is NO_DATA_CLASS where there is no radar data
+    """
+    altitude_ft = flight_level * 100
+    lat_grid, lon_grid = np.meshgrid(lats, lons, indexing="ij")
+    point_lats, point_lons = lat_grid.ravel(), lon_grid.ravel()
+    predictions = np.full(len(point_lats), NO_DATA_CLASS, dtype=np.int8)
+    for start in range(0, len(point_lats), batch_size):
+        batch_lats, batch_lons = point_lats[start:start + batch_size], point_lons[start:start + batch_size]
+        start_time = time.perf_counter()
+        origins = np.column_stack([np.full(len(batch_lats), ft_to_meters(altitude_ft)), batch_lats, batch_lons])
+        grids, has_data = volume_index.grid_points(origins, grid_spec.grid_shape, grid_spec.alt_range,
+                                                   grid_spec.lat_range, grid_spec.lon_range)
+        features = make_features(grids[has_data], batch_lats[has_data], batch_lons[has_data],
+                                 altitude_ft, delta_t, grid_spec.fields)
+        timings["gridding"] += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        if len(features):
+            with torch.inference_mode():
+                batch_predictions = get_predicted_classes(model(features)).numpy()
+            predictions[start + np.flatnonzero(has_data)] = batch_predictions
+        timings["predicting"] += time.perf_counter() - start_time
+    return predictions.reshape(len(lats), len(lons))
+
+
+def write_raster(output_path, predictions, lats, lons, flight_level, attrs):
+    """
+    Writes the predictions at one flight level to a compressed NetCDF file
+    """
+    raster = xr.Dataset(
+        data_vars={"turbulence": (["lat", "lon"], predictions)},
+        coords={"lat": lats, "lon": lons},
+        attrs=dict(attrs, FL=flight_level),
+    )
+    raster.to_netcdf(output_path, encoding={"turbulence": {"zlib": True, "_FillValue": NO_DATA_CLASS}})
+
+
+def check_against_create_grid(radars, volume_index, grid_spec, lats, lons, flight_level, num_points):
+    """
+    Grids the first num_points points of the lattice one at a time with
+    create_grid, printing the time per point and the largest difference from
+    the grids of the volume index
+    """
+    lat_grid, lon_grid = np.meshgrid(lats, lons, indexing="ij")
+    origins = np.column_stack([np.full(lat_grid.size, ft_to_meters(flight_level * 100)),
+                               lat_grid.ravel(), lon_grid.ravel()])[:num_points]
+    grids, has_data = volume_index.grid_points(origins, grid_spec.grid_shape, grid_spec.alt_range,
+                                               grid_spec.lat_range, grid_spec.lon_range)
+    max_diff = 0.0
+    start_time = time.perf_counter()
+    for origin, grid, point_has_data in zip(origins, grids, has_data):
+        expected = create_grid(radars=radars,
+            grid_shape=grid_spec.grid_shape,
+            alt_range=grid_spec.alt_range,
+            lat_range=grid_spec.lat_range,
+            lon_range=grid_spec.lon_range,
+            grid_origin=tuple(origin),
+            fields=list(grid_spec.fields),
+            use_kernel=True,
+            planar_distance=True)
+        if not expected:
+            max_diff = max(max_diff, np.inf if point_has_data else 0.0)
+            continue
+        expected = np.stack([expected[field].values for field in grid_spec.fields], axis=-1)
+        if not np.array_equal(np.isnan(expected), np.isnan(grid)):
+            max_diff = np.inf
+        elif not np.isnan(expected).all():
+            max_diff = max(max_diff, float(np.nanmax(np.abs(expected - grid))))
+    create_grid_time = time.perf_counter() - start_time
+    print(f"create_grid: {len(origins) / create_grid_time:.1f} points/sec gridding one at a time, "
+          f"largest difference from the volume index's grids: {max_diff}")
+
+
+def parse_range(value):
+    low, high = (float(bound) for bound in value.split(","))
+    return low, high
+
+
+def main():
+    if len(sys.argv) < 3:
+        usage()
+    model_path, output_dir = sys.argv[1], sys.argv[2]
+    radar_files = []
+    lat_range = lon_range = step = None
+    flight_levels = DEFAULT_FLIGHT_LEVELS
+    delta_t = 0.0
+    batch_size = 4096
+    num_check_points = 0
+    i = 3
+    while i < len(sys.argv):
+        if i + 1 >= len(sys.argv):
+            usage()
+        try:
+            if sys.argv[i] == "-radar_files":
+                radar_files = sys.argv[i + 1].split(",")
+            elif sys.argv[i] == "-lat":
+                lat_range = parse_range(sys.argv[i + 1])
+            elif sys.argv[i] == "-lon":
+                lon_range = parse_range(sys.argv[i + 1])
+            elif sys.argv[i] == "-step":
+                step = float(sys.argv[i + 1])
+            elif sys.argv[i] == "-fl":
+                flight_levels = [int(fl) for fl in sys.argv[i + 1].split(",")]
+            elif sys.argv[i] == "-delta_t":
+                delta_t = float(sys.argv[i + 1])
+            elif sys.argv[i] == "-batch":
+                batch_size = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-check":
+                num_check_points = int(sys.argv[i + 1])
+            else:
+                usage()
+        except ValueError:
+            usage()
+        i += 2
+
+    model, grid_spec = load_trained_model(model_path)
+    fields = list(grid_spec.fields)
+    print(f"Loaded {type(model).__name__} with grid spec {grid_spec}")
+    if radar_files:
+        radars = tuple(pyart.io.read_nexrad_archive(radar_file) for radar_file in radar_files)
+        print(f"Read {len(radars)} radar files")
+    else:
+        radars = make_synthetic_volume(fields)
+        print(f"Created {len(radars)} synthetic radars around {SYNTHETIC_RADAR_CENTER}")
+
+    start_time = time.perf_counter()
+    volume_index = VolumeIndex(radars, fields, grid_spec.degrees)
+    index_time = time.perf_counter() - start_time
+    print(f"Indexed {len(volume_index)} gates in {index_time:.2f}s")
+
+    min_lat, max_lat, min_lon, max_lon = volume_index.bounds
+    lats, lons = make_lattice(lat_range or (min_lat, max_lat), lon_range or (min_lon, max_lon),
+                              step or grid_spec.degrees)
+    num_points = len(lats) * len(lons) * len(flight_levels)
+    print(f"Predicting at {len(lats)} x {len(lons)} points at flight levels {flight_levels} ({num_points} points)")
+
+    os.makedirs(output_dir, exist_ok=True)
+    attrs = {"MODEL": os.path.basename(model_path), "DELTA_T": delta_t, "RADARS": len(radars)}
+    attrs.update(grid_spec.to_attrs())
+    timings = {"gridding": 0.0, "predicting": 0.0, "writing": 0.0}
+    for flight_level in flight_levels:
+        predictions = predict_flight_level(model, grid_spec, volume_index, lats, lons, flight_level,
+                                           delta_t, batch_size, timings)
+        start_time = time.perf_counter()
+        output_path = os.path.join(output_dir, f"turbulence_FL{flight_level:03}.nc")
+        write_raster(output_path, predictions, lats, lons, flight_level, attrs)
+        timings["writing"] += time.perf_counter() - start_time
+        print(f"FL{flight_level:03}: {np.count_nonzero(predictions != NO_DATA_CLASS)} points with radar data, "
+              f"written to {output_path}")
+
+    total_time = index_time + sum(timings.values())
+    print(f"\nindexing {index_time:.2f}s, " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+    print(f"{num_points / total_time:.0f} points/sec overall "
+          f"({num_points / (timings['gridding'] + timings['predicting']):.0f} points/sec gridding and predicting) "
+          f"on {torch.get_num_threads()} CPU threads")
+
+    if num_check_points > 0:
+        check_against_create_grid(radars, volume_index, grid_spec, lats, lons, flight_levels[0], num_check_points)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+# prediction_server.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Serves turbulence predictions over HTTP (e.g., to the frontend) from
+#   a trained or exported model and a local directory of NEXRAD files, without
+#   any network access. Each request for a (lat, lon, alt, time) is gridded
+#   around the scan of the closest radar at or before that time, as in
+#   radars/radar_data_to_model_input.py. Requests that arrive together are
+#   micro-batched: a batch is run once it is full or once its first request
+#   has waited a deadline, gridding all of the batch's points in one pass (see
+#   radars/volume_index.py) and running the model once. Indexed radar volumes
+#   and gridded inputs (per radar volume and tile, a small box around the
+#   requested location) are cached
+# Usage: python prediction_server.py MODEL_PATH RADAR_DIR [-host HOST] [-port PORT] [-max_batch N]
+#                                    [-max_wait_ms MS] [-cache_size N] [-max_age MINUTES] [-grid_spec GRID_SPEC]
+#       MODEL_PATH: A model saved by train_and_test_model.py (*.pth) or
+#                   exported by export_model.py or quantize_model.py (*.pt2, *.pt)
+#       RADAR_DIR: A directory (searched recursively) of NEXRAD files named
+#                  like KJGX20240131_235419_V06
+#       -host, -port: Where to listen (default 127.0.0.1:8080)
+#       -max_batch: The largest number of requests in a batch (default 256)
+#       -max_wait_ms: The longest a request waits for a batch to fill (default 10)
+#       -cache_size: The number of gridded inputs to cache (default 4096)
+#       -max_age: The oldest a radar scan can be, in minutes (default 30)
+#       -grid_spec: The grid spec of the model (default: the one saved next to it)
+# Endpoints:
+#       GET /predict?lat=LAT&lon=LON&alt=FEET&time=ISO_TIME (or POST the same as JSON)
+#       GET /metrics: p50/p99 latency, batch sizes, and cache hit rates
+#       GET /health
+
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import datetime
+import os
+import re
+import sys
+import time
+import numpy as np
+import pandas as pd
+import torch
+from aiohttp import web
+from haversine import haversine_vector
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+# Append to sys path to import the gridding code from radars
+sys.path.append(os.path.join(DIRNAME, "..", "radars"))
+
+from trained_model import load_grid_spec, load_trained_model
+from export_model import load_exported_model
+from evaluation import get_predicted_classes
+from lattice_inference import ft_to_meters, make_features
+import quiet_pyart as pyart
+from volume_index import VolumeIndex
+from grid_config.grid_spec import get_grid_spec
+
+# e.g., KJGX20240131_235419_V06
+RADAR_FILENAME_REGEX = re.compile(r"^([A-Z]{4})(\d{8}_\d{6})")
+NEXRAD_SITES_PATH = os.path.join(DIRNAME, "..", "radars", "nexrad_sites.csv")
+# Radars farther than this from a request have no data in its grid
+MAX_RADAR_DISTANCE_KM = 230
+# How often the radar directory is checked for new files
+RESCAN_SECONDS = 30
+# The number of indexed radar volumes kept in memory
+NUM_CACHED_VOLUMES = 4
+# The number of recent requests and batches the metrics are computed over
+NUM_METRICS_SAMPLES = 10000
+# Returned by LRUCache.get for keys that are not cached (None can be cached)
+NOT_CACHED = object()
+
+
+def usage():
+    print(f"Usage: python {sys.argv[0]} MODEL_PATH RADAR_DIR [-host HOST] [-port PORT] [-max_batch N] "
+          "[-max_wait_ms MS] [-cache_size N] [-max_age MINUTES] [-grid_spec GRID_SPEC]")
+    exit(1)
+
+
+class LRUCache:
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        """
+        Returns the value of key (marking it as the most recently used), or
+        default if it is not cached
+        """
+        if key not in self.items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+
+class RadarDirectory:
+
+    def __init__(self, dir_path, fields, bucket_degrees, max_age):
+        """
+        Parameters:
+            dir_path -- The directory (searched recursively) of NEXRAD files
+            fields -- The fields to grid
+            bucket_degrees -- The width of the buckets of each VolumeIndex
+            max_age -- The oldest (a datetime.timedelta) a scan can be
+        """
+        self.dir_path = dir_path
+        self.fields = fields
+        self.bucket_degrees = bucket_degrees
+        self.max_age = max_age
+        self.sites = pd.read_csv(NEXRAD_SITES_PATH).set_index("Site Code")
+        self.volumes = LRUCache(NUM_CACHED_VOLUMES)
+        self.last_scan_time = -np.inf
+        self.rescan()
+
+    def rescan(self):
+        """
+        Finds every radar file in the directory, sorted by site and time
+        """
+        scans = collections.defaultdict(list)
+        for root, _, filenames in os.walk(self.dir_path):
+            for filename in filenames:
+                match = RADAR_FILENAME_REGEX.match(filename)
+                if match is None or match.group(1) not in self.sites.index:
+                    continue
+                scan_time = datetime.datetime.strptime(match.group(2), "%Y%m%d_%H%M%S")
+                scans[match.group(1)].append((scan_time, os.path.join(root, filename)))
+        self.scans = {site: sorted(site_scans) for site, site_scans in scans.items()}
+        self.site_codes = list(self.scans)
+        self.site_locations = self.sites.loc[self.site_codes, ["Latitude", "Longitude"]].to_numpy()
+        self.last_scan_time = time.monotonic()
+
+    def find_scan(self, lat, lon, request_time):
+        """
+        Finds the scan of the closest radar (within MAX_RADAR_DISTANCE_KM) with
+        a scan at or up to max_age before request_time
+        Returns:
+            The (path, scan time) of the scan, or None if there is none
+        """
+        if time.monotonic() - self.last_scan_time > RESCAN_SECONDS:
+            self.rescan()
+        if not self.site_codes:
+            return None
+        distances = haversine_vector(np.array([[lat, lon]]), self.site_locations, unit="km", comb=True).ravel()
+        for site_idx in np.argsort(distances):
+            if distances[site_idx] > MAX_RADAR_DISTANCE_KM:
+                break
+            site_scans = self.scans[self.site_codes[site_idx]]
+            scan_idx = bisect.bisect_right(site_scans, (request_time, chr(0x10FFFF))) - 1
+            if scan_idx >= 0 and request_time - site_scans[scan_idx][0] <= self.max_age:
+                return site_scans[scan_idx][1], site_scans[scan_idx][0]
+        return None
+
+    def get_volume_index(self, path):
+        """
+        Returns the VolumeIndex of a radar file, reading and indexing it if it
+        is not cached
+        """
+        volume_index = self.volumes.get(path)
+        if volume_index is None:
+            radar = pyart.io.read_nexrad_archive(path)
+            # Some files have the radar at longitude 0, so use the site's
+            # longitude (as in radar_data_to_model_input.py)
+            if radar.longitude['data'] == 0:
+                site_longitude = self.sites.loc[RADAR_FILENAME_REGEX.match(os.path.basename(path)).group(1), "Longitude"]
+                radar.gate_longitude['data'] += site_longitude
+                radar.longitude['data'] = np.array([site_longitude])
+            volume_index = VolumeIndex(radar, self.fields, self.bucket_degrees)
+            self.volumes.put(path, volume_index)
+        return volume_index
+
+
+class Predictor:
+
+    def __init__(self, model, grid_spec, radar_directory, cache_size):
+        """
+        Parameters:
+            model -- The model (or exported model), in eval mode
+            grid_spec -- The GridSpec of the model's inputs
+            radar_directory -- The RadarDirectory to grid from
+            cache_size -- The number of gridded inputs to cache
+        """
+        self.model = model
+        self.grid_spec = grid_spec
+        self.radar_directory = radar_directory
+        self.grids = LRUCache(cache_size)
+        # Requests are snapped to the center of a tile the size of one grid
+        # cell, so requests in the same tile share a grid
+        self.tile_degrees = grid_spec.degrees / grid_spec.n_lat
+        self.tile_meters = grid_spec.z_size / grid_spec.n_alt
+
+    def get_tile(self, lat, lon, alt_meters):
+        return (round(lat / self.tile_degrees), round(lon / self.tile_degrees), round(alt_meters / self.tile_meters))
+
+    def predict_batch(self, requests):
+        """
+        Predicts the turbulence for a batch of requests
+        Parameters:
+            requests -- A list of (lat, lon, alt in feet, time) tuples
+        Returns:
+            A list of the response to each request
+        """
+        responses = [None] * len(requests)
+        keys = [None] * len(requests)
+        # The grid of each tile in the batch (None for tiles without radar data)
+        grids = {}
+        # The tiles of each radar volume that are not cached (dicts as ordered sets)
+        misses = collections.defaultdict(dict)
+        for i, (lat, lon, alt, request_time) in enumerate(requests):
+            scan = self.radar_directory.find_scan(lat, lon, request_time)
+            if scan is None:
+                responses[i] = {"turbulence": None, "error": "No radar scan found for this location and time"}
+                continue
+            path, scan_time = scan
+            keys[i] = (path, self.get_tile(lat, lon, ft_to_meters(alt)))
+            # The same as the DELTA_T of the training inputs
+            responses[i] = {"radar": os.path.basename(path), "delta_t": (request_time - scan_time).seconds}
+            if keys[i] not in grids and keys[i] not in misses[path]:
+                grid = self.grids.get(keys[i], NOT_CACHED)
+                if grid is NOT_CACHED:
+                    misses[path][keys[i]] = None
+                else:
+                    grids[keys[i]] = grid
+
+        # Grid the tiles that are not cached, in one pass per radar volume
+        for path, path_keys in misses.items():
+            path_keys = list(path_keys)
+            origins = np.array([(tile_alt * self.tile_meters, tile_lat * self.tile_degrees, tile_lon * self.tile_degrees)
+                                for _, (tile_lat, tile_lon, tile_alt) in path_keys])
+            path_grids, has_data = self.radar_directory.get_volume_index(path).grid_points(
+                origins, self.grid_spec.grid_shape, self.grid_spec.alt_range,
+                self.grid_spec.lat_range, self.grid_spec.lon_range)
+            for key, grid, grid_has_data in zip(path_keys, path_grids, has_data):
+                grids[key] = grid if grid_has_data else None
+                self.grids.put(key, grids[key])
+
+        predicted = [i for i, key in enumerate(keys) if key is not None and grids[key] is not None]
+        for i, key in enumerate(keys):
+            if key is not None and grids[key] is None:
+                responses[i].update(turbulence=None, error="No radar data around this location")
+        if predicted:
+            features = make_features(np.stack([grids[keys[i]] for i in predicted]),
+                                     np.array([requests[i][0] for i in predicted]),
+                                     np.array([requests[i][1] for i in predicted]),
+                                     np.array([requests[i][2] for i in predicted]),
+                                     np.array([responses[i]["delta_t"] for i in predicted]),
+                                     self.grid_spec.fields)
+            with torch.inference_mode():
+                classes = get_predicted_classes(self.model(features)).tolist()
+            for i, predicted_class in zip(predicted, classes):
+                responses[i]["turbulence"] = predicted_class
+        return responses
+
+
+class Batcher:
+
+    def __init__(self, predictor, max_batch, max_wait):
+        """
+        Parameters:
+            predictor -- The Predictor to run each batch with
+            max_batch -- The largest number of requests in a batch
+            max_wait -- The longest (in seconds) the first request of a batch
+                waits for more requests
+        """
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        # Batches run one at a time off of the event loop, so it keeps
+        # accepting requests while the model runs
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.latencies = collections.deque(maxlen=NUM_METRICS_SAMPLES)
+        self.batch_sizes = collections.deque(maxlen=NUM_METRICS_SAMPLES)
+        self.num_requests = 0
+
+    async def predict(self, request):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_sizes.append(len(batch))
+            try:
+                responses = await loop.run_in_executor(self.executor, self.predictor.predict_batch,
+                                                       [request for request, _ in batch])
+                for (_, future), response in zip(batch, responses):
+                    future.set_result(response)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+    def get_metrics(self):
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        batch_sizes = np.array(self.batch_sizes) if self.batch_sizes else np.zeros(1)
+        grids = self.predictor.grids
+        return {
+            "requests": self.num_requests,
+            "latency_ms": {
+                "p50": float(np.percentile(latencies, 50)),
+                "p99": float(np.percentile(latencies, 99)),
+                "max": float(latencies.max()),
+            },
+            "batch_size": {
+                "mean": float(batch_sizes.mean()),
+                "p50": float(np.percentile(batch_sizes, 50)),
+                "max": int(batch_sizes.max()),
+            },
+            "grid_cache": {"size": len(grids), "hits": grids.hits, "misses": grids.misses},
+            "volume_cache": {"size": len(self.predictor.radar_directory.volumes),
+                             "hits": self.predictor.radar_directory.volumes.hits,
+                             "misses": self.predictor.radar_directory.volumes.misses},
+        }
+
+
+def parse_request(params):
+    """
+    Returns the (lat, lon, alt in feet, time) of a request, raising ValueError
+    if any of them are missing or invalid
+    """
+    try:
+        lat, lon, alt = float(params["lat"]), float(params["lon"]), float(params["alt"])
+        request_time = datetime.datetime.fromisoformat(str(params["time"]))
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Expected lat, lon, alt (in feet), and time (ISO 8601): {e}")
+    # Radar scan times are in UTC and stored without a timezone
+    if request_time.tzinfo is not None:
+        request_time = request_time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return lat, lon, alt, request_time
+
+
+def make_app(batcher):
+    routes = web.RouteTableDef()
+
+    @routes.route("*", "/predict")
+    async def predict(request):
+        start_time = time.perf_counter()
+        try:
+            # A malformed JSON body raises a JSONDecodeError, which is a ValueError
+            params = await request.json() if request.method == "POST" else request.query
+            response = await batcher.predict(parse_request(params))
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+        batcher.num_requests += 1
+        batcher.latencies.append((time.perf_counter() - start_time) * 1000)
+        return web.json_response(response, status=200 if response["turbulence"] is not None else 404)
+
+    @routes.get("/metrics")
+    async def metrics(request):
+        return web.json_response(batcher.get_metrics())
+
+    @routes.get("/health")
+    async def health(request):
+        return web.json_response({"status": "ok"})
+
+    async def start_batcher(app):
+        app["batcher_task"] = asyncio.create_task(batcher.run())
+
+    async def stop_batcher(app):
+        app["batcher_task"].cancel()
+        batcher.executor.shutdown()
+
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_startup.append(start_batcher)
+    app.on_cleanup.append(stop_batcher)
+    return app
+
+
+def main():
+    if len(sys.argv) < 3:
+        usage()
+    model_path, radar_dir = sys.argv[1], sys.argv[2]
+    host, port = "127.0.0.1", 8080
+    max_batch = 256
+    max_wait_ms = 10.0
+    cache_size = 4096
+    max_age_minutes = 30.0
+    grid_spec = None
+    i = 3
+    while i < len(sys.argv):
+        if i + 1 >= len(sys.argv):
+            usage()
+        try:
+            if sys.argv[i] == "-host":
+                host = sys.argv[i + 1]
+            elif sys.argv[i] == "-port":
+                port = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-max_batch":
+                max_batch = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-max_wait_ms":
+                max_wait_ms = float(sys.argv[i + 1])
+            elif sys.argv[i] == "-cache_size":
+                cache_size = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-max_age":
+                max_age_minutes = float(sys.argv[i + 1])
+            elif sys.argv[i] == "-grid_spec":
+                grid_spec = get_grid_spec(sys.argv[i + 1])
+            else:
+                usage()
+        except ValueError:
+            usage()
+        i += 2
+
+    if model_path.endswith(".pth"):
+        model, saved_grid_spec = load_trained_model(model_path)
+    else:
+        # Exported models are saved with their grid spec, so a missing one is
+        # an error rather than the original reflectivity-only grid
+        model = load_exported_model(model_path)
+        saved_grid_spec = grid_spec or load_grid_spec(model_path, required=True)
+    grid_spec = grid_spec or saved_grid_spec
+    print(f"Loaded {model_path} with grid spec {grid_spec}")
+
+    radar_directory = RadarDirectory(radar_dir, list(grid_spec.fields), grid_spec.degrees,
+                                     datetime.timedelta(minutes=max_age_minutes))
+    print(f"Found {sum(len(scans) for scans in radar_directory.scans.values())} radar files from "
+          f"{len(radar_directory.scans)} sites in {radar_dir}")
+
+    predictor = Predictor(model, grid_spec, radar_directory, cache_size)
+    batcher = Batcher(predictor, max_batch, max_wait_ms / 1000)
+    web.run_app(make_app(batcher), host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# quantize_model.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Creates an int8 version of a model trained by train_and_test_model.py
+#   for serving on CPU. Linear layers are quantized dynamically (their weights
+#   are int8, and their inputs are quantized as they arrive), and the conv
+#   branch of the hybrid models is quantized statically, with the range of each
+#   layer's activations calibrated on a sample of the training inputs. It then
+#   reports the test accuracy, false positive rate, and false negative rate of
+#   the int8 model against the float32 model, along with their latency and
+#   size, and saves the int8 model as TorchScript
+# Usage: python quantize_model.py MODEL_PATH DATALOADER_PATH [-calibration NUM_INPUTS]
+#                                 [-batch BATCH_SIZE] [-runs NUM_RUNS] [-output OUTPUT_PATH]
+#       MODEL_PATH: A model saved by train_and_test_model.py (*.pth)
+#       DATALOADER_PATH: The dataloader the model was trained on. It is split
+#                        with the seed in MODEL_PATH, so the metrics are on the
+#                        same held-out test inputs as in training
+#       -calibration: The number of training inputs to calibrate the conv
+#                     branch on (default 2000)
+#       -batch: The number of inputs in each batch (default 256)
+#       -runs: The number of timed runs of each latency benchmark (default 20)
+#       -output: Where to save the int8 model (default: MODEL_PATH ending in _int8.pt).
+#                Its grid spec is saved next to it
+
+import copy
+import io
+import os
+import sys
+import torch
+from torch import nn
+import torch.ao.quantization as quantization
+
+from trained_model import get_grid_spec_path, load_trained_model, load_test_split, save_grid_spec
+from evaluation import ConfusionMatrix, get_predicted_classes
+from export_model import EXPORT_BATCH_SIZE, time_model
+
+
+def usage():
+    print(f"Usage: python {sys.argv[0]} MODEL_PATH DATALOADER_PATH [-calibration NUM_INPUTS] "
+          "[-batch BATCH_SIZE] [-runs NUM_RUNS] [-output OUTPUT_PATH]")
+    exit(1)
+
+
+def fuse_conv_relu(conv_branch):
+    """
+    Fuses each Conv3d followed by a ReLU in conv_branch (an nn.Sequential)
+    into one layer, so the quantized conv applies the ReLU itself
+    """
+    layers = list(conv_branch.named_children())
+    pairs = [[name, next_name] for (name, layer), (next_name, next_layer) in zip(layers, layers[1:])
+             if isinstance(layer, nn.Conv3d) and isinstance(next_layer, nn.ReLU)]
+    return quantization.fuse_modules(conv_branch, pairs)
+
+
+def quantize_model(model, calibration_inputs, batch_size):
+    """
+    Returns an int8 copy of a model. The conv branch (if the model has one)
+    is quantized statically, and the Linear layers dynamically
+    Parameters:
+        model -- A float32 model in eval mode
+        calibration_inputs -- A tensor of inputs to calibrate the range of the
+            conv branch's activations on
+        batch_size -- The number of calibration inputs to run at once
+    """
+    model = copy.deepcopy(model)
+    if hasattr(model, "conv_branch"):
+        # Quantized Conv3d needs explicit padding, which for the odd kernels
+        # (and stride 1) of the hybrid models is the same as padding="same"
+        for layer in model.conv_branch.modules():
+            if isinstance(layer, nn.Conv3d) and layer.padding == "same":
+                layer.padding = tuple(kernel_size // 2 for kernel_size in layer.kernel_size)
+
+        # The stubs quantize the conv branch's input and dequantize its output
+        model.conv_branch = nn.Sequential(quantization.QuantStub(), fuse_conv_relu(model.conv_branch),
+                                          quantization.DeQuantStub())
+        model.conv_branch.qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+        quantization.prepare(model, inplace=True)
+        with torch.no_grad():
+            for x in torch.split(calibration_inputs, batch_size):
+                model(x)
+        quantization.convert(model, inplace=True)
+    return quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def get_test_metrics(model, features, labels, batch_size):
+    """
+    Returns the predicted classes of a model on the test inputs, and its
+    accuracy, false positive rate, and false negative rate, as in the testing
+    of train_and_test_model.py
+    """
+    with torch.inference_mode():
+        predictions = torch.cat([get_predicted_classes(model(x)) for x in torch.split(features, batch_size)])
+    confusion = ConfusionMatrix()
+    confusion.update(labels, predictions)
+    metrics = confusion.get_metrics()
+    return predictions, {name: metrics[name].item() for name in ("accuracy", "false positive rate", "false negative rate")}
+
+
+def get_size_mb(model):
+    # The size of the model's saved state_dict
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+
+def main():
+    if len(sys.argv) < 3:
+        usage()
+    model_path, dataloader_path = sys.argv[1], sys.argv[2]
+    num_calibration_inputs = 2000
+    batch_size = 256
+    num_runs = 20
+    output_path = os.path.splitext(model_path)[0] + "_int8.pt"
+    i = 3
+    while i < len(sys.argv):
+        if i + 1 >= len(sys.argv):
+            usage()
+        try:
+            if sys.argv[i] == "-calibration":
+                num_calibration_inputs = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-batch":
+                batch_size = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-runs":
+                num_runs = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-output":
+                output_path = sys.argv[i + 1]
+            else:
+                usage()
+        except ValueError:
+            usage()
+        i += 2
+
+    model, grid_spec = load_trained_model(model_path)
+    (train_features, _), (test_features, test_labels) = load_test_split(dataloader_path, model_path, grid_spec)
+    print(f"Loaded {type(model).__name__} and {len(test_labels)} test inputs with grid spec {grid_spec}")
+
+    calibration_inputs = train_features[torch.randperm(len(train_features), generator=torch.Generator().manual_seed(0))
+                                        [:num_calibration_inputs]]
+    quantized_model = quantize_model(model, calibration_inputs, batch_size)
+    print(f"Calibrated the conv branch on {len(calibration_inputs)} training inputs "
+          f"({torch.backends.quantized.engine} backend)")
+
+    float_predictions, float_metrics = get_test_metrics(model, test_features, test_labels, batch_size)
+    int8_predictions, int8_metrics = get_test_metrics(quantized_model, test_features, test_labels, batch_size)
+    print(f"\n{'test metric':<22}{'float32':>10}{'int8':>10}{'delta':>10}")
+    for name in float_metrics:
+        print(f"{name:<22}{float_metrics[name]:>10.2%}{int8_metrics[name]:>10.2%}"
+              f"{int8_metrics[name] - float_metrics[name]:>+10.2%}")
+    print(f"The int8 model predicts the same class as float32 for "
+          f"{(int8_predictions == float_predictions).float().mean().item():.2%} of the test inputs")
+
+    single_input, batch_inputs = test_features[:1], test_features[:batch_size]
+    print(f"\n{'model':<10}{'size (MB)':>11}{'1 input (ms)':>14}{f'{len(batch_inputs)} inputs (ms)':>18}{'speedup':>9}")
+    base_time = None
+    for name, timed_model in (("float32", model), ("int8", quantized_model)):
+        single_time = time_model(timed_model, single_input, num_runs)
+        batch_time = time_model(timed_model, batch_inputs, num_runs)
+        base_time = base_time or batch_time
+        print(f"{name:<10}{get_size_mb(timed_model):>11.3f}{single_time * 1000:>14.3f}{batch_time * 1000:>18.2f}"
+              f"{base_time / batch_time:>8.2f}x")
+
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized_model, test_features[:EXPORT_BATCH_SIZE])
+    torch.jit.save(traced, output_path)
+    # Saved next to the int8 model, which does not record its grid spec
+    save_grid_spec(output_path, grid_spec)
+    print(f"\nSaved the int8 model to {output_path}, and its grid spec to {get_grid_spec_path(output_path)}")
+
+
+if __name__ == "__main__":
+    main()
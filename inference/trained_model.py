@@ -0,0 +1,170 @@
+# trained_model.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Loads a model saved by train_and_test_model.py for inference. The
+#   model class and its hyperparameters are read from the *_model_config.json
+#   saved next to it, or for models saved before those were, from the file
+#   name through the model registry (e.g.,
+#   ..._best_hybrid_mse_model_w_seed_42.pth is a HybridModel1Out), and only
+#   that class's module is imported. The grid spec is read from the
+#   *_grid_spec.json saved next to it (which export_model.py and
+#   quantize_model.py also save next to their outputs). Models saved before
+#   grid specs were saved use the original reflectivity-only grid. Also splits a
+#   saved dataloader into the same training and test inputs as the model's
+#   training run
+
+import functools
+import json
+import os
+import re
+import sys
+import torch
+
+# Append to sys path to import grid_config and model_architecture, and
+# model_training so that saved dataloaders can be unpickled
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model_training"))
+
+from grid_config.grid_spec import GridSpec, REFLECTIVITY_GRID_SPEC
+from model_architecture.constants import NUM_LINEAR_FEATURES
+from model_architecture.model_registry import get_entry_point, import_entry_point
+from dataloader_class import get_dataset_grid_spec
+from class_balance import get_labels, get_stratified_splits
+from split_cache import get_random_splits, load_or_compute_splits
+
+# The model type, loss type, and seed in the names of the models
+# train_and_test_model.py saves. Models saved before the loss type was in the
+# file name used nll
+MODEL_FILENAME_REGEX = re.compile(r"_best_(\w+?)(?:_(nll|mse|mae))?_model_w_seed_(\d+)")
+# Where train_and_test_model.py saves the splits of each dataset and seed
+SPLIT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model_training",
+                               "trained_model_outputs", "split_cache")
+# How the inputs of models whose model configs do not record their splits
+# (those saved before they did) were split
+DEFAULT_SPLITS = {"stratify": False, "test_size": 0.10, "num_folds": 6}
+
+
+def get_model_config_path(model_path):
+    return os.path.splitext(model_path)[0] + "_model_config.json"
+
+
+def load_model_config(model_path):
+    """
+    Returns the model config saved next to the model at model_path, or None
+    for models saved before model configs were saved
+    """
+    model_config_path = get_model_config_path(model_path)
+    if not os.path.exists(model_config_path):
+        return None
+    with open(model_config_path) as model_config_file:
+        return json.load(model_config_file)
+
+
+def get_model_class(model_path):
+    """
+    Returns the class of the model saved at model_path (with the
+    hyperparameters it was trained with), from the model config saved next to
+    it, or else from its file name (with the class's default hyperparameters,
+    which the models saved before model configs were saved were trained with)
+    """
+    model_config = load_model_config(model_path)
+    if model_config is not None:
+        return functools.partial(import_entry_point(model_config["entry_point"]), **model_config["hyperparameters"])
+    match = MODEL_FILENAME_REGEX.search(os.path.basename(model_path))
+    if match is None:
+        raise ValueError(f"Could not tell the model type of {model_path} from its name")
+    model_type, loss_type = match.group(1), match.group(2) or "nll"
+    return import_entry_point(get_entry_point(model_type, loss_type))
+
+
+def get_seed(model_path):
+    """
+    Returns the seed the dataset was split with to train the model saved at
+    model_path, from its file name
+    """
+    match = MODEL_FILENAME_REGEX.search(os.path.basename(model_path))
+    if match is None:
+        raise ValueError(f"Could not tell the seed of {model_path} from its name")
+    return int(match.group(3))
+
+
+def get_grid_spec_path(model_path):
+    return os.path.splitext(model_path)[0] + "_grid_spec.json"
+
+
+def save_grid_spec(model_path, grid_spec):
+    """
+    Saves grid_spec next to the model (or exported model) at model_path, where
+    load_grid_spec reads it
+    """
+    with open(get_grid_spec_path(model_path), "w") as grid_spec_file:
+        grid_spec_file.write(grid_spec.to_json())
+
+
+def load_grid_spec(model_path, required=False):
+    """
+    Returns the GridSpec saved next to the model at model_path, or the
+    original reflectivity-only spec if there is none
+    Parameters:
+        required -- Raise a FileNotFoundError if there is none instead (e.g.,
+            for exported models, which are always saved with one)
+    """
+    grid_spec_path = get_grid_spec_path(model_path)
+    if not os.path.exists(grid_spec_path):
+        if required:
+            raise FileNotFoundError(f"No grid spec saved next to {model_path} at {grid_spec_path}")
+        return REFLECTIVITY_GRID_SPEC
+    with open(grid_spec_path) as grid_spec_file:
+        return GridSpec.from_json(grid_spec_file.read())
+
+
+def load_trained_model(model_path, Model=None):
+    """
+    Loads a trained model onto the CPU, in eval mode
+    Parameters:
+        model_path -- The path to a state_dict saved by train_and_test_model.py
+        Model -- The class of the model (default: read from the file name)
+    Returns:
+        The model and its GridSpec
+    """
+    Model = Model or get_model_class(model_path)
+    grid_spec = load_grid_spec(model_path)
+    model = Model(grid_spec=grid_spec)
+    model.load_state_dict(torch.load(model_path, map_location="cpu", weights_only=True))
+    model.eval()
+    return model, grid_spec
+
+
+def load_test_split(dataloader_path, model_path, grid_spec):
+    """
+    Loads a dataloader saved by create_datasets.py and splits it the same way
+    train_and_test_model.py did when it trained the model at model_path (with
+    the split settings recorded in its model config, e.g., -stratify)
+    Returns:
+        The (features, labels) tensors of the training and of the held-out
+        test inputs
+    """
+    dataset = torch.load(dataloader_path, weights_only=False)
+    dataset_grid_spec = get_dataset_grid_spec(dataset)
+    if dataset_grid_spec != grid_spec:
+        raise ValueError(f"The inputs in {dataloader_path} have grid spec {dataset_grid_spec}, "
+                         f"but the model expects {grid_spec}")
+    features, labels = dataset.get_tensors()
+    splits = (load_model_config(model_path) or {}).get("splits", DEFAULT_SPLITS)
+    split_fn = get_stratified_splits if splits["stratify"] else get_random_splits
+    # From the same split cache as training (or computed and saved there)
+    train_idx, test_idx, _ = load_or_compute_splits(SPLIT_CACHE_DIR, get_labels(dataset), get_seed(model_path),
+                                                    split_fn, test_size=splits["test_size"],
+                                                    num_folds=splits["num_folds"])
+    train_indices = torch.as_tensor(train_idx)
+    test_indices = torch.as_tensor(test_idx)
+    return (features[train_indices], labels[train_indices]), (features[test_indices], labels[test_indices])
+
+
+def make_example_inputs(grid_spec, batch_size, seed=0):
+    """
+    Returns a (batch_size x num_features) tensor of random inputs shaped like
+    the model inputs of grid_spec
+    """
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(batch_size, NUM_LINEAR_FEATURES + grid_spec.num_grid_features, generator=generator)
@@ -0,0 +1,187 @@
+# benchmark_models.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Measures the training step time (forward, backward, and optimizer
+#   step on one batch) and peak memory of HybridModel, HybridModel1Out, and
+#   LinearClassifierModel in float32 and in mixed precision (bfloat16 on CPU,
+#   float16 on CUDA), each with and without the channels_last_3d memory
+#   format. Every mode is also trained for a few steps from the same weights on
+#   the same random batches as float32, to check that its loss stays within
+#   LOSS_TOLERANCE of float32's
+# Usage: python benchmark_models.py [-batch BATCH_SIZE] [-steps NUM_STEPS] [-grid_spec GRID_SPEC]
+#       -batch: The number of inputs in each batch (default 2000)
+#       -steps: The number of timed training steps of each mode (default 5)
+#       -grid_spec: The name of (or path to) the grid spec of the inputs
+#                   (default reflectivity, the spec of the saved models)
+
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import torch
+from torch import nn
+import torch.optim as optim
+
+DIRNAME = os.path.dirname(sys.argv[0])
+
+# Append to sys path to import grid_config and model_training
+sys.path.append(os.path.join(DIRNAME, ".."))
+
+from grid_config.grid_spec import get_grid_spec
+from constants import NUM_LINEAR_FEATURES
+from hybrid_model import HybridModel
+from hybrid_model_1_out import HybridModel1Out
+from regression_model import LinearClassifierModel
+from model_training.mixed_precision import get_autocast, make_grad_scaler, prepare_model
+
+# Each model and the loss it is trained with
+MODELS = {
+    "HybridModel": (HybridModel, "nll"),
+    "HybridModel1Out": (HybridModel1Out, "mse"),
+    "LinearClassifierModel": (LinearClassifierModel, "nll"),
+}
+# Each mode is (mixed precision, channels_last_3d)
+MODES = {
+    "float32": (False, False),
+    "channels_last": (False, True),
+    "amp": (True, False),
+    "amp_channels_last": (True, True),
+}
+NUM_WARMUP_STEPS = 2
+# The relative difference from float32's loss (after the accuracy check's
+# steps) that a mode must stay within
+LOSS_TOLERANCE = 0.05
+
+
+def usage():
+    print(f"Usage: python {sys.argv[0]} [-batch BATCH_SIZE] [-steps NUM_STEPS] [-grid_spec GRID_SPEC]")
+    exit(1)
+
+
+def make_batches(num_batches, batch_size, grid_spec):
+    """
+    Returns a list of (x, y) random batches, where the labels depend on the
+    inputs so that the models can learn something
+    """
+    generator = torch.Generator().manual_seed(0)
+    batches = []
+    for _ in range(num_batches):
+        x = torch.randn(batch_size, NUM_LINEAR_FEATURES + grid_spec.num_grid_features, generator=generator)
+        y = torch.clamp((x[:, NUM_LINEAR_FEATURES:].mean(dim=1) * 20 + 5).round(), 0, 9).long()
+        batches.append((x, y))
+    return batches
+
+
+def train_step(model, optimizer, scaler, x, y, loss_type, device, amp):
+    """
+    Runs one training step, returning the loss
+    """
+    x, y = x.to(device), y.to(device)
+    optimizer.zero_grad()
+    with get_autocast(device, amp):
+        y_hat = model(x)
+        if loss_type == "nll":
+            loss = nn.functional.nll_loss(nn.functional.log_softmax(y_hat, dim=-1), y)
+        else:
+            loss = nn.functional.mse_loss(y_hat, y.float())
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+    return loss.item()
+
+
+def get_rss_kb():
+    # The resident memory of this process, in KB
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def benchmark_mode(model_name, mode, batches, grid_spec, num_steps, device, result_queue):
+    """
+    Trains a new model in one mode, putting its mean step time, peak memory,
+    and its losses on the accuracy check's batches on result_queue. This runs
+    in its own process, so the peak memory of each mode is measured separately
+    """
+    Model, loss_type = MODELS[model_name]
+    amp, channels_last = MODES[mode]
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    start_rss = get_rss_kb()
+
+    # The models seed their weights, so every mode starts from the same ones
+    model = prepare_model(Model(grid_spec=grid_spec).to(device), channels_last)
+    model.train()
+    optimizer = optim.Adam(model.parameters(), lr=0.001)
+    scaler = make_grad_scaler(device, amp)
+    losses = [train_step(model, optimizer, scaler, x, y, loss_type, device, amp) for x, y in batches]
+
+    x, y = batches[0]
+    for _ in range(NUM_WARMUP_STEPS):
+        train_step(model, optimizer, scaler, x, y, loss_type, device, amp)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(num_steps):
+        train_step(model, optimizer, scaler, x, y, loss_type, device, amp)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    step_time = (time.perf_counter() - start_time) / num_steps
+
+    if device.type == "cuda":
+        peak_memory_mb = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        # ru_maxrss is in KB on Linux
+        peak_memory_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss) / 1024
+    result_queue.put((step_time, peak_memory_mb, losses))
+
+
+def main():
+    batch_size = 2000
+    num_steps = 5
+    grid_spec_name = "reflectivity"
+    i = 1
+    while i < len(sys.argv):
+        if i + 1 >= len(sys.argv):
+            usage()
+        try:
+            if sys.argv[i] == "-batch":
+                batch_size = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-steps":
+                num_steps = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-grid_spec":
+                grid_spec_name = sys.argv[i + 1]
+            else:
+                usage()
+        except ValueError:
+            usage()
+        i += 2
+
+    grid_spec = get_grid_spec(grid_spec_name)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    batches = make_batches(3, batch_size, grid_spec)
+    # Each mode runs in a fresh process (forked, so CUDA is not initialized here)
+    context = multiprocessing.get_context("fork")
+
+    print(f"Device: {device}, batch size: {batch_size}, grid spec: {grid_spec}")
+    print(f"{'model':<23}{'mode':<19}{'step (ms)':>10}{'speedup':>9}{'peak MB':>9}{'loss diff':>11}")
+    for model_name in MODELS:
+        base_step_time = base_losses = None
+        for mode in MODES:
+            result_queue = context.Queue()
+            process = context.Process(target=benchmark_mode, args=(model_name, mode, batches, grid_spec,
+                                                                   num_steps, device, result_queue))
+            process.start()
+            step_time, peak_memory_mb, losses = result_queue.get()
+            process.join()
+
+            base_step_time = base_step_time or step_time
+            base_losses = base_losses or losses
+            loss_diff = abs(losses[-1] - base_losses[-1]) / max(abs(base_losses[-1]), 1e-8)
+            flag = "" if loss_diff <= LOSS_TOLERANCE else "  <-- outside tolerance"
+            print(f"{model_name:<23}{mode:<19}{step_time * 1000:>10.1f}{base_step_time / step_time:>8.2f}x"
+                  f"{peak_memory_mb:>9.1f}{loss_diff:>10.3%}{flag}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+# constants.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: The input and output sizes shared by every model architecture, in a
+#   module without any dependencies, so the training, evaluation, and
+#   inference code can import them without importing (and building) a model
+
+NUM_CLASSES_TO_LEARN = 10 # Final Output should be projected to this
+
+NUM_LINEAR_FEATURES = 4 # lat long alt delta_t 
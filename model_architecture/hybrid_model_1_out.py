@@ -2,57 +2,61 @@
 # Team Celestial Blue
 # Spring 2025
 
+import os
+import sys
 import torch
 from torch import nn
-from torch.utils.data import Dataset, DataLoader
 # from https://pytorch.org/tutorials/beginner/introyt/modelsyt_tutorial.html
 
-NUM_CHANNELS = 1 # This corresponds to the number of fields of the gridded input
-NUM_CLASSES_TO_LEARN = 10 # Final Output should be projected to this
-SMALLER_CLASSES_TO_LEARN = 6
+# Append to sys path to import grid_config
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 
-N_ALT = 10
-N_LAT = 16
-N_LON = 16
+from grid_config.grid_spec import REFLECTIVITY_GRID_SPEC
+from model_architecture.constants import NUM_CLASSES_TO_LEARN, NUM_LINEAR_FEATURES
 
-NUM_GRID_FEATURES = N_ALT * N_LAT * N_LAT # Number of grid features
-NUM_LINEAR_FEATURES = 4 # lat long alt delta_t 
-NUM_FIELDS = 1
+SMALLER_CLASSES_TO_LEARN = 6
 
 class HybridModel1Out(nn.Module):
-    def __init__(self):
+    # The memory format the conv branch's weights and inputs are stored in
+    memory_format = torch.contiguous_format
+
+    # grid_spec is the GridSpec of the gridded input. Each of its fields is an
+    # input channel to the conv branch, and the conv branch is sized to its shape.
+    # The other arguments are the architecture's hyperparameters (set for each
+    # model type in model_registry.json), and their defaults are the
+    # architecture the saved models were trained with:
+    #   fc_widths -- The output size of each layer of the fully connected branch
+    #   conv_channels -- The output channels of each Conv3d of the conv branch,
+    #       which max pools after its first and last Conv3d
+    #   kernel_size -- The size of each Conv3d's kernel (odd, so the grid keeps its shape)
+    #   hidden_size -- The size of the hidden layer of the final classifier
+    def __init__(self, grid_spec=REFLECTIVITY_GRID_SPEC, fc_widths=(8, 2), conv_channels=(8, 16, 32),
+                 kernel_size=3, hidden_size=64):
         super(HybridModel1Out, self).__init__()
+        self.grid_spec = grid_spec.validate()
+        num_fields = grid_spec.num_fields
 
         # ReLU: f(x) = max(0,x) 
         
-        # Fully connected branch for the first 4 features
-        first_linear_layer_output = second_linear_layer_input = 8 # CHOSEN BY CHAT
-        second_linear_layer_output = 2 # CHOSEN BY CHAT
-        self.fc_branch = nn.Sequential(
-            nn.Linear(NUM_LINEAR_FEATURES, first_linear_layer_output), # Cast up to 8 (arbitrarily) and then back down
-            nn.ReLU(),
-            nn.Linear(second_linear_layer_input, second_linear_layer_output),
-            nn.ReLU()
-        )
+        # Fully connected branch for the first 4 features, e.g., cast up to 8
+        # (arbitrarily) and then back down to 2 (CHOSEN BY CHAT)
+        fc_layers = []
+        for in_features, out_features in zip((NUM_LINEAR_FEATURES, *fc_widths), fc_widths):
+            fc_layers += [nn.Linear(in_features, out_features), nn.ReLU()]
+        self.fc_branch = nn.Sequential(*fc_layers)
+        second_linear_layer_output = fc_widths[-1]
         
-        # 3D CNN branch for the last 2560 features reshaped to (16,16,10)
-        self.conv_branch = nn.Sequential(
-             # Kernel size of 3 means predicting on 3 x 3 x 3 for 27 weights per spot
-             # Padding = same mmeans size of the output feature map is the same as the input feature map
-            nn.Conv3d(in_channels=NUM_FIELDS, out_channels=8, kernel_size=3, padding='same'), 
-
-            nn.ReLU(),
-            nn.MaxPool3d(2),  # Reduce size to (8,8,5) using max from each 2x2x2 subsection
-            nn.Conv3d(8, 16, kernel_size=3, padding=1),
-            nn.ReLU(),
-
-            nn.Conv3d(16, 32, kernel_size = 3, padding = 1),
-            nn.ReLU(),
-
-
-            nn.MaxPool3d(2),  # Reduce size to (4,4,2)
-            nn.Flatten() # Convert final 3D feature maps into 1D vector
-)
+        # 3D CNN branch for the gridded features reshaped to (fields, 10, 16, 16)
+        # Kernel size of 3 means predicting on 3 x 3 x 3 for 27 weights per spot
+        # Padding = same mmeans size of the output feature map is the same as the input feature map
+        conv_layers = []
+        for i, (in_channels, out_channels) in enumerate(zip((num_fields, *conv_channels), conv_channels)):
+            conv_layers += [nn.Conv3d(in_channels, out_channels, kernel_size=kernel_size, padding='same'), nn.ReLU()]
+            if i == 0:
+                conv_layers.append(nn.MaxPool3d(2)) # Reduce size to (8,8,5) using max from each 2x2x2 subsection
+        conv_layers.append(nn.MaxPool3d(2)) # Reduce size to (4,4,2)
+        conv_layers.append(nn.Flatten()) # Convert final 3D feature maps into 1D vector
+        self.conv_branch = nn.Sequential(*conv_layers)
 
         conv_output_size = self._get_conv_output_shape()
 
@@ -65,28 +69,43 @@ class HybridModel1Out(nn.Module):
             # nn.Linear(16 * 4 * 4 * 2 + 64, 64),  # Concatenated size
 
 
-            nn.Linear(conv_output_size + second_linear_layer_output, 64),
+            nn.Linear(conv_output_size + second_linear_layer_output, hidden_size),
             nn.ReLU(),
             
-            nn.Linear(64, NUM_CLASSES_TO_LEARN),
+            nn.Linear(hidden_size, NUM_CLASSES_TO_LEARN),
             nn.Linear(NUM_CLASSES_TO_LEARN, 1) # Create 1 output from all 10 classes
         )
 
     
     def _get_conv_output_shape(self):
-        dummy_input = torch.zeros(1, NUM_FIELDS, N_ALT, N_LAT, N_LON)
+        dummy_input = torch.zeros(1, self.grid_spec.num_fields, *self.grid_spec.grid_shape)
         out = self.conv_branch(dummy_input)
         return out.view(1, -1).size(1)
 
-
-    def forward(self, x):
-        # Split input:
-        x_fc = x[:, :4]  # First 4 features
-        x_cnn = x[:, 4:].reshape(-1, NUM_FIELDS, N_ALT, N_LAT, N_LON)  # Reshape last 2560 elements to (B, C, 10, 16, 16), the -1 means to infer based on batch size
-
-        # Forward through both branches
+    def use_channels_last(self):
+        """
+        Stores the conv branch's weights, and reshapes its inputs, in the
+        channels_last_3d memory format, which Conv3d is usually faster in on CPU
+        """
+        self.memory_format = torch.channels_last_3d
+        return self.to(memory_format=torch.channels_last_3d)
+
+
+    def get_conv_features(self, x):
+        """
+        Runs the conv branch on the gridded features of x, returning its
+        flattened output (of size conv_output_size) for each input
+        """
+        x_cnn = x[:, 4:].reshape(-1, self.grid_spec.num_fields, *self.grid_spec.grid_shape).contiguous(memory_format=self.memory_format)  # Reshape last 2560 * C elements to (B, C, 10, 16, 16), the -1 means to infer based on batch size
+        return self.conv_branch(x_cnn)
+
+    def forward_heads(self, x_fc, out_cnn):
+        """
+        Runs the fully connected branch on the linear features x_fc, then the
+        final layers on its output and the conv branch's output out_cnn (which
+        can be cached, see model_training/embedding_cache.py)
+        """
         out_fc = self.fc_branch(x_fc)
-        out_cnn = self.conv_branch(x_cnn)
 
         # Concatenate outputs and pass through final layers
         out = torch.cat((out_fc, out_cnn), dim=1)
@@ -94,6 +113,11 @@ class HybridModel1Out(nn.Module):
         out = self.fc_final(out)
         return out.view(-1) # Flatten the output to 1D
 
+    def forward(self, x):
+        # Split input: the first 4 features go through the fully connected
+        # branch, and the rest through the conv branch
+        return self.forward_heads(x[:, :4], self.get_conv_features(x))
+
     def num_flat_features(self, x):
         size = x.size()[1:]  # all dimensions except the batch dimension
         num_features = 1
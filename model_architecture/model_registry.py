@@ -0,0 +1,89 @@
+# model_registry.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Maps each model type (e.g., hybrid) to the classes it trains, read
+#   from model_registry.json (or the file at $MODEL_REGISTRY_PATH). Each model
+#   type has an entry point ("module:Class") for classification losses (nll)
+#   and one for regression losses (mse, mae), and the hyperparameters its
+#   classes are built with. A class's module is only imported when that class
+#   is used, so scripts only import the models they use, and a new
+#   architecture is added by adding its entry to the registry (its module must
+#   be importable from the repo's root, like model_architecture.hybrid_model)
+#   without changing train_and_test_model.py
+
+import functools
+import importlib
+import json
+import os
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_REGISTRY_PATH = os.path.join(DIRNAME, "model_registry.json")
+# The losses a model is trained to output a single number for
+REGRESSION_LOSS_TYPES = ("mse", "mae")
+
+
+@functools.lru_cache(maxsize=None)
+def load_registry(registry_path=None):
+    """
+    Returns the registry (a dictionary of each model type to its entry points
+    and hyperparameters) at registry_path, default $MODEL_REGISTRY_PATH or
+    model_registry.json
+    """
+    registry_path = registry_path or os.environ.get("MODEL_REGISTRY_PATH", DEFAULT_REGISTRY_PATH)
+    with open(registry_path) as registry_file:
+        return json.load(registry_file)
+
+
+def get_model_types():
+    return list(load_registry())
+
+
+def get_entry_point(model_type, loss_type):
+    """
+    Returns the entry point ("module:Class") of the class model_type trains
+    with loss_type
+    """
+    registry = load_registry()
+    if model_type not in registry:
+        raise ValueError(f"Unknown model type {model_type}: expected one of {list(registry)}")
+    return registry[model_type]["regression" if loss_type in REGRESSION_LOSS_TYPES else "classification"]
+
+
+def import_entry_point(entry_point):
+    """
+    Imports and returns the class of entry_point ("module:Class")
+    """
+    module_name, class_name = entry_point.split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def get_hyperparameters(model_type):
+    """
+    Returns the architecture hyperparameters (keyword arguments) the classes
+    of model_type are built with
+    """
+    return dict(load_registry()[model_type].get("hyperparameters", {}))
+
+
+def get_model_builder(model_type, loss_type):
+    """
+    Returns a function that builds the model model_type trains with loss_type
+    (given its grid_spec), with the registry's hyperparameters
+    """
+    Model = import_entry_point(get_entry_point(model_type, loss_type))
+    return functools.partial(Model, **get_hyperparameters(model_type))
+
+
+def get_model_config(model_type, loss_type):
+    """
+    Returns the entry point and hyperparameters that a model trained as
+    model_type with loss_type is built from, to save next to it
+    """
+    return {
+        "model_type": model_type,
+        "loss_type": loss_type,
+        "entry_point": get_entry_point(model_type, loss_type),
+        "hyperparameters": get_hyperparameters(model_type),
+    }
+
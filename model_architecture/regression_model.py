@@ -2,28 +2,26 @@
 # Team Celestial Blue
 # Spring 2025
 
+import os
+import sys
 import torch
 from torch import nn
-from torch.utils.data import Dataset, DataLoader
-import torch.optim as optim
 
-N_ALT = 10
-N_LAT = 16
-N_LON = 16
+# Append to sys path to import grid_config
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 
-NUM_GRID_FEATURES = N_ALT * N_LAT * N_LAT # Number of grid features
-NUM_LINEAR_FEATURES = 4 # lat long alt delta_t 
-NUM_TOTAL_FEATURES = NUM_GRID_FEATURES + NUM_LINEAR_FEATURES
-NUM_FIELDS = 1
+from grid_config.grid_spec import REFLECTIVITY_GRID_SPEC
+from model_architecture.constants import NUM_LINEAR_FEATURES
 
 class LinearClassifierModel(nn.Module):
-    def __init__(self):
+    def __init__(self, grid_spec=REFLECTIVITY_GRID_SPEC):
         super(LinearClassifierModel, self).__init__()
+        self.grid_spec = grid_spec.validate()
         # Set a random seed for reproducibility
         torch.manual_seed(42)  # Ensures weight initialization is the same each run
         torch.cuda.manual_seed_all(42)  
         output_len = 10
-        self.linear = nn.Linear(NUM_TOTAL_FEATURES, output_len)
+        self.linear = nn.Linear(grid_spec.num_grid_features + NUM_LINEAR_FEATURES, output_len)
 
     def forward(self, x):
         # print(f"forward called with inputs {x}")
@@ -16,7 +16,7 @@ model = HybridModel()
 print("Note: There is actually one higher dimension on all this data for the " \
 "batch size, but it has been omitted from this script for simplicity.")
 
-conv_input = torch.randn(1, 1, 16, 16, 10)
+conv_input = torch.randn(1, model.grid_spec.num_fields, *model.grid_spec.grid_shape)
 
 def get_shape_as_str(input):
     return str(list(input[0].shape))
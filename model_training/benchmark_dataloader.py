@@ -0,0 +1,127 @@
+# benchmark_dataloader.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Measures how many samples/sec the training DataLoaders deliver with
+#   different settings: collating every input one at a time (the original
+#   loaders) vs. gathering whole batches from contiguous storage
+#   (RadarDataLoader.__getitems__) vs. gathering them from a TensorBatchDataset
+#   of float32 or float16 inputs with one index_select, each with different
+#   numbers of worker processes. The first epoch (which includes starting the workers) is
+#   reported separately from the rest
+# Usage: python benchmark_dataloader.py [-dataloader PATH] [-n NUM_SAMPLES] [-epochs NUM_EPOCHS]
+#       -dataloader: Benchmark a saved dataloader.pth rather than random inputs
+#       -n: The number of random inputs (default 20000)
+#       -epochs: The number of epochs to time each setting for (default 3)
+
+import os
+import sys
+import time
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+
+DIRNAME = os.path.dirname(sys.argv[0])
+
+# Append to sys path to import grid_config
+sys.path.append(os.path.join(DIRNAME, ".."))
+
+from dataloader_class import RadarDataLoader, collate_batch, get_dataset_grid_spec
+from loader_config import get_available_cores, get_default_num_workers, get_loader_kwargs
+from tensor_dataset import FEATURE_DTYPES, TensorBatchDataset, make_batch_loader
+from grid_config.grid_spec import REFLECTIVITY_GRID_SPEC
+from model_architecture.constants import NUM_LINEAR_FEATURES
+
+BATCH_SIZE = 2000
+NUM_WORKERS_LIST = [0, 1, 2, 4]
+COLLATE_MODES = ["per_sample", "batched"] + [f"tensor_{dtype}" for dtype in FEATURE_DTYPES]
+
+
+def usage():
+    print(f"Usage: python {sys.argv[0]} [-dataloader PATH] [-n NUM_SAMPLES] [-epochs NUM_EPOCHS]")
+    exit(1)
+
+
+def make_random_dataset(num_samples, grid_spec):
+    """
+    Returns a RadarDataLoader of num_samples random inputs with grid_spec
+    """
+    generator = torch.Generator().manual_seed(0)
+    features = torch.randn(num_samples, grid_spec.num_grid_features + NUM_LINEAR_FEATURES, generator=generator)
+    labels = torch.randint(0, 10, (num_samples,), generator=generator)
+    return RadarDataLoader.from_tensors(features, labels, grid_spec)
+
+
+def time_epochs(loader, num_epochs):
+    """
+    Iterates over every batch of loader num_epochs times
+    Returns:
+        A list of the time (in seconds) of each epoch
+    """
+    epoch_times = []
+    for _ in range(num_epochs):
+        start_time = time.perf_counter()
+        for x, y in loader:
+            pass
+        epoch_times.append(time.perf_counter() - start_time)
+    return epoch_times
+
+
+def main():
+    dataloader_path = None
+    num_samples = 20000
+    num_epochs = 3
+    i = 1
+    while i < len(sys.argv):
+        if i + 1 >= len(sys.argv):
+            usage()
+        try:
+            if sys.argv[i] == "-dataloader":
+                dataloader_path = sys.argv[i + 1]
+            elif sys.argv[i] == "-n":
+                num_samples = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-epochs":
+                num_epochs = int(sys.argv[i + 1])
+            else:
+                usage()
+        except ValueError:
+            usage()
+        i += 2
+
+    if dataloader_path is not None:
+        dataset = torch.load(dataloader_path, weights_only=False)
+        print(f"Loaded {len(dataset)} inputs with grid spec {get_dataset_grid_spec(dataset)}")
+    else:
+        dataset = make_random_dataset(num_samples, REFLECTIVITY_GRID_SPEC)
+        print(f"Created {len(dataset)} random inputs with grid spec {REFLECTIVITY_GRID_SPEC}")
+    per_sample_data = list(dataset.data)
+    dataset.get_tensors()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # More workers than cores would only measure the cores being oversubscribed
+    num_workers_list = [n for n in NUM_WORKERS_LIST if n <= get_available_cores()]
+    num_workers_list = sorted(set(num_workers_list + [get_default_num_workers()]))
+    print(f"Default number of loader workers: {get_default_num_workers()}")
+    print(f"{'collate':<16}{'workers':>8}{'first epoch (samples/s)':>26}{'later epochs (samples/s)':>27}")
+    for collate in COLLATE_MODES:
+        if collate.startswith("tensor_"):
+            tensor_dataset = TensorBatchDataset.from_dataset(dataset, FEATURE_DTYPES[collate[len("tensor_"):]])
+        for num_workers in num_workers_list:
+            loader_kwargs = get_loader_kwargs(device, num_workers)
+            if collate == "per_sample":
+                # A plain list has no __getitems__, so each input is collated separately
+                loader = DataLoader(per_sample_data, batch_size=BATCH_SIZE, shuffle=True,
+                                    collate_fn=default_collate, **loader_kwargs)
+            elif collate == "batched":
+                loader = DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=True,
+                                    collate_fn=collate_batch, **loader_kwargs)
+            else:
+                loader = make_batch_loader(tensor_dataset, BATCH_SIZE, shuffle=True, **loader_kwargs)
+            epoch_times = time_epochs(loader, num_epochs)
+            first = len(dataset) / epoch_times[0]
+            later = len(dataset) * (num_epochs - 1) / sum(epoch_times[1:]) if num_epochs > 1 else first
+            print(f"{collate:<16}{num_workers:>8}{first:>26.0f}{later:>27.0f}")
+            del loader
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# benchmark_ddp.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Measures the scaling efficiency of training the hybrid model with
+#   DistributedDataParallel (gloo backend, as in train_and_test_model.py under
+#   torchrun), by launching 1, 2, 4, ... processes on this machine. Each
+#   process gets the same number of threads, and every step trains on
+#   BATCH_SIZE random inputs in total, split between the processes. The
+#   scaling efficiency of N processes is their samples/sec divided by N times
+#   the samples/sec of 1 process (100% means the processes never wait on each
+#   other or on the gradient all-reduce)
+# Usage: python benchmark_ddp.py [-processes N1,N2,...] [-threads NUM_THREADS] [-steps NUM_STEPS] [-n NUM_SAMPLES]
+#       -processes: The numbers of processes to time (default 1,2,4)
+#       -threads: The number of threads of each process (default: the number
+#                 of cores divided by the most processes)
+#       -steps: The number of timed training steps (default 10, after 2 warm up steps)
+#       -n: The number of random inputs (default 4000)
+
+import os
+import socket
+import sys
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn, optim
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+# Append to sys path to import grid_config and model_architecture
+sys.path.append(os.path.join(DIRNAME, ".."))
+
+from grid_config.grid_spec import REFLECTIVITY_GRID_SPEC
+from model_architecture.constants import NUM_LINEAR_FEATURES
+from model_architecture.hybrid_model import HybridModel
+from loader_config import get_available_cores
+from distributed import BACKEND, DistributedBatchSampler, wrap_model
+from tensor_dataset import TensorBatchDataset
+
+BATCH_SIZE = 2000
+NUM_WARMUP_STEPS = 2
+
+
+def usage():
+    print(f"Usage: python {sys.argv[0]} [-processes N1,N2,...] [-threads NUM_THREADS] [-steps NUM_STEPS] [-n NUM_SAMPLES]")
+    exit(1)
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def train_rank(rank, world_size, port, num_threads, num_steps, num_samples, results):
+    """
+    Trains the hybrid model for NUM_WARMUP_STEPS + num_steps steps as one of
+    world_size processes, and (on rank 0) stores the time of the timed steps
+    in results
+    """
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group(BACKEND, rank=rank, world_size=world_size)
+    torch.set_num_threads(num_threads)
+
+    generator = torch.Generator().manual_seed(0)
+    features = torch.randn(num_samples, REFLECTIVITY_GRID_SPEC.num_grid_features + NUM_LINEAR_FEATURES, generator=generator)
+    labels = torch.randint(0, 10, (num_samples,), generator=generator)
+    dataset = TensorBatchDataset(features, labels)
+    sampler = DistributedBatchSampler(torch.arange(num_samples), BATCH_SIZE // world_size, seed=0)
+
+    model = wrap_model(HybridModel(grid_spec=REFLECTIVITY_GRID_SPEC))
+    optimizer = optim.Adam(model.parameters(), lr=0.01)
+    loss_fn = nn.NLLLoss()
+    log_softmax = nn.LogSoftmax(dim=-1)
+
+    step = 0
+    start_time = None
+    while step < NUM_WARMUP_STEPS + num_steps:
+        for indices in sampler:
+            if step == NUM_WARMUP_STEPS:
+                dist.barrier()
+                start_time = time.perf_counter()
+            x, y = dataset[indices]
+            optimizer.zero_grad()
+            loss = loss_fn(log_softmax(model(x)), y)
+            loss.backward() # DDP all-reduces the gradients here
+            optimizer.step()
+            step += 1
+            if step == NUM_WARMUP_STEPS + num_steps:
+                break
+    dist.barrier()
+    if rank == 0:
+        results[world_size] = time.perf_counter() - start_time
+    dist.destroy_process_group()
+
+
+def main():
+    world_sizes = [1, 2, 4]
+    num_threads = None
+    num_steps = 10
+    num_samples = 4000
+    i = 1
+    while i < len(sys.argv):
+        if i + 1 >= len(sys.argv):
+            usage()
+        try:
+            if sys.argv[i] == "-processes":
+                world_sizes = [int(n) for n in sys.argv[i + 1].split(",")]
+            elif sys.argv[i] == "-threads":
+                num_threads = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-steps":
+                num_steps = int(sys.argv[i + 1])
+            elif sys.argv[i] == "-n":
+                num_samples = int(sys.argv[i + 1])
+            else:
+                usage()
+        except ValueError:
+            usage()
+        i += 2
+    if num_threads is None:
+        num_threads = max(1, get_available_cores() // max(world_sizes))
+
+    print(f"Training the hybrid model on batches of {BATCH_SIZE} random inputs with {BACKEND}, "
+          f"{num_threads} threads per process, for {num_steps} steps ({get_available_cores()} cores available)")
+    results = mp.Manager().dict()
+    for world_size in world_sizes:
+        mp.spawn(train_rank, args=(world_size, get_free_port(), num_threads, num_steps, num_samples, results),
+                 nprocs=world_size)
+
+    base_world_size = min(results.keys())
+    base_throughput = num_steps * BATCH_SIZE / results[base_world_size] / base_world_size
+    print(f"\n{'processes':>9}{'time (s)':>10}{'samples/sec':>13}{'speedup':>9}{'efficiency':>12}")
+    for world_size in world_sizes:
+        throughput = num_steps * BATCH_SIZE / results[world_size]
+        print(f"{world_size:>9}{results[world_size]:>10.2f}{throughput:>13.1f}"
+              f"{throughput / (base_throughput * base_world_size):>8.2f}x{throughput / (base_throughput * world_size):>12.1%}")
+
+
+if __name__ == "__main__":
+    main()
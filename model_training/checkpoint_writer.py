@@ -0,0 +1,223 @@
+# checkpoint_writer.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Defines CheckpointWriter, which saves training checkpoints from a
+#   background thread so that training never waits on the disk. Each
+#   checkpoint is copied to the CPU when it is saved (so training can keep
+#   changing the model and optimizer), then written to a temporary file,
+#   fsynced, and renamed into place, so a job preempted in the middle of a
+#   write never leaves a corrupt checkpoint behind. The last few checkpoints
+#   are kept, and loading falls back to an older one if the newest cannot be
+#   read
+
+import atexit
+import copy
+import glob
+import os
+import re
+import threading
+import time
+import torch
+
+# The number of checkpoints kept by default
+NUM_CHECKPOINTS_KEPT = 3
+
+
+def snapshot_to_cpu(value):
+    """
+    Returns a copy of value (e.g., a checkpoint dictionary) with every tensor
+    in it copied to the CPU, so that later training steps (which update the
+    model and optimizer state in place) do not change it
+    """
+    if isinstance(value, torch.Tensor):
+        return value.detach().to("cpu", copy=True)
+    if isinstance(value, dict):
+        return {key: snapshot_to_cpu(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot_to_cpu(item) for item in value)
+    return copy.deepcopy(value)
+
+
+def fsync_dir(dirname):
+    # Makes a rename in dirname durable (not supported on every platform)
+    try:
+        dir_fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def atomic_write(path, write_fn):
+    """
+    Calls write_fn(temp_path) to write a temporary file next to path, fsyncs
+    it, and renames it to path, so path is always either the old or the new
+    file (and processes writing the same file at once, e.g., distributed
+    ranks, do not collide). The temporary file is removed if writing fails
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        write_fn(temp_path)
+        with open(temp_path, "rb") as temp_file:
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def atomic_save(obj, path):
+    """
+    Saves obj with torch.save to path with atomic_write
+    """
+    atomic_write(path, lambda temp_path: torch.save(obj, temp_path))
+
+
+class CheckpointWriter:
+
+    def __init__(self, path, num_kept=NUM_CHECKPOINTS_KEPT):
+        """
+        Parameters:
+            path -- The checkpoint path, e.g., model_checkpoint.pth. The
+                checkpoints are numbered, e.g., model_checkpoint_00003.pth
+            num_kept -- The number of the newest checkpoints to keep
+        """
+        self.path = path
+        self.num_kept = max(num_kept, 1)
+        self.stem, self.ext = os.path.splitext(path)
+        self.pattern = re.compile(re.escape(os.path.basename(self.stem)) + r"_(\d+)" + re.escape(self.ext) + "$")
+        existing = self.get_numbered_paths()
+        self.next_number = self.get_number(existing[0]) + 1 if existing else 0
+
+        # Only the newest checkpoint waiting to be written is kept: if the
+        # disk falls behind, older ones are skipped rather than queued
+        self.condition = threading.Condition()
+        self.pending = None
+        self.writing = False
+        self.error = None
+        self.thread = None
+        self.num_written = 0
+        self.num_skipped = 0
+        self.write_time = 0.0
+        atexit.register(self.close)
+
+    def get_number(self, path):
+        return int(self.pattern.search(os.path.basename(path)).group(1))
+
+    def get_numbered_paths(self):
+        paths = [path for path in glob.glob(glob.escape(self.stem) + "_*" + self.ext)
+                 if self.pattern.search(os.path.basename(path))]
+        return sorted(paths, key=self.get_number, reverse=True)
+
+    def get_checkpoint_paths(self):
+        """
+        Returns the paths of the saved checkpoints, newest first, followed by
+        path itself if it was saved by an older version of this script
+        """
+        paths = self.get_numbered_paths()
+        if os.path.exists(self.path):
+            paths.append(self.path)
+        return paths
+
+    def save(self, checkpoint):
+        """
+        Copies checkpoint (a dictionary of state dicts, tensors, and other
+        values) to the CPU and returns, leaving the background thread to write
+        it. Raises any error the thread had writing an earlier checkpoint
+        """
+        snapshot = snapshot_to_cpu(checkpoint)
+        with self.condition:
+            self.raise_error()
+            if self.pending is not None:
+                self.num_skipped += 1
+            self.pending = snapshot
+            if self.thread is None:
+                # Started on the first save, so processes forked before then
+                # (e.g., the parallel sweep's workers) do not inherit it
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                checkpoint, self.pending = self.pending, None
+                self.writing = True
+            error = None
+            try:
+                start_time = time.perf_counter()
+                self.write(checkpoint)
+                self.write_time += time.perf_counter() - start_time
+                self.num_written += 1
+            except Exception as write_error:
+                error = write_error
+            with self.condition:
+                self.error = error or self.error
+                self.writing = False
+                self.condition.notify_all()
+
+    def write(self, checkpoint):
+        path = f"{self.stem}_{self.next_number:05d}{self.ext}"
+        atomic_save(checkpoint, path)
+        self.next_number += 1
+        # Delete the checkpoints older than the last num_kept (and one saved
+        # by an older version of this script)
+        for old_path in self.get_checkpoint_paths()[self.num_kept:]:
+            os.remove(old_path)
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Could not write a checkpoint") from error
+
+    def flush(self):
+        """
+        Waits until every saved checkpoint has been written
+        """
+        with self.condition:
+            while self.pending is not None or self.writing:
+                self.condition.wait()
+            self.raise_error()
+
+    def close(self):
+        # Called at exit, so the last checkpoint saved is always written
+        if self.thread is not None and self.thread.is_alive():
+            try:
+                self.flush()
+            except RuntimeError as error:
+                print(f"{error}: {error.__cause__}")
+
+    def load(self, **load_kwargs):
+        """
+        Returns the newest checkpoint that can be read, or None if there is
+        none. Checkpoints that cannot be read are skipped
+        """
+        self.flush()
+        for path in self.get_checkpoint_paths():
+            try:
+                checkpoint = torch.load(path, **load_kwargs)
+            except Exception as error:
+                print(f"Skipping checkpoint {path} that could not be read: {error}")
+                continue
+            print(f"Loaded checkpoint {path}")
+            return checkpoint
+        return None
+
+    def remove_all(self):
+        """
+        Deletes every checkpoint, e.g., once training has finished
+        """
+        self.flush()
+        for path in self.get_checkpoint_paths():
+            os.remove(path)
+
+    def get_summary(self):
+        return f"Wrote {self.num_written} checkpoints in {self.write_time:.2f}s on a background thread " \
+               f"(skipped {self.num_skipped} that were replaced by a newer one before being written)"
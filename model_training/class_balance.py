@@ -0,0 +1,122 @@
+# class_balance.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Helpers for training on the skewed turbulence labels (mostly 0 and
+#   1, up to 9) without copying any inputs: WeightedBatchSampler draws each
+#   training batch like a WeightedRandomSampler, so every class is sampled
+#   equally often (-balance_classes), and get_stratified_splits splits the
+#   dataset so each split has the same class proportions (-stratify). Both
+#   only use the labels, as one int8 tensor, and never copy the inputs
+
+import math
+import torch
+
+from tensor_dataset import LABEL_DTYPE, TensorBatchDataset, TensorBatchSampler, resolve_subsets
+
+
+def get_labels(dataset, indices=None):
+    """
+    Returns the labels of the items indices (or all items) of dataset (a
+    TensorBatchDataset or RadarDataLoader, or a Subset of one) as an int8
+    tensor, without touching the inputs
+    """
+    dataset, indices = resolve_subsets(dataset, indices)
+    if isinstance(dataset, TensorBatchDataset):
+        labels = dataset.labels
+    else:
+        labels = dataset.get_tensors()[1]
+    return labels[indices].to(LABEL_DTYPE)
+
+
+class WeightedBatchSampler(TensorBatchSampler):
+
+    def __init__(self, indices, labels, batch_size, generator=None, rank=0, world_size=1):
+        """
+        Yields batches of indices drawn (with replacement) with a probability
+        inversely proportional to the number of inputs of their class, so every
+        class is drawn equally often, as many per epoch as there are indices.
+        When distributed, every rank draws the same batches (generator must be
+        seeded the same way on every rank) and yields every world_size'th index
+        of each, so the number drawn is rounded up to a multiple of world_size
+        Parameters:
+            indices -- The indices (into a dataset) to sample
+            labels -- An int8 tensor of the label of each of indices
+            batch_size -- The number of indices drawn for each batch
+            generator -- The torch.Generator to draw with (default: torch's
+                global generator)
+            rank -- The rank of this process
+            world_size -- The number of processes
+        """
+        super().__init__(indices, math.ceil(batch_size / world_size) * world_size, shuffle=True, generator=generator)
+        labels = labels.long()
+        # The indices grouped by class, and where each class starts
+        self.class_indices = self.indices[torch.argsort(labels, stable=True)]
+        self.class_counts = torch.bincount(labels)
+        self.class_starts = torch.cumsum(self.class_counts, 0) - self.class_counts
+        self.rank = rank
+        self.world_size = world_size
+        self.num_samples = math.ceil(len(self.indices) / world_size) * world_size
+
+    def __len__(self):
+        return math.ceil(self.num_samples / self.batch_size)
+
+    def __iter__(self):
+        # The same draw as a WeightedRandomSampler with a weight of
+        # 1 / class_count for each input, made by drawing a class and then an
+        # input of it, which (unlike torch.multinomial over every input) works
+        # for any number of inputs
+        num_samples = self.num_samples
+        present_classes = torch.nonzero(self.class_counts).view(-1)
+        classes = present_classes[torch.randint(len(present_classes), (num_samples,), generator=self.generator)]
+        offsets = (torch.rand(num_samples, generator=self.generator, dtype=torch.float64) * self.class_counts[classes]).long()
+        indices = self.class_indices[self.class_starts[classes] + offsets]
+        start_batch, self.start_batch = self.start_batch, 0
+        for batch in torch.split(indices, self.batch_size)[start_batch:]:
+            yield batch[self.rank::self.world_size]
+
+
+def get_stratified_fold_ids(labels, num_folds, generator):
+    """
+    Assigns each input to one of num_folds folds so that every fold has the
+    same number (give or take one) of each class: the inputs of each class are
+    shuffled and dealt out to the folds in turn, starting from a random fold
+    Returns:
+        A tensor of the fold of each input
+    """
+    labels = labels.long()
+    # The inputs grouped by class, in a random order within each class
+    order = torch.randperm(len(labels), generator=generator)
+    order = order[torch.argsort(labels[order], stable=True)]
+    class_counts = torch.bincount(labels)
+    class_starts = torch.cumsum(class_counts, 0) - class_counts
+    first_folds = torch.randint(num_folds, (len(class_counts),), generator=generator)
+    sorted_labels = labels[order]
+    position_in_class = torch.arange(len(labels)) - class_starts[sorted_labels]
+    fold_ids = torch.empty(len(labels), dtype=torch.long)
+    fold_ids[order] = (position_in_class + first_folds[sorted_labels]) % num_folds
+    return fold_ids
+
+
+def get_stratified_splits(labels, test_size, num_folds, seed):
+    """
+    Splits the inputs into a test set and cross validation folds with the same
+    class proportions as labels (like train_test_split and StratifiedKFold,
+    but only with torch ops on the labels tensor)
+    Parameters:
+        labels -- An int8 tensor of the label of every input
+        test_size -- The fraction of the inputs to hold out for testing (it is
+            rounded to 1 / an integer, e.g., 0.10)
+        num_folds -- The number of cross validation folds
+        seed -- The seed of the splits
+    Returns:
+        The indices of the training inputs, the indices of the test inputs, and
+        a list of (train_idx, val_idx) for each fold, where train_idx and
+        val_idx index into the training inputs (as numpy arrays, like KFold)
+    """
+    generator = torch.Generator().manual_seed(seed)
+    is_test = get_stratified_fold_ids(labels, round(1 / test_size), generator) == 0
+    train_idx, test_idx = torch.nonzero(~is_test).view(-1), torch.nonzero(is_test).view(-1)
+    fold_ids = get_stratified_fold_ids(labels[train_idx], num_folds, generator)
+    folds = [(torch.nonzero(fold_ids != fold).view(-1).numpy(), torch.nonzero(fold_ids == fold).view(-1).numpy())
+             for fold in range(num_folds)]
+    return train_idx.numpy(), test_idx.numpy(), folds
@@ -7,10 +7,14 @@
 #       existing_dataloader: Optionally can include dataloader to add to
 
 import torch 
-from dataloader_class import RadarDataLoader
 import sys
 import os
 
+# Append to sys path to import grid_config in dataloader_class
+sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), ".."))
+
+from dataloader_class import RadarDataLoader
+
 def usage():
     print("Usage: python create_datasets.py [dataloder_name] ([existing_dataloader])")
     print("dataloader_name: Desired name for dataloader to generate")
@@ -23,7 +27,7 @@ def main():
         print(f"Specified existing dataloder: {sys.argv[2]}, so loading before appending new data...")
         old_data = torch.load(sys.argv[2], weights_only=False)
         print("Loaded old data")
-    elif len(sys.arv == 2):
+    elif len(sys.argv) == 2:
         old_data = None
     else:
         usage()
@@ -8,10 +8,17 @@ import torch
 import glob
 import tarfile
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 import os
 import xarray as xr
 import numpy as np
 import shutil
+from grid_config.fields import get_fill_value
+from grid_config.grid_spec import GridSpec
+
+# The attributes of each NetCDF file used as linear features, and as the label
+LINEAR_FEATURE_ATTRS = ["LAT", "LON", "ALT", "DELTA_T"]
+LABEL_ATTR = "TURB"
 
 
 def decompress_tar_xz(filepath, extract_path):
@@ -34,6 +41,29 @@ def decompress_tar_xz(filepath, extract_path):
         print(f"An unexpected error occurred: {e}")
 
 
+def get_dataset_grid_spec(dataset):
+    """
+    Returns the GridSpec of the inputs in a RadarDataLoader. Dataloaders saved
+    before the grid spec was stored use the original 10x16x16 grid (of only
+    reflectivity, unless they stored their fields)
+    """
+    grid_spec = getattr(dataset, "grid_spec", None)
+    if grid_spec is None:
+        grid_spec = GridSpec.from_attrs({}, fields=getattr(dataset, "fields", None))
+    return grid_spec
+
+
+def collate_batch(batch):
+    """
+    collate_fn for DataLoaders over a RadarDataLoader. Batches from
+    RadarDataLoader.__getitems__ are already (features, labels) tensors, so
+    they are returned as is, and lists of items are collated as usual
+    """
+    if isinstance(batch, tuple):
+        return batch
+    return default_collate(batch)
+
+
 class RadarDataLoader(Dataset):
   
   def __init__(self, dir_path, old_data=None): 
@@ -48,9 +78,18 @@ class RadarDataLoader(Dataset):
     print("Calling init")
     self.data = [] 
 
+    # Contiguous copies of every input and label, built by get_tensors
+    self.features = None
+    self.labels = None
+
+    # The grid spec (shape and fields) of every input, which is determined by
+    # the first file loaded, or by old_data if given
+    self.grid_spec = None
+
     # If we are given old_data, start by loading this
     if (old_data is not None):
         self.data = [radar_data for radar_data in old_data]
+        self.grid_spec = get_dataset_grid_spec(old_data)
         print(type(self.data))
         print(f"Loaded {len(self.data)} old data points")
     count = 0
@@ -65,26 +104,35 @@ class RadarDataLoader(Dataset):
             filepath = os.path.join(specific_dirname, filename)
             if os.path.isfile(filepath):  # Ensure it's a file
                 nc_file = xr.open_dataset(filepath)
-                attrs_arr = np.array(list(nc_file.attrs.values()))
+
+                # All inputs must have the same grid spec to be stacked together
+                fields = list(nc_file.data_vars)
+                grid_spec = GridSpec.from_attrs(nc_file.attrs, fields=fields)
+                if self.grid_spec is None:
+                    self.grid_spec = grid_spec
+                    print(f"Using grid spec: {grid_spec}")
+                if grid_spec != self.grid_spec or fields != list(grid_spec.fields) or \
+                        any(nc_file[var].shape != grid_spec.grid_shape for var in fields):
+                    print(f"Skipping {filepath}: has grid spec {grid_spec} and fields {fields} but expected {self.grid_spec}")
+                    continue
 
                 # get attributes (lat,long,) from netcdf file and cast them to floats
-                # does not keep last element because that is TURB, which is being used as label
-                features = attrs_arr[:-1].astype(float)
+                # TURB is not included because it is being used as label
+                features = np.array([nc_file.attrs[attr] for attr in LINEAR_FEATURE_ATTRS]).astype(float)
 
-                #flatten grid-like data from NEXRAD, reflectivity for instance
-                flattened_data = np.concatenate([nc_file[var].values.flatten() for var in nc_file.data_vars])
+                # flatten grid-like data from NEXRAD, reflectivity for instance,
+                # filling empty cells with a value specific to each field
+                flattened_data = np.concatenate([np.nan_to_num(nc_file[var].values.flatten(), nan=get_fill_value(var))
+                                                 for var in fields])
 
                 #concatenate attributes array with flatted grid-like data
                 features = np.concatenate((features, flattened_data))
                 
                 # Single Category Encoding for pilot reported turbulence level
-                label = int(attrs_arr[-1])
+                label = int(nc_file.attrs[LABEL_ATTR])
 
                 features = torch.tensor(features, dtype=torch.float32) 
                 
-                # To account for all the cells with undetectable reflectivity, we set a reflectivity value out of range (-32 dBz)
-                features = torch.nan_to_num(features, nan=-32.0)
-                
                 self.data.append((features, label))
 
                 count += 1
@@ -111,4 +159,42 @@ class RadarDataLoader(Dataset):
 
     return self.data[idx]
 
+  def __getitems__(self, indices):
+    """
+    __getitems__ accepts a list of indices and retrieves a whole batch at once
+    from contiguous storage, rather than DataLoader collating the inputs one
+    at a time. DataLoaders using this must have collate_fn=collate_batch
+    Returns:
+        A tuple of the features (batch_size x num_features) and labels
+        (batch_size) of the batch
+    """
+    features, labels = self.get_tensors()
+    indices = torch.as_tensor(indices, dtype=torch.long)
+    return features[indices], labels[indices]
 
+  def get_tensors(self):
+    """
+    get_tensors() returns every input stacked into one float32 tensor (of
+    size len(self) x num_features), and every label in one int64 tensor. They
+    are built on the first call, after which self.data holds views into them
+    so that the inputs are not stored twice
+    """
+    # Dataloaders pickled before these were added do not have them
+    if getattr(self, "features", None) is None or len(self.features) != len(self.data):
+        self.features = torch.stack([features for features, _ in self.data])
+        self.labels = torch.tensor([label for _, label in self.data], dtype=torch.long)
+        self.data = [(self.features[i], label) for i, (_, label) in enumerate(self.data)]
+    return self.features, self.labels
+
+  @classmethod
+  def from_tensors(cls, features, labels, grid_spec):
+    """
+    from_tensors() creates a RadarDataLoader from already processed inputs
+    (e.g., synthetic ones for benchmarking) rather than NetCDF files
+    """
+    dataset = cls.__new__(cls)
+    dataset.grid_spec = grid_spec
+    dataset.data = [(features[i], int(labels[i])) for i in range(len(features))]
+    dataset.features = None
+    dataset.labels = None
+    return dataset
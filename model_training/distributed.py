@@ -0,0 +1,151 @@
+# distributed.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Helpers for training with DistributedDataParallel (DDP) across
+#   several processes, on one machine or across SLURM nodes, launched by
+#   torchrun. The processes (ranks) communicate with the gloo backend, which
+#   runs on CPU-only nodes. Each rank trains on its own shard of every batch,
+#   DDP averages the gradients, and the validation metrics are summed over the
+#   ranks, so every rank makes the same cross validation decisions
+
+import math
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+from loader_config import get_available_cores
+
+BACKEND = "gloo"
+
+
+def init_distributed():
+    """
+    Joins the process group if this process was launched by torchrun with
+    more than one process (which sets RANK and WORLD_SIZE), and splits this
+    node's cores between its ranks
+    Returns:
+        The rank of this process and the number of processes (0 and 1 when
+        not distributed)
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size <= 1:
+        return 0, 1
+    dist.init_process_group(BACKEND)
+    # torchrun sets OMP_NUM_THREADS=1, which would leave most cores idle
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    torch.set_num_threads(max(1, get_available_cores() // local_world_size))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    # Only rank 0 writes checkpoints, results, and the saved model
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def wrap_model(model):
+    """
+    Wraps a model (already on its device) in DistributedDataParallel, which
+    averages its gradients over the ranks during backward, if distributed
+    """
+    if not is_distributed():
+        return model
+    return DistributedDataParallel(model)
+
+
+def unwrap_model(model):
+    # The model inside a DistributedDataParallel, e.g., to save its state_dict
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def all_reduce_sum(tensor):
+    """
+    Returns the sum of tensor over every rank (tensor itself if not
+    distributed). Every rank must call this at the same point
+    """
+    if not is_distributed():
+        return tensor
+    tensor = tensor.clone()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def any_rank(flag):
+    """
+    Returns whether flag is True on any rank. Every rank must call this at the
+    same point
+    """
+    return bool(all_reduce_sum(torch.tensor(int(flag))) > 0)
+
+
+def broadcast_seed():
+    """
+    Returns a random seed from rank 0, so that every rank shuffles the same way
+    """
+    seed = torch.randint(2**62, (1,))
+    if is_distributed():
+        dist.broadcast(seed, src=0)
+    return int(seed)
+
+
+class DistributedBatchSampler:
+
+    def __init__(self, indices, batch_size, seed):
+        """
+        Yields this rank's shard of batches of indices, chosen by a
+        DistributedSampler: each epoch the indices are shuffled the same way
+        on every rank (from seed and the epoch), padded to a multiple of the
+        number of ranks, and split between the ranks, so every rank trains on
+        the same number of batches
+        Parameters:
+            indices -- The indices (into a dataset) to sample
+            batch_size -- The number of indices in each of this rank's batches
+            seed -- The shuffle seed, which must be the same on every rank
+        """
+        self.indices = torch.as_tensor(indices, dtype=torch.long)
+        self.batch_size = batch_size
+        self.seed = seed
+        self.sampler = DistributedSampler(range(len(self.indices)), shuffle=True, seed=seed)
+        self.epoch = 0
+        # The number of batches to skip in the next epoch (see TensorBatchSampler)
+        self.start_batch = 0
+
+    def __len__(self):
+        return math.ceil(len(self.sampler) / self.batch_size)
+
+    def __iter__(self):
+        self.sampler.set_epoch(self.epoch)
+        self.epoch += 1
+        indices = self.indices[torch.as_tensor(list(self.sampler), dtype=torch.long)]
+        start_batch, self.start_batch = self.start_batch, 0
+        yield from torch.split(indices, self.batch_size)[start_batch:]
+
+    def get_state(self):
+        # The next epoch's order only depends on the seed and its number
+        return self.seed, self.epoch
+
+    def set_state(self, state):
+        if state is None:
+            return
+        if isinstance(state, int):
+            # Checkpoints from before the seed was saved only have the epoch
+            self.epoch = state
+            return
+        # A resumed run draws a new seed, so shuffle with the saved one instead
+        self.seed, self.epoch = state
+        self.sampler = DistributedSampler(range(len(self.indices)), shuffle=True, seed=self.seed)
+
+
+def get_rank_shard(indices):
+    """
+    Returns this rank's share of indices (every world_size'th one), without
+    padding, e.g., to evaluate each input once
+    """
+    if not is_distributed():
+        return indices
+    return torch.as_tensor(indices, dtype=torch.long)[dist.get_rank()::dist.get_world_size()]
@@ -0,0 +1,73 @@
+# early_stopping.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Budgets the epochs and folds spent on the L2 search in
+#   train_and_test_model.py. EarlyStopping stops training one (l2_alpha, fold)
+#   once its validation loss stops improving, and successive_halving prunes
+#   the worse half of the L2 values still being searched after every few folds
+
+import math
+
+
+class EarlyStopping:
+
+    def __init__(self, patience, min_delta=0.0):
+        """
+        Parameters:
+            patience -- The number of epochs in a row without the validation
+                loss improving to stop after (0 never stops)
+            min_delta -- The amount the loss must decrease by to count as an
+                improvement
+        """
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_loss = math.inf
+        self.best_epoch = 0
+        self.num_epochs = 0
+        self.num_bad_epochs = 0
+        self.stopped = False
+
+    def step(self, val_loss):
+        """
+        Records the validation loss after an epoch
+        Returns:
+            True if training should stop
+        """
+        self.num_epochs += 1
+        if val_loss < self.best_loss - self.min_delta:
+            self.best_loss = val_loss
+            self.best_epoch = self.num_epochs
+            self.num_bad_epochs = 0
+        else:
+            self.num_bad_epochs += 1
+        self.stopped = self.patience > 0 and self.num_bad_epochs >= self.patience
+        return self.stopped
+
+    def state_dict(self):
+        return dict(vars(self))
+
+    def load_state_dict(self, state_dict):
+        vars(self).update(state_dict)
+
+
+def get_best_epoch(val_losses):
+    """
+    Returns the number of epochs (counting from 1) it took to reach the lowest
+    validation loss in val_losses
+    """
+    return min(range(len(val_losses)), key=lambda i: val_losses[i]) + 1
+
+
+def successive_halving(mean_losses, keep_fraction=0.5):
+    """
+    Keeps the best configurations still being searched
+    Parameters:
+        mean_losses -- A dictionary of the mean validation loss (over the folds
+            trained so far) of each configuration still being searched
+        keep_fraction -- The fraction of configurations to keep (rounded up)
+    Returns:
+        Lists of the kept and of the pruned configurations, each sorted by loss
+    """
+    ranked = sorted(mean_losses, key=lambda config: mean_losses[config])
+    num_kept = max(1, math.ceil(len(ranked) * keep_fraction))
+    return ranked[:num_kept], ranked[num_kept:]
@@ -0,0 +1,112 @@
+# embedding_cache.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Trains only the fully connected layers of a hybrid model on top of a
+#   frozen conv branch (e.g., one from an already trained model). Since the
+#   frozen conv branch's output for an input never changes, it is run once over
+#   the whole dataset and its outputs (embeddings) are saved in a .npy file
+#   that is memory-mapped, rather than run on every batch of every epoch of
+#   every cross validation configuration. The file is named by a hash of the
+#   conv branch's weights and the dataset's inputs, so later runs with the same
+#   frozen conv branch and dataset (e.g., with other seeds or loss functions)
+#   reuse it
+
+import hashlib
+import os
+import numpy as np
+import torch
+from torch import nn
+
+from model_architecture.constants import NUM_LINEAR_FEATURES
+from checkpoint_writer import atomic_write
+
+EMBEDDING_BATCH_SIZE = 256
+
+
+class HeadModel(nn.Module):
+
+    def __init__(self, model):
+        """
+        Wraps a hybrid model whose conv branch is frozen, so that it runs on
+        the cached embeddings instead of on the gridded features
+        Parameters:
+            model -- A HybridModel or HybridModel1Out. Its conv branch is
+                frozen, and is not run by forward
+        """
+        super().__init__()
+        self.model = model
+        self.model.conv_branch.requires_grad_(False)
+
+    def forward(self, x):
+        """
+        x is a batch of the rows of load_or_compute_embeddings, i.e., the
+        linear features followed by the conv branch's output for each input
+        """
+        return self.model.forward_heads(x[:, :NUM_LINEAR_FEATURES], x[:, NUM_LINEAR_FEATURES:])
+
+
+def load_conv_branch(model, model_path):
+    """
+    Loads only the conv branch of the hybrid model saved at model_path into
+    model (the rest of the state_dict, e.g., the fully connected layers of a
+    model trained with another loss function, is ignored)
+    Returns:
+        The model
+    """
+    state_dict = torch.load(model_path, map_location="cpu", weights_only=True)
+    prefix = "conv_branch."
+    model.conv_branch.load_state_dict({name[len(prefix):]: value for name, value in state_dict.items()
+                                       if name.startswith(prefix)})
+    return model
+
+
+def get_embedding_cache_path(model, features, cache_dir):
+    # Named by a hash of the conv branch's weights and of the inputs, so a
+    # changed conv branch or dataset never reads stale embeddings
+    sha = hashlib.sha1()
+    for name, value in model.conv_branch.state_dict().items():
+        sha.update(name.encode())
+        sha.update(value.detach().cpu().contiguous().numpy().tobytes())
+    sha.update(str(tuple(features.shape)).encode())
+    sha.update(features.contiguous().numpy().tobytes())
+    return os.path.join(cache_dir, f"conv_embeddings_{sha.hexdigest()[:16]}.npy")
+
+
+def load_or_compute_embeddings(model, features, cache_dir, batch_size=EMBEDDING_BATCH_SIZE):
+    """
+    Returns a memory-mapped (num_inputs x (NUM_LINEAR_FEATURES +
+    conv_output_size)) float32 tensor of each input's linear features followed
+    by the output of model's conv branch for it, computing and saving it to
+    cache_dir if it is not there yet
+    Parameters:
+        model -- A hybrid model with the frozen conv branch
+        features -- A (num_inputs x num_features) tensor of every input
+        cache_dir -- The directory of the saved embeddings
+        batch_size -- The number of inputs to run the conv branch on at once
+    """
+    cache_path = get_embedding_cache_path(model, features, cache_dir)
+    if os.path.exists(cache_path):
+        print(f"Loading the cached conv branch embeddings from {cache_path}")
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        num_columns = NUM_LINEAR_FEATURES + model._get_conv_output_shape()
+        print(f"Computing the conv branch embeddings of {len(features)} inputs, saving them to {cache_path}")
+
+        def write_embeddings(temp_path):
+            embeddings = np.lib.format.open_memmap(temp_path, mode="w+", dtype=np.float32,
+                                                   shape=(len(features), num_columns))
+            was_training = model.training
+            model.eval()
+            with torch.no_grad():
+                for start in range(0, len(features), batch_size):
+                    x = features[start:start + batch_size].float()
+                    embeddings[start:start + len(x), :NUM_LINEAR_FEATURES] = x[:, :NUM_LINEAR_FEATURES].numpy()
+                    embeddings[start:start + len(x), NUM_LINEAR_FEATURES:] = model.get_conv_features(x).numpy()
+            model.train(was_training)
+            embeddings.flush()
+            del embeddings
+
+        # An interrupted run never leaves a partial cache behind
+        atomic_write(cache_path, write_embeddings)
+    # Copy-on-write, so the tensor is writable without changing the file
+    return torch.from_numpy(np.load(cache_path, mmap_mode="c"))
@@ -0,0 +1,81 @@
+# evaluation.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Scores a model's predicted turbulence classes against the labels
+#   with a confusion matrix, which is accumulated with one torch.bincount per
+#   batch (rather than checking each input one at a time). The accuracy, false
+#   positive rate, false negative rate, and recall of each class are all
+#   derived from it, so the validation in cross validation and the final test
+#   report the same metrics
+
+import torch
+
+from model_architecture.constants import NUM_CLASSES_TO_LEARN
+
+
+def get_predicted_classes(outputs):
+    """
+    Returns the turbulence class each model output predicts: the most likely
+    class of a classifier, or the rounded output of a 1-output regressor
+    """
+    if outputs.dim() == 1:
+        return outputs.round().clamp(0, NUM_CLASSES_TO_LEARN - 1).long()
+    return outputs.argmax(dim=1)
+
+
+class ConfusionMatrix:
+
+    def __init__(self, num_classes=NUM_CLASSES_TO_LEARN):
+        """
+        counts[i][j] is the number of inputs with label i that the model
+        predicted as class j
+        """
+        self.num_classes = num_classes
+        self.counts = torch.zeros(num_classes, num_classes, dtype=torch.long)
+
+    def update(self, labels, predictions):
+        """
+        Adds a batch of labels and the classes predicted for them (tensors on
+        any device) to the counts
+        """
+        pairs = labels.long().view(-1) * self.num_classes + predictions.long().view(-1)
+        batch_counts = torch.bincount(pairs, minlength=self.num_classes ** 2)
+        self.counts += batch_counts.view(self.num_classes, self.num_classes).cpu()
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def get_metrics(self):
+        """
+        Returns a dictionary of tensors of:
+            accuracy -- The fraction of inputs predicted as their label
+            false positive rate -- The fraction of inputs with label 0 (no
+                turbulence) that were predicted as class 2 or more
+            false negative rate -- The fraction of inputs with turbulence
+                (label 1 or more) that were predicted as class 0
+            recall -- The fraction of the inputs of each class predicted as
+                that class (nan for classes without any inputs)
+            actual counts, predicted counts -- The number of inputs with each
+                label, and predicted as each class
+        The rates are fractions of all of the inputs, as in the original
+        testing of train_and_test_model.py
+        """
+        total = self.counts.sum().clamp(min=1)
+        actual_counts = self.counts.sum(dim=1)
+        return {
+            "accuracy": self.counts.diagonal().sum() / total,
+            "false positive rate": self.counts[0, 2:].sum() / total,
+            "false negative rate": self.counts[1:, 0].sum() / total,
+            "recall": self.counts.diagonal() / actual_counts,
+            "actual counts": actual_counts,
+            "predicted counts": self.counts.sum(dim=0),
+        }
+
+
+def format_metrics(metrics):
+    """
+    Returns the accuracy and false positive/negative rates of get_metrics as
+    one line, e.g., for printing after each epoch
+    """
+    return ", ".join(f"{name}: {metrics[name].item():.2%}"
+                     for name in ("accuracy", "false positive rate", "false negative rate"))
@@ -0,0 +1,256 @@
+# experiment_ledger.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Defines ExperimentLedger, an append-only SQLite database of every
+#   training run: its configuration (model, loss, seed, options, processes,
+#   SLURM job), the train and validation loss, timing, and throughput of
+#   every epoch, and its test results. Every run (from any seed or SLURM job)
+#   adds rows to the same file, so runs can be compared with one query, e.g.
+#       SELECT model_type, loss_type, seed, test_accuracy FROM runs JOIN results USING (run_id)
+#   Rows are only ever inserted, each in its own short transaction, so many
+#   runs can share the ledger
+# Usage: python experiment_ledger.py [-ledger LEDGER_PATH]
+#       Prints a summary of every run in the ledger
+#       -ledger: The ledger (default trained_model_outputs/experiment_ledger.sqlite)
+
+import contextlib
+import datetime
+import json
+import os
+import socket
+import sqlite3
+import sys
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_LEDGER_PATH = os.path.join(DIRNAME, "trained_model_outputs", "experiment_ledger.sqlite")
+# How long to wait for another run to finish writing before giving up
+LOCK_TIMEOUT_SECONDS = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started_at TEXT,
+    model_type TEXT,
+    loss_type TEXT,
+    seed INTEGER,
+    options TEXT,
+    world_size INTEGER,
+    device TEXT,
+    host TEXT,
+    slurm_job_id TEXT,
+    dataset_path TEXT,
+    num_inputs INTEGER
+);
+CREATE TABLE IF NOT EXISTS epochs (
+    run_id TEXT,
+    recorded_at TEXT,
+    phase TEXT,
+    l2_alpha REAL,
+    fold INTEGER,
+    epoch INTEGER,
+    train_loss REAL,
+    val_loss REAL,
+    val_accuracy REAL,
+    train_seconds REAL,
+    num_inputs INTEGER,
+    inputs_per_sec REAL
+);
+CREATE INDEX IF NOT EXISTS epochs_run_id ON epochs (run_id);
+CREATE TABLE IF NOT EXISTS results (
+    run_id TEXT,
+    finished_at TEXT,
+    best_l2_alpha REAL,
+    num_retrain_epochs INTEGER,
+    test_loss REAL,
+    test_accuracy REAL,
+    false_positive_rate REAL,
+    false_negative_rate REAL,
+    confusion_matrix TEXT,
+    model_path TEXT,
+    duration_seconds REAL
+);
+"""
+
+
+def usage():
+    print(f"Usage: python {sys.argv[0]} [-ledger LEDGER_PATH]")
+    exit(1)
+
+
+def get_timestamp():
+    return datetime.datetime.now().isoformat()
+
+
+def connect(ledger_path):
+    """
+    Opens the ledger at ledger_path, creating it (and its tables) if needed
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(ledger_path)), exist_ok=True)
+    connection = sqlite3.connect(ledger_path, timeout=LOCK_TIMEOUT_SECONDS)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def query(ledger_path, sql, parameters=()):
+    """
+    Returns the rows (as dictionaries) of a query of the ledger at ledger_path
+    """
+    with contextlib.closing(connect(ledger_path)) as connection:
+        return [dict(row) for row in connection.execute(sql, parameters)]
+
+
+def get_runs(ledger_path=DEFAULT_LEDGER_PATH):
+    """
+    Returns every run in the ledger, oldest first, with its results (which
+    are None if it has not finished) and number of epochs recorded
+    """
+    return query(ledger_path, """
+        SELECT runs.*, results.best_l2_alpha, results.test_loss, results.test_accuracy,
+               results.false_positive_rate, results.false_negative_rate, results.duration_seconds,
+               (SELECT COUNT(*) FROM epochs WHERE epochs.run_id = runs.run_id) AS num_epochs
+        FROM runs LEFT JOIN results USING (run_id)
+        ORDER BY runs.started_at
+    """)
+
+
+def get_epochs(run_id, ledger_path=DEFAULT_LEDGER_PATH):
+    """
+    Returns every epoch recorded for run_id, in the order they were trained
+    """
+    return query(ledger_path, "SELECT * FROM epochs WHERE run_id = ? ORDER BY rowid", (run_id,))
+
+
+def get_latest_run_id(ledger_path=DEFAULT_LEDGER_PATH):
+    runs = query(ledger_path, "SELECT run_id FROM runs ORDER BY started_at DESC LIMIT 1")
+    return runs[0]["run_id"] if runs else None
+
+
+class ExperimentLedger:
+
+    def __init__(self, ledger_path, run_id, enabled=True, start_time=None):
+        """
+        Parameters:
+            ledger_path -- The SQLite file to add the run's rows to
+            run_id -- The unique name of this run (e.g., the name of its
+                output files)
+            enabled -- Whether to write anything (e.g., only on rank 0)
+            start_time -- When the run started (default now), which is
+                earlier for a run resumed from a checkpoint
+        """
+        self.ledger_path = ledger_path
+        self.run_id = run_id
+        self.enabled = enabled
+        self.start_time = start_time or datetime.datetime.now()
+
+    def insert(self, table, row):
+        """
+        Adds row (a dictionary of column values) to table in its own
+        transaction. A ledger that cannot be written (e.g., locked for too
+        long) is reported rather than stopping training
+        """
+        if not self.enabled:
+            return
+        row = dict(row, run_id=self.run_id)
+        columns = ", ".join(row)
+        placeholders = ", ".join("?" for _ in row)
+        try:
+            with contextlib.closing(connect(self.ledger_path)) as connection, connection:
+                connection.execute(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", list(row.values()))
+        except sqlite3.Error as e:
+            print(f"Could not write to the experiment ledger {self.ledger_path}: {e}")
+
+    def start_run(self, model_type, loss_type, seed, options, world_size, device, dataset_path, num_inputs):
+        # Records the configuration of the run
+        self.insert("runs", {
+            "started_at": self.start_time.isoformat(),
+            "model_type": model_type,
+            "loss_type": loss_type,
+            "seed": seed,
+            "options": json.dumps(options, sort_keys=True),
+            "world_size": world_size,
+            "device": str(device),
+            "host": socket.gethostname(),
+            "slurm_job_id": os.environ.get("SLURM_JOB_ID"),
+            "dataset_path": os.path.abspath(dataset_path),
+            "num_inputs": num_inputs,
+        })
+
+    def record_epoch(self, phase, l2_alpha, fold, epoch, train_loss, train_seconds, num_inputs, val_loss=None, val_accuracy=None):
+        """
+        Records one epoch of training
+        Parameters:
+            phase -- "cross_validation", "search", or "retrain"
+            l2_alpha -- The L2 penalty trained with
+            fold -- The cross validation fold (the trial when searching, None
+                when retraining)
+            epoch -- The number of the epoch (from 1)
+            train_loss -- The average training loss per batch
+            train_seconds -- How long training (without validation) took
+            num_inputs -- The number of inputs trained on
+            val_loss -- The average validation loss per batch, if validated
+            val_accuracy -- The validation accuracy, if validated
+        """
+        self.insert("epochs", {
+            "recorded_at": get_timestamp(),
+            "phase": phase,
+            "l2_alpha": l2_alpha,
+            "fold": fold,
+            "epoch": epoch,
+            "train_loss": train_loss,
+            "val_loss": val_loss,
+            "val_accuracy": val_accuracy,
+            "train_seconds": train_seconds,
+            "num_inputs": num_inputs,
+            "inputs_per_sec": num_inputs / train_seconds if train_seconds > 0 else None,
+        })
+
+    def finish_run(self, best_l2_alpha, num_retrain_epochs, test_loss, metrics, confusion_matrix, model_path):
+        """
+        Records the test results of the run, where metrics are from
+        ConfusionMatrix.get_metrics
+        """
+        self.insert("results", {
+            "finished_at": get_timestamp(),
+            "best_l2_alpha": best_l2_alpha,
+            "num_retrain_epochs": num_retrain_epochs,
+            "test_loss": test_loss,
+            "test_accuracy": metrics["accuracy"].item(),
+            "false_positive_rate": metrics["false positive rate"].item(),
+            "false_negative_rate": metrics["false negative rate"].item(),
+            "confusion_matrix": json.dumps(confusion_matrix),
+            "model_path": model_path,
+            "duration_seconds": (datetime.datetime.now() - self.start_time).total_seconds(),
+        })
+
+
+def format_value(value, precision=4):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.{precision}g}"
+    return str(value)
+
+
+def main():
+    ledger_path = DEFAULT_LEDGER_PATH
+    if len(sys.argv) == 3 and sys.argv[1] == "-ledger":
+        ledger_path = sys.argv[2]
+    elif len(sys.argv) != 1:
+        usage()
+    if not os.path.exists(ledger_path):
+        print(f"No experiment ledger at {ledger_path}")
+        exit(1)
+
+    columns = ["run_id", "model_type", "loss_type", "seed", "world_size", "slurm_job_id", "num_epochs",
+               "best_l2_alpha", "test_loss", "test_accuracy", "false_positive_rate", "false_negative_rate", "duration_seconds"]
+    rows = [[format_value(run[column]) for column in columns] for run in get_runs(ledger_path)]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) if rows else len(column) for i, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+if __name__ == "__main__":
+    main()
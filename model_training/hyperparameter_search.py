@@ -0,0 +1,291 @@
+# hyperparameter_search.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Searches the learning rate, weight decay (L2 penalty), batch size,
+#   and conv branch widths of train_and_test_model.py (-search) with ASHA
+#   (asynchronous successive halving, the scheduler of Hyperband). Every
+#   trial (a randomly sampled configuration) is first trained for a few
+#   epochs, and only the best 1/REDUCTION_FACTOR of the trials at each rung
+#   are promoted to train for REDUCTION_FACTOR times as many epochs, so most
+#   of the epochs go to the best configurations. A promoted trial is warm
+#   started from the model, optimizer, and shuffle state it reached at its
+#   last rung, rather than retrained from scratch. The trials run in a pool
+#   of worker processes that share one copy of the dataset, and the scheduler
+#   hands each worker a new job as soon as it finishes one. The result of
+#   every job is appended to a CSV results table, so an interrupted search
+#   resumes from the trials it already trained
+
+import concurrent.futures
+import csv
+import json
+import os
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from loader_config import get_available_cores
+
+# The rungs are MIN_EPOCHS, MIN_EPOCHS * REDUCTION_FACTOR, ... up to MAX_EPOCHS
+MIN_EPOCHS = 1
+MAX_EPOCHS = 9
+REDUCTION_FACTOR = 3
+
+# The distribution each hyperparameter is sampled from: ("log_uniform", low,
+# high) or ("choice", [values])
+SEARCH_SPACE = {
+    "lr": ("log_uniform", 1e-4, 1e-1),
+    "weight_decay": ("log_uniform", 1e-5, 1e-1),
+    "batch_size": ("choice", [500, 1000, 2000, 4000]),
+    "conv_channels": ("choice", [[4, 8, 16], [8, 16, 32], [16, 32, 64]]),
+}
+# The hyperparameters passed to the model's constructor (the others configure
+# its training)
+ARCHITECTURE_HYPERPARAMETERS = ("conv_channels",)
+
+RESULTS_COLUMNS = ["trial_id", "rung", "epochs", "config", "loss", "val_losses", "train_time", "worker_pid"]
+
+# Set in each worker process by _init_worker
+_worker_state = {}
+
+
+def get_rungs(min_epochs=MIN_EPOCHS, max_epochs=MAX_EPOCHS, reduction_factor=REDUCTION_FACTOR):
+    """
+    Returns the number of epochs a trial has trained for at each rung
+    """
+    rungs = [min_epochs]
+    while rungs[-1] * reduction_factor <= max_epochs:
+        rungs.append(rungs[-1] * reduction_factor)
+    return rungs
+
+
+def sample_config(search_space, seed, trial_id):
+    """
+    Returns a configuration (a dictionary of a value of each hyperparameter in
+    search_space) sampled from a generator seeded by seed and trial_id, so a
+    trial always gets the same configuration
+    """
+    rng = np.random.default_rng([seed, trial_id])
+    config = {}
+    for name, (distribution, *args) in sorted(search_space.items()):
+        if distribution == "log_uniform":
+            low, high = args
+            config[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        elif distribution == "choice":
+            values, = args
+            config[name] = values[rng.integers(len(values))]
+        else:
+            raise ValueError(f"Unknown distribution {distribution} of hyperparameter {name}")
+    return config
+
+
+def get_architecture(config):
+    """
+    Returns the hyperparameters of config that the model is built with
+    """
+    return {name: config[name] for name in ARCHITECTURE_HYPERPARAMETERS if name in config}
+
+
+def get_trial_state_path(trials_dir, trial_id, epochs):
+    # Each rung of a trial gets its own file, so a trial whose next rung was
+    # interrupted can still be warm started from the last one
+    return os.path.join(trials_dir, f"trial_{trial_id}_epoch_{epochs}.pth")
+
+
+class AshaScheduler:
+
+    def __init__(self, rungs, reduction_factor=REDUCTION_FACTOR):
+        """
+        Parameters:
+            rungs -- The number of epochs trained at each rung (see get_rungs)
+            reduction_factor -- The fraction (1 / reduction_factor) of the
+                trials at each rung that are promoted to the next
+        """
+        self.rungs = rungs
+        self.reduction_factor = reduction_factor
+        # The loss of each trial that reached each rung
+        self.losses = [dict() for _ in rungs]
+        # The trials at each rung that have been promoted to the next
+        self.promoted = [set() for _ in rungs]
+        self.num_trials = 0
+
+    def record(self, trial_id, rung, loss):
+        self.losses[rung][trial_id] = loss
+        self.num_trials = max(self.num_trials, trial_id + 1)
+        if rung > 0:
+            self.promoted[rung - 1].add(trial_id)
+
+    def get_promotable(self, rung):
+        """
+        Returns the trials at rung in the best 1 / reduction_factor of the
+        trials there that have not been promoted yet, best first
+        """
+        losses = self.losses[rung]
+        ranked = sorted(losses, key=lambda trial_id: losses[trial_id])
+        return [trial_id for trial_id in ranked[:len(ranked) // self.reduction_factor]
+                if trial_id not in self.promoted[rung]]
+
+    def get_cost(self, rung):
+        # The number of epochs it takes to train a trial from the rung below to rung
+        return self.rungs[rung] - (self.rungs[rung - 1] if rung > 0 else 0)
+
+    def next_job(self, budget_left):
+        """
+        Returns the (trial_id, rung) to train next, promoting a trial from the
+        highest rung that has one to promote, or else starting a new trial, or
+        None if neither fits in budget_left epochs
+        """
+        for rung in reversed(range(len(self.rungs) - 1)):
+            for trial_id in self.get_promotable(rung):
+                if self.get_cost(rung + 1) <= budget_left:
+                    self.promoted[rung].add(trial_id)
+                    return trial_id, rung + 1
+        if self.get_cost(0) <= budget_left:
+            self.num_trials += 1
+            return self.num_trials - 1, 0
+        return None
+
+    def get_best(self):
+        """
+        Returns the trial with the lowest loss at the highest rung any trial
+        reached, and that rung
+        """
+        rung = max(rung for rung, losses in enumerate(self.losses) if losses)
+        losses = self.losses[rung]
+        return min(losses, key=lambda trial_id: losses[trial_id]), rung
+
+
+def read_search_results(results_path):
+    """
+    Returns the rows of a search results table as a list of dictionaries, or
+    an empty list if it does not exist yet
+    """
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path, newline="") as results_file:
+        results = list(csv.DictReader(results_file))
+    for result in results:
+        result["trial_id"] = int(result["trial_id"])
+        result["rung"] = int(result["rung"])
+        result["epochs"] = int(result["epochs"])
+        result["config"] = json.loads(result["config"])
+        result["loss"] = float(result["loss"])
+        result["val_losses"] = [float(loss) for loss in result["val_losses"].split()]
+        result["train_time"] = float(result["train_time"])
+        result["worker_pid"] = int(result["worker_pid"])
+    return results
+
+
+def append_search_result(results_path, result):
+    """
+    Appends one row to a search results table, writing the header if it is new
+    """
+    write_header = not os.path.exists(results_path)
+    with open(results_path, "a", newline="") as results_file:
+        writer = csv.DictWriter(results_file, fieldnames=RESULTS_COLUMNS)
+        if write_header:
+            writer.writeheader()
+        writer.writerow(dict(result, config=json.dumps(result["config"], sort_keys=True),
+                             val_losses=" ".join(str(loss) for loss in result["val_losses"])))
+
+
+def _init_worker(train_trial_fn, dataset, num_threads):
+    # Workers are forked, so the dataset tensors are not copied or pickled
+    torch.set_num_threads(num_threads)
+    _worker_state["train_trial_fn"] = train_trial_fn
+    _worker_state["dataset"] = dataset
+
+
+def _run_job(job):
+    start_time = time.time()
+    val_losses = _worker_state["train_trial_fn"](_worker_state["dataset"], **job["trial"])
+    return dict(trial_id=job["trial"]["trial_id"], rung=job["rung"], epochs=job["trial"]["end_epoch"],
+                config=job["trial"]["config"], loss=min(val_losses), val_losses=val_losses,
+                train_time=time.time() - start_time, worker_pid=os.getpid())
+
+
+def run_search(train_trial_fn, dataset, search_space, default_config, budget, seed, num_workers,
+               results_path, trials_dir, rungs=None):
+    """
+    Runs an ASHA search of search_space, training at most budget epochs in
+    total
+    Parameters:
+        train_trial_fn -- A function (dataset, trial_id, config, start_epoch,
+            end_epoch, load_path, save_path) that trains the model of config
+            from start_epoch (warm started from load_path, if start_epoch > 0)
+            to end_epoch, saves its state to save_path, and returns its
+            validation loss after every epoch from the first
+        dataset -- The dataset to train on (see share_dataset)
+        search_space -- The distribution of each hyperparameter (see SEARCH_SPACE)
+        default_config -- The configuration of trial 0 (e.g., the defaults
+            before searching), so the search always includes it
+        budget -- The number of epochs to train in total, over every trial
+        seed -- The seed the configurations are sampled with
+        num_workers -- The number of worker processes (0 to train in this process)
+        results_path -- The path of the CSV results table
+        trials_dir -- The directory to save the state of each trial to
+        rungs -- The epochs of each rung (default: get_rungs())
+    Returns:
+        The row of the results table of the best trial (at the highest rung
+        reached), and all the rows (including any from an earlier run)
+    """
+    rungs = rungs or get_rungs()
+    scheduler = AshaScheduler(rungs)
+    results = read_search_results(results_path)
+    for result in results:
+        scheduler.record(result["trial_id"], result["rung"], result["loss"])
+    budget_used = sum(scheduler.get_cost(result["rung"]) for result in results)
+    print(f"Found {len(results)} finished jobs ({budget_used} epochs) in {results_path}, "
+          f"searching with rungs {rungs} and a budget of {budget} epochs")
+    configs = {result["trial_id"]: result["config"] for result in results}
+    os.makedirs(trials_dir, exist_ok=True)
+
+    def next_job():
+        nonlocal budget_used
+        trial_and_rung = scheduler.next_job(budget - budget_used)
+        if trial_and_rung is None:
+            return None
+        trial_id, rung = trial_and_rung
+        budget_used += scheduler.get_cost(rung)
+        if trial_id not in configs:
+            configs[trial_id] = default_config if trial_id == 0 else sample_config(search_space, seed, trial_id)
+        start_epoch = rungs[rung - 1] if rung > 0 else 0
+        trial = dict(trial_id=trial_id, config=configs[trial_id], start_epoch=start_epoch, end_epoch=rungs[rung],
+                     load_path=get_trial_state_path(trials_dir, trial_id, start_epoch),
+                     save_path=get_trial_state_path(trials_dir, trial_id, rungs[rung]))
+        return dict(trial=trial, rung=rung)
+
+    def finish_job(result):
+        append_search_result(results_path, result)
+        results.append(result)
+        scheduler.record(result["trial_id"], result["rung"], result["loss"])
+        print(f"Finished trial {result['trial_id']} at rung {result['rung']} ({result['epochs']} epochs) with loss "
+              f"{result['loss']} in {result['train_time']:.1f}s, config {result['config']} ({budget_used}/{budget} epochs scheduled)")
+
+    if num_workers == 0:
+        _init_worker(train_trial_fn, dataset, torch.get_num_threads())
+        while (job := next_job()) is not None:
+            finish_job(_run_job(job))
+    else:
+        # Split the cores between the workers so they do not oversubscribe them
+        num_threads = max(1, get_available_cores() // num_workers)
+        print(f"Training trials on {num_workers} workers with {num_threads} threads each")
+        # fork (rather than spawn) so the workers share the dataset and do not
+        # re-run the training script's command line parsing
+        with concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=mp.get_context("fork"), initializer=_init_worker,
+                                                    initargs=(train_trial_fn, dataset, num_threads)) as executor:
+            running = set()
+            while True:
+                # Give every idle worker a job, as soon as it is free
+                while len(running) < num_workers and (job := next_job()) is not None:
+                    running.add(executor.submit(_run_job, job))
+                if not running:
+                    break
+                done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    finish_job(future.result())
+
+    if not results:
+        raise ValueError(f"A budget of {budget} epochs is too small to train any trial")
+    best_trial_id, best_rung = scheduler.get_best()
+    best_result = next(result for result in results if result["trial_id"] == best_trial_id and result["rung"] == best_rung)
+    return best_result, results
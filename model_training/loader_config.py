@@ -0,0 +1,55 @@
+# loader_config.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Chooses the DataLoader settings (worker processes, pinned memory,
+#   and prefetching) used for training, from the number of cores available to
+#   the job and the device being trained on
+
+import os
+
+# More workers than this do not speed up loading batches that are gathered
+# from contiguous tensors (see RadarDataLoader.__getitems__)
+MAX_LOADER_WORKERS = 4
+# The number of batches each worker loads ahead of the training loop
+PREFETCH_FACTOR = 2
+
+
+def get_available_cores():
+    """
+    Returns the number of cores this process may run on (which, under SLURM,
+    is the number allocated to the job rather than the number on the node)
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_default_num_workers():
+    """
+    Returns the number of loader workers to use: half of the cores not used
+    by the training loop itself, up to MAX_LOADER_WORKERS, leaving the rest
+    for the model's intra-op threads
+    """
+    return min(MAX_LOADER_WORKERS, (get_available_cores() - 1) // 2)
+
+
+def get_loader_kwargs(device, num_workers=None):
+    """
+    Returns the keyword arguments to create training DataLoaders with
+    Parameters:
+        device -- The torch.device the batches will be moved to
+        num_workers -- The number of worker processes, or None to choose it
+            from the number of available cores
+    Returns:
+        A dictionary of num_workers, pin_memory, and (if there are workers)
+        persistent_workers and prefetch_factor
+    """
+    if num_workers is None or num_workers < 0:
+        num_workers = get_default_num_workers()
+    # Pinned memory only speeds up copies to a GPU
+    loader_kwargs = dict(num_workers=num_workers, pin_memory=device.type == "cuda")
+    if num_workers > 0:
+        # Keep the workers between epochs rather than forking new ones
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=PREFETCH_FACTOR)
+    return loader_kwargs
@@ -0,0 +1,48 @@
+# mixed_precision.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Helpers for training in mixed precision: bfloat16 autocast on CPU
+#   (which needs no loss scaling, since bfloat16 has the range of float32) and
+#   float16 autocast with a GradScaler on CUDA, plus storing the hybrid
+#   models' conv branch in the channels_last_3d memory format
+
+import contextlib
+import torch
+
+# The dtype autocast runs eligible ops (e.g., Linear and Conv3d) in on each device
+AMP_DTYPES = {
+    "cpu": torch.bfloat16,
+    "cuda": torch.float16,
+}
+
+
+def get_autocast(device, enabled):
+    """
+    Returns a context manager that runs the ops inside it in the mixed
+    precision dtype of device, or does nothing if not enabled
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=AMP_DTYPES[device.type])
+
+
+def make_grad_scaler(device, enabled):
+    """
+    Returns a GradScaler, which scales the loss so that small float16
+    gradients do not underflow. It is only enabled for float16 (CUDA), and
+    otherwise passes the loss and optimizer step through unchanged
+    """
+    enabled = enabled and AMP_DTYPES.get(device.type) == torch.float16
+    return torch.amp.GradScaler(device.type, enabled=enabled)
+
+
+def prepare_model(model, channels_last):
+    """
+    Switches a model to the channels_last_3d memory format if asked to, and if
+    it has a conv branch (the linear model does not)
+    Returns:
+        The model
+    """
+    if channels_last and hasattr(model, "use_channels_last"):
+        model.use_channels_last()
+    return model
@@ -0,0 +1,143 @@
+# parallel_sweep.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Runs the (l2_alpha, fold) configurations of the cross validation in
+#   train_and_test_model.py in parallel across CPU worker processes. The
+#   dataset is stacked into tensors in shared memory once, so the workers read
+#   the same copy rather than each re-loading dataloader.pth. The results of
+#   every configuration are appended to a CSV results table as they finish, so
+#   an interrupted sweep skips the configurations already in the table
+
+import csv
+import os
+import time
+import torch
+import torch.multiprocessing as mp
+from dataloader_class import collate_batch
+from loader_config import get_available_cores
+from tensor_dataset import TensorBatchDataset, resolve_subsets
+
+RESULTS_COLUMNS = ["l2_alpha_idx", "l2_alpha", "fold", "final_val_loss", "val_losses", "train_time", "worker_pid"]
+
+# Set in each worker process by _init_worker
+_worker_state = {}
+
+
+def share_dataset(dataset):
+    """
+    Stacks the inputs and labels of a dataset of (features, label) pairs into
+    two tensors in shared memory
+    Returns:
+        A TensorBatchDataset with the same items (and indices) as dataset
+    """
+    base_dataset, base_indices = resolve_subsets(dataset)
+    if isinstance(base_dataset, TensorBatchDataset):
+        # Keep the dtype (e.g., float16) the inputs are stored as
+        return TensorBatchDataset(base_dataset.features[base_indices],
+                                  base_dataset.labels[base_indices]).share_memory_()
+    indices = list(range(len(dataset)))
+    if hasattr(dataset, "__getitems__"):
+        features, labels = collate_batch(dataset.__getitems__(indices))
+    else:
+        features, labels = collate_batch([dataset[i] for i in indices])
+    return TensorBatchDataset(features, labels).share_memory_()
+
+
+def read_results(results_path):
+    """
+    Returns the rows of a results table as a list of dictionaries, or an empty
+    list if it does not exist yet
+    """
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path, newline="") as results_file:
+        results = list(csv.DictReader(results_file))
+    for result in results:
+        result["l2_alpha_idx"] = int(result["l2_alpha_idx"])
+        result["l2_alpha"] = float(result["l2_alpha"])
+        result["fold"] = int(result["fold"])
+        result["final_val_loss"] = float(result["final_val_loss"])
+        result["val_losses"] = [float(loss) for loss in result["val_losses"].split()]
+        result["train_time"] = float(result["train_time"])
+        result["worker_pid"] = int(result["worker_pid"])
+    return results
+
+
+def append_result(results_path, result):
+    """
+    Appends one row to a results table, writing the header if it is new
+    """
+    write_header = not os.path.exists(results_path)
+    with open(results_path, "a", newline="") as results_file:
+        writer = csv.DictWriter(results_file, fieldnames=RESULTS_COLUMNS)
+        if write_header:
+            writer.writeheader()
+        writer.writerow(dict(result, val_losses=" ".join(str(loss) for loss in result["val_losses"])))
+
+
+def _init_worker(train_config_fn, dataset, num_threads):
+    # Workers are forked, so the dataset tensors are not copied or pickled
+    torch.set_num_threads(num_threads)
+    _worker_state["train_config_fn"] = train_config_fn
+    _worker_state["dataset"] = dataset
+
+
+def _run_config(task):
+    config, train_idx, val_idx = task
+    start_time = time.time()
+    val_losses = _worker_state["train_config_fn"](_worker_state["dataset"], config["l2_alpha_idx"], config["l2_alpha"],
+                                                  train_idx, val_idx, config["fold"])
+    return dict(config, final_val_loss=val_losses[-1], val_losses=val_losses,
+                train_time=time.time() - start_time, worker_pid=os.getpid())
+
+
+def run_sweep(train_config_fn, l2_alpha_list, folds, dataset, num_workers, results_path,
+              l2_alpha_idxs=None, fold_idxs=None):
+    """
+    Trains (l2_alpha, fold) configurations in a pool of worker processes
+    Parameters:
+        train_config_fn -- A function (dataset, l2_alpha_idx, l2_alpha, train_idx,
+            val_idx, fold) that trains a new model and returns its validation
+            loss after each epoch
+        l2_alpha_list -- The L2 penalties to test
+        folds -- A list of (train_idx, val_idx) for each fold
+        dataset -- The dataset to train on (see share_dataset)
+        num_workers -- The number of worker processes
+        results_path -- The path of the CSV results table
+        l2_alpha_idxs -- The indices of the L2 penalties to train (default: all)
+        fold_idxs -- The indices of the folds to train (default: all)
+    Returns:
+        The rows of the results table (including any from an earlier run)
+    """
+    results = read_results(results_path)
+    done = {(result["l2_alpha_idx"], result["fold"]) for result in results}
+    if l2_alpha_idxs is None:
+        l2_alpha_idxs = range(len(l2_alpha_list))
+    if fold_idxs is None:
+        fold_idxs = range(len(folds))
+    tasks = []
+    for l2_alpha_idx in l2_alpha_idxs:
+        for fold in fold_idxs:
+            if (l2_alpha_idx, fold) not in done:
+                config = dict(l2_alpha_idx=l2_alpha_idx, l2_alpha=l2_alpha_list[l2_alpha_idx], fold=fold)
+                tasks.append((config, *folds[fold]))
+    print(f"Found {len(done)} finished configurations in {results_path}, {len(tasks)} left to train")
+    if len(tasks) == 0:
+        return results
+
+    # Split the cores between the workers so they do not oversubscribe them
+    num_workers = min(num_workers, len(tasks))
+    num_threads = max(1, get_available_cores() // num_workers)
+    print(f"Training {len(tasks)} configurations on {num_workers} workers with {num_threads} threads each")
+
+    # fork (rather than spawn) so the workers share the dataset and do not
+    # re-run the training script's command line parsing
+    context = mp.get_context("fork")
+    with context.Pool(num_workers, initializer=_init_worker,
+                      initargs=(train_config_fn, dataset, num_threads)) as pool:
+        for result in pool.imap_unordered(_run_config, tasks):
+            append_result(results_path, result)
+            results.append(result)
+            print(f"Finished l2_alpha = {result['l2_alpha']}, fold {result['fold']} with loss "
+                  f"{result['final_val_loss']} in {result['train_time']:.1f}s ({len(results)} done)")
+    return results
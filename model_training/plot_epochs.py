@@ -3,30 +3,101 @@
 # Spring 2025
 # Last Modified: 05/06/2025
 # This file exports a function that can be used to produce epoch plots
-# to determine if the model is overfitting
+# to determine if the model is overfitting. The losses are read from the
+# experiment ledger that train_and_test_model.py records every run in
+# Usage: python plot_epochs.py [RUN_ID] [-ledger LEDGER_PATH] [-output_dir OUTPUT_DIR]
+#       RUN_ID: The run to plot, e.g., 2025-04-15T21:42:07.330386_best_hybrid_nll_model_w_seed_42
+#               (default: the latest run in the ledger)
+#       -ledger: The ledger (default trained_model_outputs/experiment_ledger.sqlite)
+#       -output_dir: Where to save the plots (default epoch_plots)
 
 import os
-import matplotlib as plt
+import sys
+import matplotlib.pyplot as plt
 
-def plot_epochs(output_dir, formatted_curr_date, NUM_EPOCHS, l2_alpha_list,
-                 training_losses_by_l2, validation_losses_by_l2):
-    
-    
+from experiment_ledger import DEFAULT_LEDGER_PATH, get_latest_run_id, query
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+
+def usage():
+    print(f"Usage: python {sys.argv[0]} [RUN_ID] [-ledger LEDGER_PATH] [-output_dir OUTPUT_DIR]")
+    exit(1)
+
+
+def get_losses_by_l2(run_id, ledger_path=DEFAULT_LEDGER_PATH):
+    """
+    Returns a dictionary of each L2 value of run_id's cross validation to its
+    epochs, and the training and validation loss after each epoch (averaged
+    over the folds that trained that epoch, since folds can stop early)
+    """
+    rows = query(ledger_path, """
+        SELECT l2_alpha, epoch, AVG(train_loss) AS train_loss, AVG(val_loss) AS val_loss
+        FROM epochs WHERE run_id = ? AND phase = 'cross_validation'
+        GROUP BY l2_alpha, epoch ORDER BY l2_alpha DESC, epoch
+    """, (run_id,))
+    losses_by_l2 = {}
+    for row in rows:
+        losses = losses_by_l2.setdefault(row["l2_alpha"], {"epochs": [], "train": [], "val": []})
+        losses["epochs"].append(row["epoch"])
+        losses["train"].append(row["train_loss"])
+        losses["val"].append(row["val_loss"])
+    return losses_by_l2
+
+
+def plot_epochs(run_id, output_dir, ledger_path=DEFAULT_LEDGER_PATH):
+    """
+    Saves a plot of the training and validation loss vs epoch of each L2 value
+    of run_id, as <output_dir>/<run_id>_l2_<L2>_loss_plot.png
+    """
+    losses_by_l2 = get_losses_by_l2(run_id, ledger_path)
+    if not losses_by_l2:
+        print(f"No cross validation epochs of run {run_id} in {ledger_path}")
+        return
     os.makedirs(output_dir, exist_ok=True)
 
-    for l2 in l2_alpha_list:
+    for l2, losses in losses_by_l2.items():
         plt.figure(figsize=(10, 5))
-        plt.plot(range(1, NUM_EPOCHS + 1), training_losses_by_l2[l2], label="Training Loss")
-        plt.plot(range(1, NUM_EPOCHS + 1), validation_losses_by_l2[l2], label="Validation Loss")
+        plt.plot(losses["epochs"], losses["train"], label="Training Loss")
+        plt.plot(losses["epochs"], losses["val"], label="Validation Loss")
         plt.xlabel("Epoch")
-        plt.ylabel("Loss")
+        plt.ylabel("Loss (mean over folds)")
         plt.title(f"Loss vs Epoch (L2 = {l2})")
         plt.legend()
         plt.grid(True)
 
         # Save the figure
         l2_clean = str(l2).replace(".", "_")
-        fig_path = os.path.join(output_dir, f"{formatted_curr_date}_l2_{l2_clean}_loss_plot.png")
+        fig_path = os.path.join(output_dir, f"{run_id}_l2_{l2_clean}_loss_plot.png")
         plt.savefig(fig_path)
         print(f"Saved plot for L2={l2} to: {fig_path}")
-        plt.close()
\ No newline at end of file
+        plt.close()
+
+
+def main():
+    run_id = None
+    ledger_path = DEFAULT_LEDGER_PATH
+    output_dir = os.path.join(DIRNAME, "epoch_plots")
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-ledger" and i + 1 < len(sys.argv):
+            ledger_path = sys.argv[i + 1]
+            i += 2
+        elif sys.argv[i] == "-output_dir" and i + 1 < len(sys.argv):
+            output_dir = sys.argv[i + 1]
+            i += 2
+        elif run_id is None and not sys.argv[i].startswith("-"):
+            run_id = sys.argv[i]
+            i += 1
+        else:
+            usage()
+    if not os.path.exists(ledger_path):
+        print(f"No experiment ledger at {ledger_path}")
+        exit(1)
+    if run_id is None:
+        run_id = get_latest_run_id(ledger_path)
+    plot_epochs(run_id, output_dir, ledger_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# preemption.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Helpers for stopping training in the middle of an epoch when SLURM
+#   preempts the job (or its time limit nears), and resuming from the same
+#   batch: saving and restoring the random number generator states, and
+#   keeping DataLoader workers alive when the whole job is sent SIGTERM, so
+#   the training loop can finish its current batch and save a checkpoint
+
+import random
+import signal
+import numpy as np
+import torch
+
+# The exit code of train_and_test_model.py after saving a checkpoint on
+# SIGTERM (EX_TEMPFAIL), so the job script can tell it did not finish
+CHECKPOINTED_EXIT_CODE = 75
+
+
+class TrainingInterrupted(Exception):
+
+    def __init__(self, num_batches):
+        """
+        Raised when training stops in the middle of an epoch on SIGTERM
+        Parameters:
+            num_batches -- The number of batches of the epoch that were trained
+        """
+        super().__init__(f"Training was interrupted after {num_batches} batches of the epoch")
+        self.num_batches = num_batches
+
+
+def get_rng_states():
+    """
+    Returns the states of the python, numpy, and torch (CPU and CUDA) random
+    number generators, to save in a checkpoint
+    """
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_states(rng_states):
+    """
+    Restores the random number generator states from get_rng_states
+    """
+    random.setstate(rng_states["python"])
+    np.random.set_state(rng_states["numpy"])
+    torch.set_rng_state(rng_states["torch"])
+    if rng_states["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_states["cuda"])
+
+
+def make_shuffle_generator():
+    """
+    Returns a torch.Generator for shuffling a loader's batches, seeded from
+    torch's global generator. Its state at the start of an epoch (saved in a
+    checkpoint) determines the order of that epoch's batches
+    """
+    return torch.Generator().manual_seed(int(torch.randint(2**62, ())))
+
+
+def ignore_sigterm(worker_id):
+    """
+    worker_init_fn for DataLoaders. SLURM sends SIGTERM to every process of a
+    preempted job, and the loader workers need to keep loading batches until
+    the training loop has finished its current batch
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
@@ -0,0 +1,107 @@
+# split_cache.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Computes the test split and cross validation folds of a dataset
+#   once per (dataset version, seed) and saves them to a small .npy file,
+#   which every later run, distributed rank, sweep worker, and resumed job
+#   with the same seed loads instead of recomputing them. The file holds one
+#   int8 per input: TEST_SPLIT for the test set, or the fold the input is
+#   validated on. The dataset version is a hash of its labels and the split's
+#   settings, so a changed dataset (or e.g. -stratify) never reads stale splits
+
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+from sklearn.model_selection import KFold
+from checkpoint_writer import atomic_write
+
+# The value of the test inputs in a split file
+TEST_SPLIT = -1
+# The KFold seed, which is the same for every run (as before the splits were
+# cached)
+KFOLD_SEED = 42
+
+
+def get_random_splits(labels, test_size, num_folds, seed):
+    """
+    Splits the inputs into a random test set (with random_split) and random
+    cross validation folds (with KFold), ignoring their labels
+    Returns:
+        The same as get_stratified_splits (see class_balance.py)
+    """
+    train_subset, test_subset = torch.utils.data.random_split(range(len(labels)), [1 - test_size, test_size],
+                                                              generator=torch.Generator().manual_seed(seed))
+    train_idx, test_idx = np.array(train_subset.indices), np.array(test_subset.indices)
+    # KFold only uses the number of inputs, so it is given no features
+    kfold = KFold(n_splits=num_folds, shuffle=True, random_state=KFOLD_SEED)
+    folds = list(kfold.split(np.zeros(len(train_idx))))
+    return train_idx, test_idx, folds
+
+
+def get_split_cache_path(cache_dir, labels, seed, split_fn, **split_settings):
+    # Named by a hash of the labels (which determine the number of inputs, and
+    # the stratification) and the split's settings, and by the seed
+    sha = hashlib.sha1()
+    sha.update(str(len(labels)).encode())
+    sha.update(labels.contiguous().numpy().tobytes())
+    sha.update(json.dumps(dict(split_settings, split_fn=split_fn.__name__), sort_keys=True).encode())
+    return os.path.join(cache_dir, f"splits_{sha.hexdigest()[:16]}_seed_{seed}.npy")
+
+
+def splits_to_assignments(num_inputs, train_idx, folds):
+    """
+    Returns an int8 array of the split of each input: TEST_SPLIT, or the fold
+    it is validated on
+    """
+    assignments = np.full(num_inputs, TEST_SPLIT, dtype=np.int8)
+    for fold, (_, val_idx) in enumerate(folds):
+        assignments[train_idx[val_idx]] = fold
+    return assignments
+
+
+def assignments_to_splits(assignments):
+    """
+    Returns the indices of the training inputs, the indices of the test inputs,
+    and a list of (train_idx, val_idx) for each fold (indexing into the
+    training inputs) from the split of each input
+    """
+    train_idx = np.flatnonzero(assignments != TEST_SPLIT)
+    test_idx = np.flatnonzero(assignments == TEST_SPLIT)
+    train_assignments = assignments[train_idx]
+    folds = [(np.flatnonzero(train_assignments != fold), np.flatnonzero(train_assignments == fold))
+             for fold in range(int(train_assignments.max()) + 1)]
+    return train_idx, test_idx, folds
+
+
+def save_assignments(path, assignments):
+    # To an open file, since np.save adds .npy to a path without it
+    with open(path, "wb") as assignments_file:
+        np.save(assignments_file, assignments)
+
+
+def load_or_compute_splits(cache_dir, labels, seed, split_fn, **split_settings):
+    """
+    Returns split_fn(labels, seed=seed, **split_settings), loading it from
+    cache_dir if it was saved there before, and otherwise computing and saving
+    it. The training inputs and folds come back in increasing order (the
+    sets of inputs are the same as split_fn's)
+    Parameters:
+        cache_dir -- The directory of the saved splits
+        labels -- An int8 tensor of the label of every input
+        seed -- The seed of the split
+        split_fn -- get_random_splits or get_stratified_splits
+        split_settings -- The other arguments of split_fn (test_size, num_folds)
+    """
+    cache_path = get_split_cache_path(cache_dir, labels, seed, split_fn, **split_settings)
+    if os.path.exists(cache_path):
+        print(f"Loading the cached dataset splits from {cache_path}")
+        assignments = np.load(cache_path)
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        print(f"Splitting the dataset with {split_fn.__name__}, saving the splits to {cache_path}")
+        train_idx, _, folds = split_fn(labels, seed=seed, **split_settings)
+        assignments = splits_to_assignments(len(labels), train_idx, folds)
+        atomic_write(cache_path, lambda temp_path: save_assignments(temp_path, assignments))
+    return assignments_to_splits(assignments)
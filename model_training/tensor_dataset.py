@@ -0,0 +1,143 @@
+# tensor_dataset.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Defines TensorBatchDataset, which holds every model input in one
+#   (num_inputs x num_features) tensor and every label in one tensor, and
+#   TensorBatchSampler, which yields batches of indices into it. Each batch is
+#   then gathered with a single index_select, rather than DataLoader fetching
+#   and collating 2000 inputs one at a time
+
+import math
+import torch
+from torch.utils.data import DataLoader, Dataset, Subset
+
+# The dtypes the inputs can be stored as. float16 halves the memory of the
+# dataset, but only keeps ~3 significant digits (e.g., longitudes are rounded
+# to 1/16 of a degree), and batches are converted back to float32
+FEATURE_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+}
+# Turbulence labels are 0-9, so they fit in a byte
+LABEL_DTYPE = torch.int8
+
+
+class TensorBatchDataset(Dataset):
+
+    def __init__(self, features, labels, dtype=None):
+        """
+        Parameters:
+            features -- A tensor (num_inputs x num_features) of every input
+            labels -- A tensor (num_inputs) of every label
+            dtype -- The dtype to store the inputs as (default: their dtype)
+        """
+        self.features = features if dtype is None else features.to(dtype)
+        self.labels = labels.to(LABEL_DTYPE)
+
+    @classmethod
+    def from_dataset(cls, dataset, dtype=torch.float32):
+        """
+        Creates a TensorBatchDataset with the same inputs as a RadarDataLoader
+        """
+        features, labels = dataset.get_tensors()
+        return cls(features, labels, dtype)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        """
+        Returns the (features, label) of one input if idx is an int, or the
+        (features, labels) of a whole batch if idx is a tensor of indices
+        """
+        if isinstance(idx, torch.Tensor):
+            return self.features.index_select(0, idx).float(), self.labels.index_select(0, idx).long()
+        return self.features[idx].float(), int(self.labels[idx])
+
+    def __getitems__(self, indices):
+        # Used by Subset and by DataLoaders given a batch_size
+        return self[torch.as_tensor(indices, dtype=torch.long)]
+
+    def share_memory_(self):
+        self.features.share_memory_()
+        self.labels.share_memory_()
+        return self
+
+
+class TensorBatchSampler:
+
+    def __init__(self, indices, batch_size, shuffle=True, generator=None):
+        """
+        Parameters:
+            indices -- The indices (into a TensorBatchDataset) to sample
+            batch_size -- The number of indices in each batch (the last batch
+                may be smaller)
+            shuffle -- Whether to shuffle the indices every epoch
+            generator -- The torch.Generator to shuffle with (default: torch's
+                global generator)
+        """
+        self.indices = torch.as_tensor(indices, dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = generator
+        # The number of batches to skip in the next epoch, to resume an epoch
+        # that was interrupted (with generator in its state from the start of
+        # that epoch)
+        self.start_batch = 0
+
+    def __len__(self):
+        return math.ceil(len(self.indices) / self.batch_size)
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices), generator=self.generator)]
+        start_batch, self.start_batch = self.start_batch, 0
+        yield from torch.split(indices, self.batch_size)[start_batch:]
+
+    def get_state(self):
+        """
+        Returns the state of the shuffle generator, which determines the order
+        of the next epoch (to save in a checkpoint)
+        """
+        return None if self.generator is None else self.generator.get_state()
+
+    def set_state(self, state):
+        if state is not None:
+            self.generator.set_state(state)
+
+
+def resolve_subsets(dataset, indices=None):
+    """
+    Follows (possibly nested) Subsets back to the dataset they index
+    Parameters:
+        dataset -- A dataset, or a Subset of one
+        indices -- Indices into dataset, or None for all of its items
+    Returns:
+        The underlying dataset and a tensor of the corresponding indices into it
+    """
+    indices = torch.arange(len(dataset)) if indices is None else torch.as_tensor(indices, dtype=torch.long)
+    while isinstance(dataset, Subset):
+        indices = torch.as_tensor(dataset.indices, dtype=torch.long)[indices]
+        dataset = dataset.dataset
+    return dataset, indices
+
+
+def make_batch_loader(dataset, batch_size, shuffle=True, indices=None, generator=None, **loader_kwargs):
+    """
+    Creates a DataLoader over a TensorBatchDataset (or a Subset of one) that
+    gathers each batch with one index_select
+    Parameters:
+        dataset -- The TensorBatchDataset, or a Subset of one
+        batch_size -- The number of inputs in each batch
+        shuffle -- Whether to shuffle the inputs every epoch
+        indices -- The items of dataset to load, or None for all of them
+        generator -- The torch.Generator to shuffle with (default: torch's
+            global generator)
+        loader_kwargs -- Passed on to DataLoader (e.g., num_workers)
+    """
+    dataset, indices = resolve_subsets(dataset, indices)
+    sampler = TensorBatchSampler(indices, batch_size, shuffle, generator)
+    # batch_size=None passes each batch of indices from the sampler straight
+    # to TensorBatchDataset.__getitem__, so there is nothing to collate
+    return DataLoader(dataset, sampler=sampler, batch_size=None, **loader_kwargs)
@@ -8,8 +8,46 @@
 #    - Supports both linear and hybrid models, and allows for different 
 #   loss functions.
 #    - Saves checkpoints during training to allow for seamless resumption
-#       if interrupted while training
-#    - Determines the best model and evaluates it on a held-out test set
+#       if interrupted while training. They are written atomically on a
+#       background thread, keeping the last few (-keep_checkpoints K). On
+#       SIGTERM (e.g., when SLURM preempts the job), the cross validation
+#       finishes its current batch, saves a checkpoint, and exits, and is
+#       resumed from the next batch
+#    - Optionally stops training each (l2_alpha, fold) early once its
+#       validation loss stops improving (-patience N), and prunes the worse
+#       half of the L2 values after every few folds (-halving_folds K,
+#       successive halving)
+#    - Determines the best model and evaluates it on a held-out test set,
+#       reporting the same confusion matrix metrics as each validation
+#    - Optionally runs the cross validation in parallel across CPU worker
+#       processes (-sweep_workers N), writing the results of each (l2_alpha,
+#       fold) configuration to a results table
+#    - Loads batches in worker processes with pinned memory and prefetching,
+#       configured from the number of cores (-loader_workers N to override)
+#    - Optionally holds the whole dataset in one float32 or float16 tensor
+#       (-tensor_dataset DTYPE), gathering each batch with one index_select
+#    - Trains with DistributedDataParallel across processes (on one or more
+#       nodes) when launched by torchrun, using the gloo backend so it runs on
+#       CPU-only nodes. Each rank trains on a shard of every batch, and the
+#       validation metrics are summed over the ranks
+#    - Optionally trains in mixed precision (-amp: bfloat16 on CPU, float16
+#       on CUDA) and with the conv branch in channels_last_3d (-channels_last)
+#    - Optionally trains only the hybrid model's fully connected layers on top
+#       of the conv branch of a trained model (-frozen_conv MODEL_PATH), on
+#       its outputs cached once for the whole dataset
+#    - Optionally profiles training (-profile): the time each batch waited on
+#       the DataLoader vs. trained, samples/sec, per-layer forward/backward
+#       times, and memory high-water marks, with a torch.profiler chrome trace
+#    - Optionally samples every class equally often when training
+#       (-balance_classes), and splits the dataset so the test set and every
+#       fold have the same class proportions (-stratify), using only the labels
+#    - Records the configuration, the train/validation loss, time, and
+#       throughput of every epoch, and the test results of every run in an
+#       SQLite experiment ledger (-ledger PATH)
+#    - Optionally searches the learning rate, weight decay, batch size, and
+#       conv branch widths with ASHA (-search) instead of the L2 grid search,
+#       warm starting each promoted trial from its last rung, in a pool of
+#       -sweep_workers processes, within the grid search's budget of epochs
 #    - Saves the best model to 
 #       trained_model_outputs/{timestamp}_best_{model_type}_mse_model_w_seed_{SEED}.pth
 
@@ -17,6 +55,10 @@ import torch
 import torch.nn as nn
 import os
 import sys
+import functools
+import json
+import shutil
+import signal
 
 # output to timestamped file
 DIRNAME = os.path.dirname(sys.argv[0])
@@ -24,36 +66,113 @@ DIRNAME = os.path.dirname(sys.argv[0])
 # Append to sys path to import scale_turbulence from plane_weights
 sys.path.append(os.path.join(DIRNAME, "..",))
 
-from model_architecture.regression_model import LinearClassifierModel
-from model_architecture.hybrid_model_1_out import HybridModel1Out
-from model_architecture.hybrid_model import HybridModel
+from model_architecture.constants import NUM_LINEAR_FEATURES
+from model_architecture.model_registry import get_hyperparameters, get_model_builder, get_model_config, get_model_types
 import torch.optim as optim
 from torch.utils.data import DataLoader
 import numpy as np
-import time, datetime
-from dataloader_class import RadarDataLoader
-from sklearn.model_selection import KFold
+import time, datetime, math
+from dataloader_class import RadarDataLoader, collate_batch, get_dataset_grid_spec
+from loader_config import get_loader_kwargs
+from tensor_dataset import FEATURE_DTYPES, TensorBatchDataset, TensorBatchSampler, resolve_subsets
+from parallel_sweep import run_sweep, share_dataset
+from early_stopping import EarlyStopping, get_best_epoch, successive_halving
+from mixed_precision import get_autocast, make_grad_scaler, prepare_model
+from embedding_cache import HeadModel, load_conv_branch, load_or_compute_embeddings
+from evaluation import ConfusionMatrix, format_metrics, get_predicted_classes
+from checkpoint_writer import CheckpointWriter, NUM_CHECKPOINTS_KEPT, atomic_save, atomic_write
+from distributed import (DistributedBatchSampler, init_distributed, is_main_process, wrap_model, unwrap_model,
+                         all_reduce_sum, any_rank, broadcast_seed, get_rank_shard)
+from training_profiler import TrainingProfiler
+from experiment_ledger import DEFAULT_LEDGER_PATH, ExperimentLedger
+from class_balance import WeightedBatchSampler, get_labels, get_stratified_splits
+from split_cache import get_random_splits, load_or_compute_splits
+from hyperparameter_search import SEARCH_SPACE, get_architecture, get_rungs, run_search
+from preemption import CHECKPOINTED_EXIT_CODE, TrainingInterrupted, get_rng_states, set_rng_states, make_shuffle_generator, ignore_sigterm
 from torch.utils.data import Subset
-import torch.nn.functional as F
 
 NUM_EPOCHS = 5 
 BATCH_SIZE = 2000
 NUM_FOLDS = 6
+# The fraction of the inputs held out as the test set
+TEST_SIZE = 0.10
+# The L2 penalties the cross validation tests (without -search)
+L2_ALPHA_LIST = [0.10, 0.01, 0.001, 0]
 # TODO: Set DATALOADER_PATH to dataloader we want to use for training
 DATALOADER_PATH = "dataloader.pth"
 
+# Optional flags (after the three required arguments) and their default values.
+# Flags with a bool default take no value (e.g., -amp)
+OPTIONAL_ARGS = {
+    "-sweep_workers": 0,
+    "-loader_workers": -1,
+    "-tensor_dataset": "none",
+    "-patience": 0,
+    "-halving_folds": 0,
+    "-amp": False,
+    "-channels_last": False,
+    "-frozen_conv": "none",
+    "-keep_checkpoints": NUM_CHECKPOINTS_KEPT,
+    "-profile": False,
+    "-balance_classes": False,
+    "-stratify": False,
+    "-ledger": DEFAULT_LEDGER_PATH,
+    "-search": False,
+    "-search_budget": -1,
+}
+
 terminate_training = False
 loss_is_nll = False
 
 def usage():
-    print("Usage: python train_and_test_model.py [linear|hybrid] [LOSS_TYPE] [SEED]")
+    print(f"Usage: python train_and_test_model.py [{'|'.join(get_model_types())}] [LOSS_TYPE] [SEED] [-sweep_workers N] [-loader_workers N] [-tensor_dataset float32|float16] [-patience N] [-halving_folds K] [-amp] [-channels_last] [-frozen_conv MODEL_PATH] [-keep_checkpoints K] [-profile] [-balance_classes] [-stratify] [-ledger LEDGER_PATH] [-search] [-search_budget EPOCHS]")
     print("linear: Train a linear classifier")
     print("hybrid: Train a hybrid classifier")
+    print("(the model types, and the hyperparameters of their architectures, are set in model_architecture/model_registry.json)")
     print("LOSS_TYPE: loss function to use (e.g., mse, mae, nll)")
     print("SEED: seed for splitting dataset and saving model checkpoint")
+    print("-sweep_workers: train the cross validation configurations in N parallel CPU processes")
+    print("-loader_workers: load batches in N worker processes (default: chosen from the number of cores)")
+    print("-tensor_dataset: hold the dataset in one tensor of the given dtype and gather batches with index_select")
+    print("-patience: stop training after N epochs without the validation loss improving (default 0, to train every epoch)")
+    print("-halving_folds: prune the worse half of the L2 values after every K folds (default 0, to never prune)")
+    print("-amp: train in mixed precision (bfloat16 on CPU, float16 on CUDA)")
+    print("-channels_last: store the hybrid model's conv branch in the channels_last_3d memory format")
+    print("-frozen_conv: train only the hybrid model's fully connected layers, on the cached outputs of the conv branch of the hybrid model at MODEL_PATH")
+    print(f"-keep_checkpoints: keep the last K checkpoints (default {NUM_CHECKPOINTS_KEPT})")
+    print("-profile: record data-wait vs. compute time per batch, per-layer times, and memory use, to a _profile.json next to the results file")
+    print("-balance_classes: draw the training batches so every class is sampled equally often")
+    print("-stratify: split the test set and cross validation folds with the same class proportions as the dataset")
+    print(f"-ledger: the SQLite experiment ledger to record the run in (default {DEFAULT_LEDGER_PATH})")
+    print("-search: search the learning rate, weight decay, batch size, and conv widths with ASHA instead of the L2 grid search")
+    print("-search_budget: the number of epochs the search trains in total (default: the most the L2 grid search would train)")
     exit(1)
 
-if len(sys.argv) != 4 or (sys.argv[1] != "linear" and sys.argv[1] != "hybrid"):
+def parse_optional_args(args):
+    """
+    Returns a dictionary of the value of each flag in OPTIONAL_ARGS (without
+    the leading -), using the default for flags that are not given
+    """
+    options = {flag[1:]: default for flag, default in OPTIONAL_ARGS.items()}
+    i = 0
+    while i < len(args):
+        if args[i] not in OPTIONAL_ARGS:
+            usage()
+        default = OPTIONAL_ARGS[args[i]]
+        if isinstance(default, bool):
+            options[args[i][1:]] = True
+            i += 1
+            continue
+        if i + 1 >= len(args):
+            usage()
+        try:
+            options[args[i][1:]] = type(default)(args[i + 1])
+        except ValueError:
+            usage()
+        i += 2
+    return options
+
+if len(sys.argv) < 4 or sys.argv[1] not in get_model_types():
     usage()
 try:
     LOSS_TYPE = sys.argv[2]
@@ -61,6 +180,28 @@ try:
 except:
     usage()
     raise f"Could not cast {sys.argv[3]} to an int"
+OPTIONS = parse_optional_args(sys.argv[4:])
+SWEEP_WORKERS = OPTIONS["sweep_workers"]
+PATIENCE = OPTIONS["patience"]
+HALVING_FOLDS = OPTIONS["halving_folds"]
+USE_AMP = OPTIONS["amp"]
+CHANNELS_LAST = OPTIONS["channels_last"]
+BALANCE_CLASSES = OPTIONS["balance_classes"]
+if OPTIONS["tensor_dataset"] != "none" and OPTIONS["tensor_dataset"] not in FEATURE_DTYPES:
+    usage()
+FROZEN_CONV_PATH = None if OPTIONS["frozen_conv"] == "none" else OPTIONS["frozen_conv"]
+if FROZEN_CONV_PATH is not None and sys.argv[1] != "hybrid":
+    usage()
+
+# The rank of this process and the number of processes, when launched by
+# torchrun (0 and 1 otherwise)
+RANK, WORLD_SIZE = init_distributed()
+if RANK != 0:
+    # Only rank 0 prints and writes the results
+    sys.stdout = open(os.devnull, "w")
+if OPTIONS["search"] and WORLD_SIZE > 1:
+    print("-search trains its trials in a pool of processes, so run it without torchrun")
+    usage()
 
 
 
@@ -72,36 +213,155 @@ curr_time = time.time()
 formatted_curr_date = datetime.datetime.fromtimestamp(curr_time).isoformat()
 
 MODEL_CHECKPOINT_PATH = os.path.join(OUTPUT_DIR, f"{sys.argv[1]}_{LOSS_TYPE}_{SEED}_model_checkpoint.pth")
+# Writes the checkpoints (numbered, e.g., ..._model_checkpoint_00003.pth) in the background
+CHECKPOINT_WRITER = CheckpointWriter(MODEL_CHECKPOINT_PATH, OPTIONS["keep_checkpoints"])
+# The results table of a parallel sweep, kept until the run finishes so an
+# interrupted sweep can skip the configurations it already trained
+SWEEP_CHECKPOINT_PATH = os.path.join(OUTPUT_DIR, f"{sys.argv[1]}_{LOSS_TYPE}_{SEED}_sweep_results.csv")
+# Likewise for the -search results table, and the state of each search trial to warm start it from
+SEARCH_CHECKPOINT_PATH = os.path.join(OUTPUT_DIR, f"{sys.argv[1]}_{LOSS_TYPE}_{SEED}_search_results.csv")
+SEARCH_TRIALS_DIR = os.path.join(OUTPUT_DIR, f"{sys.argv[1]}_{LOSS_TYPE}_{SEED}_search_trials")
+# When the run with these arguments started, kept (like its checkpoints) until
+# it finishes, so that a resumed run keeps its name and run_id in the ledger
+RUN_STATE_PATH = os.path.join(OUTPUT_DIR, f"{sys.argv[1]}_{LOSS_TYPE}_{SEED}_run_state.json")
+RESUMING_RUN = os.path.exists(RUN_STATE_PATH)
+if RESUMING_RUN:
+    with open(RUN_STATE_PATH) as run_state_file:
+        formatted_curr_date = json.load(run_state_file)["started_at"]
 OUTPUT_FILENAME = os.path.join(OUTPUT_DIR, formatted_curr_date + f"_best_{sys.argv[1]}_{LOSS_TYPE}_model_w_seed_{SEED}")
+# The results are recorded in the ledger, so this only points to the run there
 RESULTS_FILEPATH = OUTPUT_FILENAME + "_results.txt"
-RESULTS_FILE = open(RESULTS_FILEPATH, "a")
+# Every run adds its configuration, epochs, and results to the same ledger (only from rank 0)
+LEDGER = ExperimentLedger(OPTIONS["ledger"], os.path.basename(OUTPUT_FILENAME), enabled=is_main_process(),
+                          start_time=datetime.datetime.fromisoformat(formatted_curr_date))
 MODEL_FILEPATH = OUTPUT_FILENAME + ".pth"
+GRID_SPEC_FILEPATH = OUTPUT_FILENAME + "_grid_spec.json"
+MODEL_CONFIG_FILEPATH = OUTPUT_FILENAME + "_model_config.json"
+SWEEP_RESULTS_FILEPATH = OUTPUT_FILENAME + "_sweep_results.csv"
+SEARCH_RESULTS_FILEPATH = OUTPUT_FILENAME + "_search_results.csv"
+EMBEDDING_CACHE_DIR = os.path.join(OUTPUT_DIR, "embedding_cache")
+SPLIT_CACHE_DIR = os.path.join(OUTPUT_DIR, "split_cache")
+PROFILE_FILEPATH = OUTPUT_FILENAME + "_profile.json"
+PROFILE_TRACE_FILEPATH = OUTPUT_FILENAME + "_trace.json"
 
 device = torch.device("cpu")
 if torch.cuda.is_available(): 
-    device = torch.device("cuda")
+    device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
     print("Using GPU!!!")
-
-def save_checkpoint(model, optimizer, l2_alpha_idx, fold, epoch, l2_loss_list, loss_per_fold_list, loss_per_epoch_list):
+if WORLD_SIZE > 1:
+    print(f"Training with DistributedDataParallel across {WORLD_SIZE} processes ({device.type}, gloo backend)")
+
+# Settings for every DataLoader (number of workers, pinned memory, prefetching)
+LOADER_KWARGS = get_loader_kwargs(device, OPTIONS["loader_workers"])
+if LOADER_KWARGS["num_workers"] > 0:
+    # Keep loading batches when SLURM sends the whole job SIGTERM
+    LOADER_KWARGS["worker_init_fn"] = ignore_sigterm
+# Scales the loss when training in float16, otherwise does nothing
+GRAD_SCALER = make_grad_scaler(device, USE_AMP)
+# Times the training batches with -profile (only on rank 0), otherwise does nothing
+PROFILER = TrainingProfiler(OPTIONS["profile"] and is_main_process(), PROFILE_FILEPATH, PROFILE_TRACE_FILEPATH, device)
+
+def save_checkpoint(model, optimizer, l2_alpha_idx, fold, epoch, fold_val_losses, active_l2_idxs, loss_per_epoch_list, early_stopping,
+                    sampler_state=None, resume_batch=0):
+    """
+    Saves the training state after epoch. sampler_state is the state of the
+    train loader's shuffle generator to resume with, and resume_batch the
+    number of batches of the next epoch that were already trained (when
+    interrupted in the middle of it)
+    """
+    # Every rank has the same state, so only rank 0 saves it
+    if not is_main_process():
+        return
     checkpoint = {
-        'model_state_dict': model.state_dict(),
+        'model_state_dict': unwrap_model(model).state_dict(),
         'optimizer_state_dict': optimizer.state_dict(),
         'epoch': epoch,
         'fold': fold,
         'l2_alpha_idx': l2_alpha_idx,
-        'l2_loss_list': l2_loss_list,
-        'loss_per_fold_list': loss_per_fold_list,
-        'loss_per_epoch_list': loss_per_epoch_list
+        'fold_val_losses': fold_val_losses,
+        'active_l2_idxs': active_l2_idxs,
+        'loss_per_epoch_list': loss_per_epoch_list,
+        'early_stopping_state_dict': early_stopping.state_dict(),
+        'sampler_state': sampler_state,
+        'resume_batch': resume_batch,
+        'rng_states': get_rng_states(),
+        'grad_scaler_state_dict': GRAD_SCALER.state_dict()
+    }
+    # Copies the checkpoint to the CPU and returns, while it is written in the background
+    CHECKPOINT_WRITER.save(checkpoint)
+    print(f"Checkpoint saved for l2_alpha_idx: {l2_alpha_idx}, fold {fold}, and epoch {epoch}"
+          + (f" (and batch {resume_batch} of epoch {epoch + 1})" if resume_batch else ""))
+
+
+def save_retrain_checkpoint(model, optimizer, best_config, num_retrain_epochs, epoch, sampler_state, resume_batch=0):
+    """
+    Saves the state of retraining the best model after epoch, along with the
+    configuration it is retrained with, so that a resumed run skips the cross
+    validation. sampler_state and resume_batch are as in save_checkpoint
+    """
+    if not is_main_process():
+        return
+    checkpoint = {
+        'phase': 'retrain',
+        'model_state_dict': unwrap_model(model).state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'best_config': best_config,
+        'num_retrain_epochs': num_retrain_epochs,
+        'epoch': epoch,
+        'sampler_state': sampler_state,
+        'resume_batch': resume_batch,
+        'rng_states': get_rng_states(),
+        'grad_scaler_state_dict': GRAD_SCALER.state_dict()
     }
-    torch.save(checkpoint, MODEL_CHECKPOINT_PATH)
-    print(f"Checkpoint saved at {MODEL_CHECKPOINT_PATH} for l2_alpha_idx: {l2_alpha_idx}, fold {fold}, and epoch {epoch}")
+    CHECKPOINT_WRITER.save(checkpoint)
+    print(f"Retraining checkpoint saved for epoch {epoch}"
+          + (f" (and batch {resume_batch} of epoch {epoch + 1})" if resume_batch else ""))
+
+
+def load_retrain_checkpoint():
+    # The newest checkpoint, if the run was interrupted while retraining
+    checkpoint = CHECKPOINT_WRITER.load(weights_only=False)
+    if checkpoint is not None and checkpoint.get('phase') == 'retrain':
+        return checkpoint
+    return None
+
+
+def handle_sigterm(signum, frame):
+    """
+    Stops the serial cross validation or the retraining after its current
+    batch, when SLURM preempts the job (or sends --signal before its time
+    limit)
+    """
+    global terminate_training
+    terminate_training = True
+    print(f"Received signal {signum}, so checkpointing after the current batch and exiting")
+
+
+def save_run_state():
+    # Saves when the run started for a resumed run to continue (only on rank 0)
+    def write_run_state(temp_path):
+        with open(temp_path, "w") as run_state_file:
+            json.dump({"started_at": formatted_curr_date}, run_state_file)
+    atomic_write(RUN_STATE_PATH, write_run_state)
+
+
+def exit_after_checkpoint():
+    # Waits for the last checkpoint to be written, then exits
+    CHECKPOINT_WRITER.flush()
+    print(f"Exiting with code {CHECKPOINTED_EXIT_CODE}: run again with the same arguments to resume")
+    sys.exit(CHECKPOINTED_EXIT_CODE)
 
 
 def load_checkpoint(model, optimizer):
-    if os.path.exists(MODEL_CHECKPOINT_PATH):
-        checkpoint = torch.load(MODEL_CHECKPOINT_PATH, weights_only=False)
+    # The newest checkpoint that can be read, falling back to older ones
+    checkpoint = CHECKPOINT_WRITER.load(weights_only=False)
+    if checkpoint is not None:
+        if 'fold_val_losses' not in checkpoint:
+            # Checkpoints from before folds were trained one at a time cannot be resumed
+            print("Ignoring checkpoint from an older version of this script")
+            return None
         print(checkpoint['model_state_dict'])
-        model.load_state_dict(checkpoint['model_state_dict'])
+        unwrap_model(model).load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         return checkpoint
     else:
@@ -109,115 +369,567 @@ def load_checkpoint(model, optimizer):
         return None
 
 
-def init_loaders(train_idx, val_idx, dataset):
+def build_model(Model, grid_spec, **hyperparameters):
+    """
+    Creates a Model for grid_spec (with any hyperparameters overriding the
+    registry's, e.g., from -search), in the memory format set by -channels_last
+    """
+    return prepare_model(Model(grid_spec=grid_spec, **hyperparameters), CHANNELS_LAST)
+
+def build_head_model(Model, conv_path):
+    """
+    Creates a Model with the conv branch of the model saved at conv_path,
+    wrapped to train only its fully connected layers on the cached conv
+    branch outputs
+    """
+    return HeadModel(load_conv_branch(Model(), conv_path))
+
+
+def make_loader(dataset, indices=None, loader_kwargs=LOADER_KWARGS, train=True, batch_size=BATCH_SIZE):
+    """
+    Creates a shuffled DataLoader over the items indices (or all items) of
+    dataset, which gathers whole batches from a TensorBatchDataset with
+    index_select, or from a RadarDataLoader with __getitems__. The batches
+    are sampled by a TensorBatchSampler with its own generator (or, when
+    distributed, by a DistributedBatchSampler, or with -balance_classes by a
+    WeightedBatchSampler), so that an interrupted epoch
+    can be resumed (see get_batch_sampler)
+    Parameters:
+        train -- When distributed, a training loader gives each rank its share
+            of every batch (so each step trains on batch_size inputs in
+            total), and an evaluation loader gives each rank every
+            WORLD_SIZE'th input
+        batch_size -- The number of inputs in each batch (default BATCH_SIZE)
+    """
+    dataset, indices = resolve_subsets(dataset, indices)
+    if BALANCE_CLASSES and train:
+        # Every rank draws the same batches and trains on its share of each
+        batch_sampler = WeightedBatchSampler(indices, get_labels(dataset, indices), batch_size,
+                                             generator=torch.Generator().manual_seed(broadcast_seed()),
+                                             rank=RANK, world_size=WORLD_SIZE)
+    elif WORLD_SIZE > 1 and train:
+        batch_sampler = DistributedBatchSampler(indices, math.ceil(batch_size / WORLD_SIZE), broadcast_seed())
+    else:
+        batch_sampler = TensorBatchSampler(get_rank_shard(indices), batch_size, shuffle=True, generator=make_shuffle_generator())
+    if isinstance(dataset, TensorBatchDataset):
+        # batch_size=None passes each batch of indices straight to TensorBatchDataset.__getitem__
+        return DataLoader(dataset, sampler=batch_sampler, batch_size=None, **loader_kwargs)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_batch, **loader_kwargs)
+
+
+def get_batch_sampler(loader):
+    # The TensorBatchSampler or DistributedBatchSampler of a loader from make_loader
+    if isinstance(loader.sampler, (TensorBatchSampler, DistributedBatchSampler)):
+        return loader.sampler
+    return loader.batch_sampler
+
+
+def init_loaders(train_idx, val_idx, dataset, loader_kwargs=LOADER_KWARGS, batch_size=BATCH_SIZE):
     print(f"First {NUM_FOLDS} train indices: {train_idx[:NUM_FOLDS]}")
     print(f"First {NUM_FOLDS} validation indices: {val_idx[:NUM_FOLDS]}")
 
-    # Create subsets for training and validation for current fold
-    # Adapt the subsets into dataloaders
-    train_subset = Subset(dataset, train_idx)
-    train_loader = DataLoader(train_subset, batch_size=BATCH_SIZE, shuffle=True)
-
-    val_subset = Subset(dataset, val_idx)
-    val_loader = DataLoader(val_subset, batch_size=BATCH_SIZE, shuffle=True)
-    print(f"Train subset size: {len(train_subset)}, Validation subset size: {len(val_subset)}")
+    # Adapt the training and validation items for current fold into dataloaders
+    train_loader = make_loader(dataset, train_idx, loader_kwargs, batch_size=batch_size)
+    val_loader = make_loader(dataset, val_idx, loader_kwargs, train=False, batch_size=batch_size)
+    print(f"Train subset size: {len(train_idx)}, Validation subset size: {len(val_idx)}")
 
     return train_loader, val_loader
 
 
-def train_model(model, epoch, train_loader, optimizer, loss_fn, verbose=False):
-    # iterate through all the data
+def train_model(model, epoch, train_loader, optimizer, loss_fn, verbose=False, interruptible=False):
+    # iterate through all the data, starting after the batches already
+    # trained if resuming an interrupted epoch, and return the number of
+    # inputs trained on, the sum of the loss of every batch, and the number
+    # of batches
     running_train_loss = 0.0
-    for batch_num, (x_train, y_train) in enumerate(train_loader):
+    epoch_train_loss = 0.0
+    num_batches = 0
+    num_inputs = 0
+    start_batch = get_batch_sampler(train_loader).start_batch
+    for batch_num, (x_train, y_train) in enumerate(PROFILER.iterate(model, train_loader), start=start_batch):
 
         # Move data to the appropriate device
         x_train, y_train = x_train.to(device), y_train.float().to(device)
 
         optimizer.zero_grad() # zero the parameter gradients at the beginning
-        y_hat = model(x_train) # Evaluate the model on the input data
+        with get_autocast(device, USE_AMP):
+            y_hat = model(x_train) # Evaluate the model on the input data
 
-        if loss_is_nll:
-            y_hat = log_softmax(y_hat)
-            y_train = y_train.long()
+            if loss_is_nll:
+                y_hat = log_softmax(y_hat)
+                y_train = y_train.long()
 
-        loss = loss_fn(y_hat, y_train)
+            loss = loss_fn(y_hat, y_train)
 
-        loss.backward()
-        optimizer.step()
+        GRAD_SCALER.scale(loss).backward()
+        GRAD_SCALER.step(optimizer)
+        GRAD_SCALER.update()
         running_train_loss += loss.item() # Yields the average loss per batch
+        epoch_train_loss += loss.item()
+        num_batches += 1
+        num_inputs += len(x_train)
 
         if verbose and batch_num % 100 == 100 - 1:    # print every 100 mini-batches
-            output_str = f'[Epoch: {epoch}, Batch_num: {batch_num + 1:5d}] avg training loss per batch: {running_train_loss / 100:.3f}'
-            RESULTS_FILE.write(output_str)
-            print(output_str)
+            print(f'[Epoch: {epoch}, Batch_num: {batch_num + 1:5d}] avg training loss per batch: {running_train_loss / 100:.3f}')
             print(f"On batch: {batch_num + 1}, train_loss: {loss.item()}, running train loss: {running_train_loss}")
             running_train_loss = 0.0
 
-def evaluate_model(model, val_loader, loss_fn, verbose=False):
+        # When distributed, every rank stops after the same batch if any of them was sent SIGTERM
+        if interruptible and any_rank(terminate_training):
+            raise TrainingInterrupted(batch_num + 1)
+    return num_inputs, epoch_train_loss, num_batches
+
+def evaluate_model(model, val_loader, loss_fn, verbose=False, confusion=None):
+    """
+    Returns the average loss per batch of the model on val_loader, and adds
+    its predicted classes to confusion (a ConfusionMatrix), if given. When
+    distributed, the loss and confusion matrix are summed over the ranks'
+    shares of val_loader
+    """
+    # The model is run without DistributedDataParallel, which only matters for training
+    model = unwrap_model(model)
     running_valid_loss = 0.0
     with torch.no_grad(): # disable gradient tracking for validation
         for batch_num, (x_val, y_val) in enumerate(val_loader):
             
             x_val, y_val = x_val.to(device), y_val.float().to(device)
 
-            y_hat_val = model(x_val)
+            with get_autocast(device, USE_AMP):
+                y_hat_val = model(x_val).float()
 
             if loss_is_nll:
                 y_hat_val = log_softmax(y_hat_val)
                 y_val = y_val.long()
 
             val_loss = loss_fn(y_hat_val, y_val)
+            if confusion is not None:
+                confusion.update(y_val, get_predicted_classes(y_hat_val))
 
             running_valid_loss += val_loss.item()
             if verbose and batch_num % 20 == 20 - 1:    # print every 20 mini-batches
                 print(f"On batch: {batch_num + 1:3d}, val_loss: {val_loss.item()}, running val loss: {running_valid_loss}")
-    print(f"Evaluated model on {len(val_loader)} batches of ~2000")
-    avg_valid_loss_epoch = running_valid_loss / len(val_loader)
+    running_valid_loss, num_batches = all_reduce_sum(torch.tensor([running_valid_loss, len(val_loader)], dtype=torch.float64)).tolist()
+    if confusion is not None:
+        confusion.counts = all_reduce_sum(confusion.counts)
+    print(f"Evaluated model on {int(num_batches)} batches of ~2000")
+    avg_valid_loss_epoch = running_valid_loss / num_batches
     return avg_valid_loss_epoch
 
-def train_and_eval_epoch(model, epoch, train_loader, val_loader, optimizer, loss_fn, fold, save_model=False):
+def train_and_eval_epoch(model, epoch, train_loader, val_loader, optimizer, loss_fn, fold, save_model=False, phase="cross_validation"):
     # ----------------- TRAINING ----------------- 
+    # Epochs that are checkpointed (save_model) stop after the current batch
+    # on SIGTERM, raising TrainingInterrupted. When searching (phase
+    # "search"), fold is the number of the trial
     print(f"BEGINNING EPOCH {epoch}")
     model.train()
-    train_model(model, epoch, train_loader, optimizer, loss_fn, verbose=True)
+    start_time = time.perf_counter()
+    num_inputs, train_loss, num_batches = train_model(model, epoch, train_loader, optimizer, loss_fn, verbose=True, interruptible=save_model)
+    train_time = time.perf_counter() - start_time
+    num_inputs, train_loss, num_batches = all_reduce_sum(torch.tensor([num_inputs, train_loss, num_batches], dtype=torch.float64)).tolist()
+    num_inputs = int(num_inputs)
+    print(f"Trained on {num_inputs} inputs in {train_time:.2f}s ({num_inputs / train_time:.1f} inputs/sec"
+          + (f" across {WORLD_SIZE} processes)" if WORLD_SIZE > 1 else ")"))
+    PROFILER.end_epoch(fold=fold, epoch=epoch)
 
     # ----------------- VALIDATION ----------------- 
     model.eval()
-    avg_valid_loss_epoch = evaluate_model(model, val_loader, loss_fn, verbose=True)
+    confusion = ConfusionMatrix()
+    avg_valid_loss_epoch = evaluate_model(model, val_loader, loss_fn, verbose=True, confusion=confusion)
+    metrics = confusion.get_metrics()
+    print(f"Fold {fold}, epoch {epoch} validation {format_metrics(metrics)}")
+    LEDGER.record_epoch(phase, optimizer.param_groups[0]["weight_decay"], fold, epoch, train_loss / max(num_batches, 1),
+                        train_time, num_inputs, val_loss=avg_valid_loss_epoch, val_accuracy=metrics["accuracy"].item())
 
     return avg_valid_loss_epoch
 
 
+def get_fold_loss(val_losses):
+    """
+    Returns the loss of one (l2_alpha, fold) from its validation loss after
+    each epoch: the lowest loss when stopping early, otherwise the last
+    """
+    return min(val_losses) if PATIENCE > 0 else val_losses[-1]
+
+
+def prune_l2_alphas(fold, fold_val_losses, active_l2_idxs, l2_alpha_list):
+    """
+    After every HALVING_FOLDS folds, keeps the better half of the L2 values
+    still being searched (by their mean loss over the folds so far) and logs
+    which were pruned
+    Returns:
+        The l2_alpha_idxs to keep searching
+    """
+    if HALVING_FOLDS <= 0 or (fold + 1) % HALVING_FOLDS != 0 or len(active_l2_idxs) == 1:
+        return active_l2_idxs
+    mean_losses = {l2_alpha_idx: float(np.mean([get_fold_loss(val_losses) for val_losses in fold_val_losses[l2_alpha_idx]]))
+                   for l2_alpha_idx in active_l2_idxs}
+    kept, pruned = successive_halving(mean_losses)
+    print(f"Successive halving after fold {fold}: keeping l2_alpha {[l2_alpha_list[i] for i in kept]} "
+          f"(mean losses {[mean_losses[i] for i in kept]}), pruning l2_alpha {[l2_alpha_list[i] for i in pruned]} "
+          f"(mean losses {[mean_losses[i] for i in pruned]})\n")
+    return sorted(kept)
+
+
+def seed_config(l2_alpha_idx, fold):
+    """
+    Seeds torch's global generator for the (l2_alpha_idx, fold) configuration
+    from SEED, so the model's initial weights and the loaders' shuffling (see
+    make_shuffle_generator) are the same whether the configuration is trained
+    by serial_cross_validation or by a parallel sweep worker
+    """
+    torch.manual_seed(int(np.random.SeedSequence([SEED, l2_alpha_idx, fold]).generate_state(1)[0]))
+
+
+def train_config(dataset, l2_alpha_idx, l2_alpha, train_idx, val_idx, fold, Model, loss_fn):
+    """
+    Trains a new model with the L2 penalty l2_alpha on the train_idx items of
+    dataset (stopping early after PATIENCE epochs without improving), used by
+    the parallel sweep to train one (l2_alpha, fold)
+    Returns:
+        A list of the validation loss after each epoch
+    """
+    print(f"Fold {fold} with l2_alpha = {l2_alpha}")
+    seed_config(l2_alpha_idx, fold)
+    # The sweep workers are daemon processes, which cannot start loader workers
+    train_loader, val_loader = init_loaders(train_idx, val_idx, dataset, get_loader_kwargs(device, num_workers=0))
+    model = Model().to(device)
+    optimizer = optim.Adam(model.parameters(), lr=0.01, weight_decay=l2_alpha)
+    early_stopping = EarlyStopping(PATIENCE)
+    loss_per_epoch_list = list()
+    for epoch in range(1, NUM_EPOCHS):
+        avg_val_loss = train_and_eval_epoch(model, epoch, train_loader, val_loader, optimizer, loss_fn, fold)
+        loss_per_epoch_list.append(avg_val_loss)
+        if early_stopping.step(avg_val_loss):
+            print(f"Stopping early after epoch {epoch}: best loss was {early_stopping.best_loss} on epoch {early_stopping.best_epoch}")
+            break
+    return loss_per_epoch_list
+
+
+def serial_cross_validation(dataset, folds, l2_alpha_list, Model, loss_fn):
+    """
+    Trains the (l2_alpha, fold) configurations one after another, fold by
+    fold so that L2 values can be pruned, checkpointing after every epoch
+    Returns:
+        A dictionary of the validation losses of each l2_alpha_idx (a list for
+        each fold it was trained on of the loss after each epoch), and a list of
+        the l2_alpha_idxs that were not pruned
+    """
+    fold_val_losses = {l2_alpha_idx: list() for l2_alpha_idx in range(len(l2_alpha_list))}
+    active_l2_idxs = list(range(len(l2_alpha_list)))
+
+    model = wrap_model(Model().to(device))
+    optimizer = optim.Adam(params=model.parameters())
+
+    restarting_from_checkpoint = False
+    checkpoint = load_checkpoint(model, optimizer)
+    if checkpoint is None:
+        start_fold = 0
+        start_l2_alpha_idx = 0
+        start_epoch = 0
+    else:
+        restarting_from_checkpoint = True
+        start_fold = checkpoint['fold']
+        start_l2_alpha_idx = checkpoint['l2_alpha_idx']
+        start_epoch = checkpoint['epoch']
+        fold_val_losses = checkpoint['fold_val_losses']
+        active_l2_idxs = checkpoint['active_l2_idxs']
+        loss_per_epoch_list = checkpoint['loss_per_epoch_list']
+        early_stopping = EarlyStopping(PATIENCE)
+        early_stopping.load_state_dict(checkpoint['early_stopping_state_dict'])
+        # Checkpoints from before epochs could be interrupted do not have these
+        sampler_state = checkpoint.get('sampler_state')
+        resume_batch = checkpoint.get('resume_batch', 0)
+        if checkpoint.get('rng_states') is not None:
+            set_rng_states(checkpoint['rng_states'])
+        if checkpoint.get('grad_scaler_state_dict'):
+            GRAD_SCALER.load_state_dict(checkpoint['grad_scaler_state_dict'])
+        print(f"Checkpoint loaded for l2_alpha_idx: {start_l2_alpha_idx}, fold {start_fold}, and epoch {start_epoch}")
+        print(f"fold_val_losses: {fold_val_losses}, active_l2_idxs: {active_l2_idxs}, loss_per_epoch_list: {loss_per_epoch_list}")
+
+    print(f"Beginning {NUM_FOLDS}-fold Cross Validation over l2_alpha values {l2_alpha_list}\n")
+    for fold, (train_idx, val_idx) in enumerate(folds):
+        if fold < start_fold: # Skip folds that have already been trained
+            continue
+        if len(active_l2_idxs) == 1:
+            print(f"Only l2_alpha = {l2_alpha_list[active_l2_idxs[0]]} is left, so skipping the remaining folds")
+            break
+
+        for l2_alpha_idx in active_l2_idxs:
+            if restarting_from_checkpoint and l2_alpha_idx < start_l2_alpha_idx:
+                continue
+            l2_alpha = l2_alpha_list[l2_alpha_idx]
+            print(f"Fold {fold} with l2_alpha = {l2_alpha}")
+            if not restarting_from_checkpoint:
+                seed_config(l2_alpha_idx, fold)
+            # Each configuration gets its own loaders, so it is shuffled the
+            # same way as when trained by a parallel sweep worker
+            train_loader, val_loader = init_loaders(train_idx, val_idx, dataset)
+            if not restarting_from_checkpoint:
+                model = wrap_model(Model().to(device))
+                optimizer = optim.Adam(model.parameters(), lr=0.01, weight_decay=l2_alpha)
+                early_stopping = EarlyStopping(PATIENCE)
+                loss_per_epoch_list = list()
+                start_epoch = 0
+            elif sampler_state is not None:
+                # Shuffle the next epoch the same way, skipping the batches of it already trained
+                batch_sampler = get_batch_sampler(train_loader)
+                batch_sampler.set_state(sampler_state)
+                batch_sampler.start_batch = resume_batch
+                if resume_batch:
+                    print(f"Resuming epoch {start_epoch + 1} from batch {resume_batch}")
+            restarting_from_checkpoint = False
+
+            for epoch in range(start_epoch + 1, NUM_EPOCHS):
+                if early_stopping.stopped:
+                    break
+                # The shuffle state at the start of the epoch, to resume it from if interrupted
+                sampler_state = get_batch_sampler(train_loader).get_state()
+                try:
+                    avg_val_loss = train_and_eval_epoch(model, epoch, train_loader, val_loader, optimizer, loss_fn, fold, save_model=True)
+                except TrainingInterrupted as interrupted:
+                    save_checkpoint(model, optimizer, l2_alpha_idx, fold, epoch - 1, fold_val_losses, active_l2_idxs, loss_per_epoch_list, early_stopping,
+                                    sampler_state=sampler_state, resume_batch=interrupted.num_batches)
+                    exit_after_checkpoint()
+                loss_per_epoch_list.append(avg_val_loss)
+                print(f"loss_per_epoch_list on epoch {epoch} is {loss_per_epoch_list}\n")
+                if early_stopping.step(avg_val_loss):
+                    print(f"Stopping early after epoch {epoch}: best loss was {early_stopping.best_loss} on epoch {early_stopping.best_epoch}")
+                save_checkpoint(model, optimizer, l2_alpha_idx, fold, epoch, fold_val_losses, active_l2_idxs, loss_per_epoch_list, early_stopping,
+                                sampler_state=get_batch_sampler(train_loader).get_state())
+                if any_rank(terminate_training): # Interrupted during validation
+                    exit_after_checkpoint()
+
+            # Save results for this fold
+            fold_val_losses[l2_alpha_idx].append(loss_per_epoch_list)
+            print(f"Fold {fold} had loss: {get_fold_loss(loss_per_epoch_list)} with l2_alpha = {l2_alpha}\n")
+
+        active_l2_idxs = prune_l2_alphas(fold, fold_val_losses, active_l2_idxs, l2_alpha_list)
+
+    return fold_val_losses, active_l2_idxs
+
+
+def parallel_cross_validation(dataset, folds, l2_alpha_list, Model, loss_fn):
+    """
+    Trains the (l2_alpha, fold) configurations in SWEEP_WORKERS processes,
+    HALVING_FOLDS folds at a time so that L2 values can be pruned in between
+    Returns:
+        The same as serial_cross_validation
+    """
+    print(f"Sharing the dataset between {SWEEP_WORKERS} sweep workers")
+    shared_dataset = share_dataset(dataset)
+    train_config_fn = functools.partial(train_config, Model=Model, loss_fn=loss_fn)
+    fold_val_losses = {l2_alpha_idx: list() for l2_alpha_idx in range(len(l2_alpha_list))}
+    active_l2_idxs = list(range(len(l2_alpha_list)))
+
+    folds_per_sweep = HALVING_FOLDS if HALVING_FOLDS > 0 else NUM_FOLDS
+    for first_fold in range(0, NUM_FOLDS, folds_per_sweep):
+        if len(active_l2_idxs) == 1:
+            print(f"Only l2_alpha = {l2_alpha_list[active_l2_idxs[0]]} is left, so skipping the remaining folds")
+            break
+        fold_idxs = list(range(first_fold, min(first_fold + folds_per_sweep, NUM_FOLDS)))
+        # Output written before forking would otherwise be written again by each worker
+        sys.stdout.flush()
+        results = run_sweep(train_config_fn, l2_alpha_list, folds, shared_dataset, SWEEP_WORKERS,
+                            SWEEP_CHECKPOINT_PATH, l2_alpha_idxs=active_l2_idxs, fold_idxs=fold_idxs)
+        val_losses_by_config = {(result["l2_alpha_idx"], result["fold"]): result["val_losses"] for result in results}
+        for fold in fold_idxs:
+            for l2_alpha_idx in active_l2_idxs:
+                fold_val_losses[l2_alpha_idx].append(val_losses_by_config[(l2_alpha_idx, fold)])
+        active_l2_idxs = prune_l2_alphas(fold_idxs[-1], fold_val_losses, active_l2_idxs, l2_alpha_list)
+
+    return fold_val_losses, active_l2_idxs
+
+
+def l2_grid_search(dataset, folds, Model, loss_fn):
+    """
+    Cross validates every L2 penalty in a fixed list (serially, or in
+    SWEEP_WORKERS processes), pruning the worst with successive halving
+    Returns:
+        The best L2 penalty, and the number of epochs to retrain it for
+    """
+    # create a list of L2 penalties to test
+    l2_alpha_list = L2_ALPHA_LIST
+    # to store the average loss (over all folds) with each regularization parameter
+    l2_loss_list = list()
+
+    if SWEEP_WORKERS > 0 and device.type != "cpu":
+        print("The parallel sweep only trains on CPU workers, so running the cross validation serially")
+    if SWEEP_WORKERS > 0 and WORLD_SIZE > 1:
+        print("The ranks already train each configuration in parallel, so running the cross validation serially")
+    if SWEEP_WORKERS > 0 and device.type == "cpu" and WORLD_SIZE == 1:
+        fold_val_losses, active_l2_idxs = parallel_cross_validation(dataset, folds, l2_alpha_list, Model, loss_fn)
+    else:
+        signal.signal(signal.SIGTERM, handle_sigterm)
+        fold_val_losses, active_l2_idxs = serial_cross_validation(dataset, folds, l2_alpha_list, Model, loss_fn)
+        # Choosing the L2 value is not checkpointed, so it is left to finish (or
+        # be killed) until the retraining handles SIGTERM again
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # The average loss over the folds each L2 value was trained on
+    for l2_alpha_idx, l2_alpha in enumerate(l2_alpha_list):
+        loss_per_fold_list = [get_fold_loss(val_losses) for val_losses in fold_val_losses[l2_alpha_idx]]
+        l2_loss_list.append(sum(loss_per_fold_list) / len(loss_per_fold_list))
+        print(f"l2_alpha = {l2_alpha} had fold losses {loss_per_fold_list}")
+
+    print(f"length of l2_loss_list is {len(l2_loss_list)}\n")
+    print(f"l2_loss_list is {l2_loss_list}\n")
+    # Pruned L2 values were only trained on the first folds, so the best is
+    # chosen from the L2 values that were trained on every fold
+    best_l2_idx = min(active_l2_idxs, key=lambda l2_alpha_idx: l2_loss_list[l2_alpha_idx])
+    best_l2_val = l2_alpha_list[best_l2_idx]
+    print(f"best l2_alpha value is {best_l2_val} with a loss of: {l2_loss_list[best_l2_idx]}")
+
+    # When stopping early, retrain for the number of epochs the folds of the
+    # best L2 value took to reach their lowest validation loss
+    num_retrain_epochs = NUM_EPOCHS
+    if PATIENCE > 0:
+        num_retrain_epochs = math.ceil(np.mean([get_best_epoch(val_losses) for val_losses in fold_val_losses[best_l2_idx]]))
+
+    print(f"Completed {NUM_FOLDS}-fold Cross Validation")
+    return best_l2_val, num_retrain_epochs
+
+
+def train_trial(dataset, trial_id, config, start_epoch, end_epoch, load_path, save_path, train_idx, val_idx, Model, loss_fn):
+    """
+    Trains one -search trial, a model with the hyperparameters config, from
+    start_epoch to end_epoch on the train_idx items of dataset, warm started
+    from the model, optimizer, and shuffle state saved at load_path by the
+    trial's last rung (when start_epoch > 0), and saves its state to save_path
+    Returns:
+        A list of the validation loss after each epoch (from the first)
+    """
+    print(f"Trial {trial_id} with {config}, epochs {start_epoch + 1} to {end_epoch}")
+    # The search workers cannot start loader workers (see train_config)
+    train_loader, val_loader = init_loaders(train_idx, val_idx, dataset, get_loader_kwargs(device, num_workers=0),
+                                            batch_size=config["batch_size"])
+    model = Model(**get_architecture(config)).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=config["lr"], weight_decay=config["weight_decay"])
+    val_losses = list()
+    if start_epoch > 0:
+        state = torch.load(load_path, map_location=device, weights_only=False)
+        model.load_state_dict(state['model_state_dict'])
+        optimizer.load_state_dict(state['optimizer_state_dict'])
+        get_batch_sampler(train_loader).set_state(state['sampler_state'])
+        val_losses = state['val_losses']
+    for epoch in range(start_epoch + 1, end_epoch + 1):
+        val_losses.append(train_and_eval_epoch(model, epoch, train_loader, val_loader, optimizer, loss_fn, trial_id, phase="search"))
+    state = {
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'sampler_state': get_batch_sampler(train_loader).get_state(),
+        'val_losses': val_losses,
+    }
+    atomic_save(state, save_path)
+    return val_losses
+
+
+def hyperparameter_search(dataset, folds, Model, loss_fn):
+    """
+    Searches the learning rate, weight decay, batch size, and (for models
+    built with conv_channels, unless the conv branch is frozen) conv widths
+    with ASHA, training each trial on the first cross validation fold
+    Returns:
+        The best configuration, and the number of epochs to retrain it for
+    """
+    search_space = dict(SEARCH_SPACE)
+    default_config = {"lr": 0.01, "weight_decay": 0.0, "batch_size": BATCH_SIZE}
+    registry_hyperparameters = get_hyperparameters(sys.argv[1])
+    if "conv_channels" in registry_hyperparameters and FROZEN_CONV_PATH is None:
+        default_config["conv_channels"] = registry_hyperparameters["conv_channels"]
+    else:
+        del search_space["conv_channels"]
+    # By default, as many epochs as the L2 grid search trains before any are
+    # stopped early or pruned (each epoch of a trial is the same size as one
+    # of a fold's)
+    budget = OPTIONS["search_budget"]
+    if budget <= 0:
+        budget = len(L2_ALPHA_LIST) * NUM_FOLDS * (NUM_EPOCHS - 1)
+
+    num_workers = SWEEP_WORKERS
+    if SWEEP_WORKERS > 0 and device.type != "cpu":
+        print("The search's process pool only trains on CPU workers, so training the trials in this process")
+        num_workers = 0
+    train_idx, val_idx = folds[0]
+    train_trial_fn = functools.partial(train_trial, train_idx=train_idx, val_idx=val_idx, Model=Model, loss_fn=loss_fn)
+    if num_workers > 0:
+        print(f"Sharing the dataset between {num_workers} search workers")
+        dataset = share_dataset(dataset)
+    print(f"Searching {search_space} with ASHA (rungs at {get_rungs()} epochs) for {budget} epochs, starting from {default_config}\n")
+    # Output written before forking would otherwise be written again by each worker
+    sys.stdout.flush()
+    best_result, results = run_search(train_trial_fn, dataset, search_space, default_config, budget, SEED,
+                                      num_workers, SEARCH_CHECKPOINT_PATH, SEARCH_TRIALS_DIR)
+
+    print(f"Best trial of {len({result['trial_id'] for result in results})} is {best_result['trial_id']} with "
+          f"{best_result['config']} and a loss of {best_result['loss']} after {best_result['epochs']} epochs\n")
+    # Retrain for the number of epochs the best trial took to reach its lowest validation loss
+    return best_result["config"], get_best_epoch(best_result["val_losses"])
 
 
 def main():
 
-    Model = LinearClassifierModel
-    
-    if sys.argv[1] == "hybrid" and (LOSS_TYPE == "mse"or LOSS_TYPE == "mae"):
-        Model = HybridModel1Out
-    elif sys.argv[1] == "hybrid" and LOSS_TYPE == "nll":
-        Model = HybridModel
+    # The model's class (and the hyperparameters of its architecture) for
+    # the model type and loss, from the model registry
+    Model = get_model_builder(sys.argv[1], LOSS_TYPE)
     
     # load in pickled dataset from file and instantiate DataLoader Object
     dataset = torch.load(DATALOADER_PATH, weights_only=False) # load in saved dataset
 
-
-    # Split dataset 
-    dataset, test_dataset = torch.utils.data.random_split(dataset, [0.90, 0.10], generator=torch.Generator().manual_seed(SEED))
+    # The model is built for the grid spec (shape and fields) of the dataset,
+    # so check that the dataset's inputs actually have that shape
+    grid_spec = get_dataset_grid_spec(dataset).validate()
+    num_features = grid_spec.num_grid_features + NUM_LINEAR_FEATURES
+    if len(dataset) == 0 or dataset[0][0].numel() != num_features:
+        raise ValueError(f"Dataset inputs do not match grid spec {grid_spec}: expected {num_features} features")
+    Model = functools.partial(build_model, Model, grid_spec)
+    print(f"Dataset has grid spec: {grid_spec}")
+    if RESUMING_RUN:
+        # Its configuration was recorded when it first started
+        print(f"Resuming run {LEDGER.run_id} (started at {formatted_curr_date})")
+    else:
+        LEDGER.start_run(sys.argv[1], LOSS_TYPE, SEED, OPTIONS, WORLD_SIZE, device, DATALOADER_PATH, len(dataset))
+    if is_main_process():
+        save_run_state()
+        with open(RESULTS_FILEPATH, "w") as results_file:
+            results_file.write(f"The results of run {LEDGER.run_id} are in the experiment ledger {os.path.abspath(LEDGER.ledger_path)}:\n"
+                               f"python {os.path.join(DIRNAME, 'experiment_ledger.py')} -ledger {os.path.abspath(LEDGER.ledger_path)}\n")
+
+    # Stack the inputs into contiguous tensors that batches are gathered from,
+    # before any loader workers are forked so they share them
+    dataset.get_tensors()
+    print(f"Loading batches with {LOADER_KWARGS}")
+    if FROZEN_CONV_PATH is not None:
+        # The frozen conv branch is run once over every input, and the models
+        # are trained on its outputs (which keeps the inputs in the same order,
+        # so the dataset is split the same way)
+        features, labels = dataset.get_tensors()
+        conv_model = load_conv_branch(Model(), FROZEN_CONV_PATH)
+        embeddings = load_or_compute_embeddings(conv_model, features, EMBEDDING_CACHE_DIR)
+        dataset = TensorBatchDataset(embeddings, labels, FEATURE_DTYPES.get(OPTIONS["tensor_dataset"]))
+        Model = functools.partial(build_head_model, Model, FROZEN_CONV_PATH)
+        print(f"Training the fully connected layers on the conv branch of {FROZEN_CONV_PATH}, "
+              f"with inputs of shape {tuple(dataset.features.shape)}")
+    elif OPTIONS["tensor_dataset"] != "none":
+        dataset = TensorBatchDataset.from_dataset(dataset, FEATURE_DTYPES[OPTIONS["tensor_dataset"]])
+        print(f"Holding the dataset in one {dataset.features.dtype} tensor of shape {tuple(dataset.features.shape)}")
+
+
+    # Split dataset into the test set and cross validation folds (with the
+    # same class proportions with -stratify), which are computed from the
+    # int8 labels once per dataset and seed, and then loaded from SPLIT_CACHE_DIR
+    split_fn = get_stratified_splits if OPTIONS["stratify"] else get_random_splits
+    train_idx, test_idx, folds = load_or_compute_splits(SPLIT_CACHE_DIR, get_labels(dataset), SEED, split_fn,
+                                                        test_size=TEST_SIZE, num_folds=NUM_FOLDS)
+    dataset, test_dataset = Subset(dataset, train_idx), Subset(dataset, test_idx)
+    print(f"Split the dataset into {len(train_idx)} training and {len(test_idx)} test inputs")
 
     # Create DataLoader for train and test after the best model is selected
-    all_train_dataloader = DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=True)
-    test_dataloader = DataLoader(test_dataset, batch_size=BATCH_SIZE, shuffle=True)
+    all_train_dataloader = make_loader(dataset)
+    test_dataloader = make_loader(test_dataset, train=False)
 
     # https://medium.com/biased-algorithms/cross-validation-in-pytorch-2f9f9fa9ab16
-    # Initialize KFold
-    kfold = KFold(n_splits=NUM_FOLDS, shuffle=True, random_state=42)
-
-    # create a list of L2 penalties to test
-    l2_alpha_list = [0.10, 0.01, 0.001, 0]
-    # to store the average loss (over all folds) with each regularization parameter
-    l2_loss_list = list()
+    if BALANCE_CLASSES:
+        print(f"Drawing training batches with every class equally likely, from labels with counts {torch.bincount(get_labels(dataset).long()).tolist()}")
 
     # Readable softmax function (percentages)
     # softmax = nn.Softmax(dim=-1)
@@ -239,143 +951,116 @@ def main():
     print(f"Using {SEED} as the seed for splitting the dataset")
     
 
-    model = Model().to(device)
-    optimizer = optim.Adam(params=model.parameters())
-
-    restarting_from_checkpoint = False
-    checkpoint = load_checkpoint(model, optimizer)
-    if checkpoint is None:
-        start_l2_alpha_idx = 0
-        start_fold = 0
-        start_epoch = 0
+    # A run interrupted while retraining resumes from its retraining
+    # checkpoint, without cross validating again
+    retrain_checkpoint = load_retrain_checkpoint()
+    if retrain_checkpoint is not None:
+        best_config, num_retrain_epochs = retrain_checkpoint['best_config'], retrain_checkpoint['num_retrain_epochs']
+        best_l2_val = best_config["weight_decay"]
+        all_train_dataloader = make_loader(dataset, batch_size=best_config["batch_size"])
+    elif OPTIONS["search"]:
+        best_config, num_retrain_epochs = hyperparameter_search(dataset, folds, Model, loss_fn)
+        best_l2_val = best_config["weight_decay"]
+        all_train_dataloader = make_loader(dataset, batch_size=best_config["batch_size"])
     else:
-        restarting_from_checkpoint = True
-        start_l2_alpha_idx = checkpoint['l2_alpha_idx']
-        start_fold = checkpoint['fold']
-        start_epoch = checkpoint['epoch']
-        l2_loss_list = checkpoint['l2_loss_list']
-        loss_per_fold_list = checkpoint['loss_per_fold_list']
-        loss_per_epoch_list = checkpoint['loss_per_epoch_list']
-        print(f"Checkpoint loaded from {MODEL_CHECKPOINT_PATH} for l2_alpha_idx: {start_l2_alpha_idx}, fold {start_fold}, and epoch {start_epoch}")
-        print(f"l2_loss_list: {l2_loss_list}, loss_per_fold_list: {loss_per_fold_list}, loss_per_epoch_list: {loss_per_epoch_list}")
-
-    print(f"Beginning search over different values of l2_alpha\n")
-    for l2_alpha_idx in range(start_l2_alpha_idx, len(l2_alpha_list)):
-        # To store the loss for each fold
-        l2_alpha = l2_alpha_list[l2_alpha_idx]
-        loss_per_fold_list = loss_per_fold_list if restarting_from_checkpoint else list()
-        
-        print(f"Beginning {NUM_FOLDS}-fold Cross Validation with l2_alpha = {l2_alpha}")
-        # Split the dataset into 6 folds
-        
-
-        for fold, (train_idx, val_idx) in enumerate(kfold.split(dataset)):
-            if fold < start_fold: # Skip folds that have already been trained
-                continue
-            print(f"Fold {fold} with l2_alpha = {l2_alpha}")
-            loss_per_epoch_list = loss_per_epoch_list if restarting_from_checkpoint else list()
-            train_loader, val_loader = init_loaders(train_idx, val_idx, dataset)
-            model = model if restarting_from_checkpoint else Model().to(device)
-            optimizer = optimizer if restarting_from_checkpoint else optim.Adam(model.parameters(), lr=0.01, weight_decay=l2_alpha) 
-
-            for epoch in range(start_epoch + 1, NUM_EPOCHS):
-                restarting_from_checkpoint = False
-                avg_val_loss = train_and_eval_epoch(model, epoch, train_loader, val_loader, optimizer, loss_fn, fold, save_model=True)
-                loss_per_epoch_list.append(avg_val_loss)
-                print(f"loss_per_epoch_list on epoch {epoch} is {loss_per_epoch_list}\n")
-                save_checkpoint(model, optimizer, l2_alpha_idx, fold, epoch, l2_loss_list, loss_per_fold_list, loss_per_epoch_list)
-
-            # Save results for this fold (always last epoch)
-            loss_per_fold_list.append(loss_per_epoch_list[-1])
-            print(f"Fold {fold} had loss: {loss_per_fold_list[-1]} on its last epoch\n")  
-
-        # Calculate the average loss for this fold
-        fold_avg_loss = sum(loss_per_fold_list) / len(loss_per_fold_list)
-        l2_loss_list.append(fold_avg_loss)
-        print(f"l2_loss_list is now {l2_loss_list}\n")
-
-    print(f"length of l2_loss_list is {len(l2_loss_list)}\n")
-    print(f"l2_loss_list is {l2_loss_list}\n")
-    best_l2_idx = np.argmin(l2_loss_list)
-    best_l2_val = l2_alpha_list[best_l2_idx]
-    print(f"best l2_alpha value is {best_l2_val} with a loss of: {np.min(l2_loss_list)}")
-
-    print(f"Completed {NUM_FOLDS}-fold Cross Validation")
-
-    best_model = Model().to(device)
-    optimizer = optim.Adam(best_model.parameters(), lr=0.01, weight_decay=best_l2_val)
-
-    # Retrain on the 90 percent of the data
-    print("Retraining best model on 90 percent of the data\n")
-    for epoch in range(NUM_EPOCHS):
-        for batch_num, data in enumerate(all_train_dataloader):
-            x_train, y_train = data
-
-            x_train, y_train = x_train.to(device), y_train.float().to(device)
-
-            optimizer.zero_grad() # zero the parameter gradients at the beginning
-            y_hat = best_model(x_train)
-            if loss_is_nll:
-                y_hat = log_softmax(y_hat)
-                y_train = y_train.long()
-
-            loss = loss_fn(input=y_hat, target=y_train)
-                    
-            loss.backward()
-            optimizer.step()
+        best_l2_val, num_retrain_epochs = l2_grid_search(dataset, folds, Model, loss_fn)
+        best_config = {"lr": 0.01, "weight_decay": best_l2_val, "batch_size": BATCH_SIZE}
+    architecture = get_architecture(best_config)
+
+    best_model = wrap_model(Model(**architecture).to(device))
+    optimizer = optim.Adam(best_model.parameters(), lr=best_config["lr"], weight_decay=best_l2_val)
+
+    start_epoch = 0
+    batch_sampler = get_batch_sampler(all_train_dataloader)
+    if retrain_checkpoint is not None:
+        unwrap_model(best_model).load_state_dict(retrain_checkpoint['model_state_dict'])
+        optimizer.load_state_dict(retrain_checkpoint['optimizer_state_dict'])
+        start_epoch = retrain_checkpoint['epoch']
+        set_rng_states(retrain_checkpoint['rng_states'])
+        GRAD_SCALER.load_state_dict(retrain_checkpoint['grad_scaler_state_dict'])
+        # Shuffle the next epoch the same way, skipping the batches of it already trained
+        batch_sampler.set_state(retrain_checkpoint['sampler_state'])
+        batch_sampler.start_batch = retrain_checkpoint['resume_batch']
+        print(f"Resuming the retraining from epoch {start_epoch + 1}"
+              + (f", batch {batch_sampler.start_batch}" if batch_sampler.start_batch else ""))
+
+    # Retrain on the 90 percent of the data, checkpointing after every epoch
+    # and stopping after the current batch on SIGTERM like the serial cross
+    # validation
+    print(f"Retraining best model on 90 percent of the data for {num_retrain_epochs} epochs\n")
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    for epoch in range(start_epoch, num_retrain_epochs):
+        # The shuffle state at the start of the epoch, to resume it from if interrupted
+        sampler_state = batch_sampler.get_state()
+        start_time = time.perf_counter()
+        try:
+            num_inputs, train_loss, num_batches = train_model(best_model, epoch + 1, all_train_dataloader, optimizer, loss_fn, interruptible=True)
+        except TrainingInterrupted as interrupted:
+            save_retrain_checkpoint(best_model, optimizer, best_config, num_retrain_epochs, epoch, sampler_state,
+                                    resume_batch=interrupted.num_batches)
+            exit_after_checkpoint()
+        PROFILER.end_epoch(fold="retrain", epoch=epoch)
+        train_time = time.perf_counter() - start_time
+        train_loss, num_batches, num_inputs = all_reduce_sum(torch.tensor([train_loss, num_batches, num_inputs], dtype=torch.float64)).tolist()
+        LEDGER.record_epoch("retrain", best_l2_val, None, epoch + 1, train_loss / max(num_batches, 1), train_time, int(num_inputs))
+        save_retrain_checkpoint(best_model, optimizer, best_config, num_retrain_epochs, epoch + 1, batch_sampler.get_state())
+    # Testing is not checkpointed (a run killed while testing resumes after the last epoch)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
     print("Testing the retrained best model\n")
 
     # ----------------- TESTING -----------------
     # Evaluate the model on the test set
-    running_test_loss = 0.0
     best_model.eval()
-
-    # To store the distribution of classes
-    actual_output_counts = np.zeros(10, dtype=int)
-    model_output_counts = np.zeros(10, dtype=int)
-    with torch.no_grad():
-        for x_test, y_test in test_dataloader:
-            x_test, y_test = x_test.to(device), y_test.float().to(device)
-            y_hat_test = best_model(x_test)
-
-            if loss_is_nll:
-                y_hat_test = log_softmax(y_hat_test)
-                y_test = y_test.long()
-
-            test_loss = loss_fn(input=y_hat_test, target=y_test)
-            running_test_loss += test_loss.item()
-
-            probs = F.softmax(y_hat_test, dim=1)  # Get class probabilities
-
-        for i in range(len(y_test)):
-            true_label = y_test[i].item()
-            predicted_class = torch.argmax(y_hat_test[i]).item()
-            top_prob = probs[i][predicted_class].item()
-            actual_output_counts[true_label] += 1
-            model_output_counts[predicted_class] += 1
-
-            # Calculate accuracy
-            if true_label == predicted_class: 
-                num_correct += 1
-            if true_label == 0 and predicted_class > 1:
-                num_false_positive += 1
-            if true_label > 0 and predicted_class == 0:
-                num_false_negative += 1
-
-    
-    print(f"For the test data, the actual distribution of classes are: {actual_output_counts}")
-    print(f"For the test data, the model's distribution of classes are: {model_output_counts}")
-
-    print(f"Accuracy is: {num_correct}/{len(test_dataset)}, or {num_correct/len(test_dataset) * 100}%")
-    print(f"The false positive rate is: {num_false_positive}/{len(test_dataset)}, or {num_false_positive/len(test_dataset) * 100}%")
-    print(f"The false negative rate is: {num_false_negative}/{len(test_dataset)}, or {num_false_negative/len(test_dataset) * 100}%")
-
-    # Save the best model
+    confusion = ConfusionMatrix()
+    avg_test_loss = evaluate_model(best_model, test_dataloader, loss_fn, confusion=confusion)
+    metrics = confusion.get_metrics()
+
+    # The distribution of classes
+    print(f"For the test data, the actual distribution of classes are: {metrics['actual counts'].tolist()}")
+    print(f"For the test data, the model's distribution of classes are: {metrics['predicted counts'].tolist()}")
+    print(f"For the test data, the recall of each class is: {[round(recall, 4) for recall in metrics['recall'].tolist()]}")
+
+    num_correct = int(confusion.counts.diagonal().sum())
+    num_false_positive = int(confusion.counts[0, 2:].sum())
+    num_false_negative = int(confusion.counts[1:, 0].sum())
+    print(f"The average test loss per batch is: {avg_test_loss}")
+    print(f"Accuracy is: {num_correct}/{len(confusion)}, or {metrics['accuracy'].item() * 100}%")
+    print(f"The false positive rate is: {num_false_positive}/{len(confusion)}, or {metrics['false positive rate'].item() * 100}%")
+    print(f"The false negative rate is: {num_false_negative}/{len(confusion)}, or {metrics['false negative rate'].item() * 100}%")
+    LEDGER.finish_run(best_l2_val, num_retrain_epochs, avg_test_loss, metrics, confusion.counts.tolist(), MODEL_FILEPATH)
+
+    # Save the best model, along with the grid spec needed to rebuild it. A
+    # model trained on a frozen conv branch is saved whole, with that branch
+    best_model = unwrap_model(best_model)
+    if isinstance(best_model, HeadModel):
+        best_model = best_model.model
+    if not is_main_process():
+        # Only rank 0 saves the model and removes the checkpoints
+        return
     torch.save(best_model.state_dict(), MODEL_FILEPATH)
-    # Remove the checkpoint file
-    os.remove(MODEL_CHECKPOINT_PATH)
-    RESULTS_FILE.close()
+    with open(GRID_SPEC_FILEPATH, "w") as grid_spec_file:
+        grid_spec_file.write(grid_spec.to_json())
+    # With the searched hyperparameters of the architecture (e.g., conv_channels)
+    model_config = get_model_config(sys.argv[1], LOSS_TYPE)
+    model_config["hyperparameters"].update(architecture)
+    # With how the inputs were split, so that inference (e.g., quantize_model.py)
+    # can hold out the same test inputs
+    model_config["splits"] = {"stratify": OPTIONS["stratify"], "test_size": TEST_SIZE, "num_folds": NUM_FOLDS}
+    with open(MODEL_CONFIG_FILEPATH, "w") as model_config_file:
+        json.dump(model_config, model_config_file, indent=4)
+    # Remove the checkpoint files, run state, and search trials, keeping the parallel
+    # sweep's and search's results tables
+    print(CHECKPOINT_WRITER.get_summary())
+    CHECKPOINT_WRITER.remove_all()
+    os.remove(RUN_STATE_PATH)
+    if os.path.exists(SWEEP_CHECKPOINT_PATH):
+        os.replace(SWEEP_CHECKPOINT_PATH, SWEEP_RESULTS_FILEPATH)
+    if os.path.exists(SEARCH_CHECKPOINT_PATH):
+        os.replace(SEARCH_CHECKPOINT_PATH, SEARCH_RESULTS_FILEPATH)
+        shutil.rmtree(SEARCH_TRIALS_DIR, ignore_errors=True)
 
 if __name__ == "__main__":
     main()
+    if WORLD_SIZE > 1:
+        torch.distributed.destroy_process_group()
@@ -0,0 +1,229 @@
+# training_profiler.py
+# Team Celestial Blue
+# Spring 2025
+# Purpose: Defines TrainingProfiler, which (with -profile) records how long
+#   each training batch waited on the DataLoader vs. how long the training
+#   step took, the samples/sec of each epoch, the forward and backward time of
+#   each layer of the model, and the memory high-water marks, and writes them
+#   to a JSON metrics file after every epoch. The first few batches are also
+#   run under torch.profiler, and exported as a chrome trace (open it in
+#   chrome://tracing or https://ui.perfetto.dev). When disabled, it does
+#   nothing, so training is not slowed down
+
+import json
+import os
+import resource
+import sys
+import time
+import warnings
+import torch
+from checkpoint_writer import atomic_write
+
+# The torch.profiler schedule: skip the first batch (which includes one-time
+# setup), then warm up for 1 batch and record the next 3
+PROFILE_WAIT_BATCHES = 1
+PROFILE_WARMUP_BATCHES = 1
+PROFILE_ACTIVE_BATCHES = 3
+# An epoch that spends more than this fraction of its time waiting on the
+# DataLoader is reported as I/O-bound
+IO_BOUND_FRACTION = 0.5
+
+
+def get_max_rss_mb():
+    # The peak resident memory of this process (ru_maxrss is in KB on Linux
+    # and in bytes on macOS)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+def write_json(path, value):
+    with open(path, "w") as json_file:
+        json.dump(value, json_file, indent=1)
+
+
+class TrainingProfiler:
+
+    def __init__(self, enabled, metrics_path, trace_path, device):
+        """
+        Parameters:
+            enabled -- Whether to profile (otherwise every method does nothing)
+            metrics_path -- Where to write the JSON metrics
+            trace_path -- Where to export the chrome trace
+            device -- The device being trained on
+        """
+        self.enabled = enabled
+        self.metrics_path = metrics_path
+        self.trace_path = trace_path
+        self.device = device
+        # Processes forked after this (e.g., the parallel sweep's workers) do not profile
+        self.pid = os.getpid()
+        self.epochs = []
+        self.batches = []
+        self.layer_times = {}
+        self.num_profiled_batches = 0
+        self.profiler = None
+        self.hooks = []
+        self.layer_start_times = {}
+        self.trace_exported = False
+
+    def is_active(self):
+        return self.enabled and os.getpid() == self.pid
+
+    def synchronize(self):
+        # CUDA runs asynchronously, so wait for it before reading the time
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def iterate(self, model, loader):
+        """
+        Yields the batches of loader, recording how long each one was waited
+        for and how long the training step (the code between yields) took.
+        Also runs torch.profiler and times the layers of model over the first
+        batches profiled
+        """
+        if not self.is_active():
+            yield from loader
+            return
+        self.start_torch_profiler(model)
+        iterator = iter(loader)
+        while True:
+            wait_start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            step_start = time.perf_counter()
+            yield batch
+            self.synchronize()
+            step_end = time.perf_counter()
+            self.batches.append({
+                "batch_size": len(batch[0]),
+                "data_wait_s": step_start - wait_start,
+                "compute_s": step_end - step_start,
+            })
+            self.step_torch_profiler()
+
+    def start_torch_profiler(self, model):
+        if self.profiler is not None or self.trace_exported:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=PROFILE_WAIT_BATCHES, warmup=PROFILE_WARMUP_BATCHES,
+                                             active=PROFILE_ACTIVE_BATCHES, repeat=1),
+            on_trace_ready=self.export_trace,
+            record_shapes=True,
+            profile_memory=True,
+        )
+        self.profiler.start()
+        self.add_layer_hooks(model)
+
+    def step_torch_profiler(self):
+        if self.profiler is None:
+            return
+        self.profiler.step()
+        self.num_profiled_batches += 1
+        if self.num_profiled_batches >= PROFILE_WAIT_BATCHES + PROFILE_WARMUP_BATCHES + PROFILE_ACTIVE_BATCHES:
+            self.stop_torch_profiler()
+
+    def stop_torch_profiler(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        self.profiler = None
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+    def export_trace(self, profiler):
+        profiler.export_chrome_trace(self.trace_path)
+        self.trace_exported = True
+        print(f"Exported the torch.profiler trace of {PROFILE_ACTIVE_BATCHES} training batches to {self.trace_path}")
+
+    def add_layer_hooks(self, model):
+        """
+        Times the forward and backward pass of each layer (module without
+        children) of model, labelling them in the trace as well
+        """
+        # The first layer's inputs never require gradients, which is expected here
+        warnings.filterwarnings("ignore", message="Full backward hook is firing")
+        for name, module in model.named_modules():
+            if len(list(module.children())) > 0:
+                continue
+            name = name.removeprefix("module.") # Inside DistributedDataParallel
+            self.hooks.append(module.register_forward_pre_hook(self.make_start_hook(name, "forward")))
+            self.hooks.append(module.register_forward_hook(self.make_end_hook(name, "forward")))
+            self.hooks.append(module.register_full_backward_pre_hook(self.make_start_hook(name, "backward")))
+            self.hooks.append(module.register_full_backward_hook(self.make_end_hook(name, "backward")))
+
+    def make_start_hook(self, name, direction):
+        def start_hook(*args):
+            self.synchronize()
+            record = torch.profiler.record_function(f"{direction}: {name}")
+            record.__enter__()
+            self.layer_start_times[(name, direction)] = (time.perf_counter(), record)
+        return start_hook
+
+    def make_end_hook(self, name, direction):
+        def end_hook(*args):
+            if (name, direction) not in self.layer_start_times:
+                return
+            self.synchronize()
+            start_time, record = self.layer_start_times.pop((name, direction))
+            record.__exit__(None, None, None)
+            # Only the batches after the first (which includes one-time setup) are counted
+            if self.num_profiled_batches >= PROFILE_WAIT_BATCHES:
+                layer_times = self.layer_times.setdefault(name, {"forward_s": 0.0, "backward_s": 0.0, "batches": 0})
+                layer_times[f"{direction}_s"] += time.perf_counter() - start_time
+                if direction == "forward":
+                    layer_times["batches"] += 1
+        return end_hook
+
+    def end_epoch(self, **labels):
+        """
+        Summarizes the batches since the last call (e.g., one epoch of one
+        fold, labelled by fold=..., epoch=...) and rewrites the metrics file
+        """
+        if not self.is_active() or not self.batches:
+            return
+        data_wait = sum(batch["data_wait_s"] for batch in self.batches)
+        compute = sum(batch["compute_s"] for batch in self.batches)
+        num_inputs = sum(batch["batch_size"] for batch in self.batches)
+        wait_fraction = data_wait / max(data_wait + compute, 1e-9)
+        epoch = dict(labels)
+        epoch.update({
+            "num_batches": len(self.batches),
+            "num_inputs": num_inputs,
+            "data_wait_s": data_wait,
+            "compute_s": compute,
+            "samples_per_sec": num_inputs / max(data_wait + compute, 1e-9),
+            "data_wait_fraction": wait_fraction,
+            "bound": "I/O-bound" if wait_fraction > IO_BOUND_FRACTION else "compute-bound",
+            "max_rss_mb": get_max_rss_mb(),
+            "batches": self.batches,
+        })
+        self.epochs.append(epoch)
+        self.batches = []
+        print(f"Profiled {epoch['num_batches']} batches: {data_wait:.2f}s waiting on data, {compute:.2f}s training "
+              f"({wait_fraction:.1%} waiting, {epoch['bound']}), {epoch['samples_per_sec']:.1f} samples/sec")
+        self.write()
+
+    def write(self):
+        memory = {"max_rss_mb": get_max_rss_mb()}
+        if self.device.type == "cuda":
+            memory["cuda_max_allocated_mb"] = torch.cuda.max_memory_allocated(self.device) / 2**20
+            memory["cuda_max_reserved_mb"] = torch.cuda.max_memory_reserved(self.device) / 2**20
+        layers = {name: {"forward_ms": times["forward_s"] / times["batches"] * 1000,
+                         "backward_ms": times["backward_s"] / times["batches"] * 1000,
+                         "batches": times["batches"]}
+                  for name, times in self.layer_times.items() if times["batches"] > 0}
+        metrics = {
+            "device": str(self.device),
+            "memory": memory,
+            "layers": layers,
+            "trace_path": self.trace_path if self.trace_exported else None,
+            "epochs": self.epochs,
+        }
+        atomic_write(self.metrics_path, lambda temp_path: write_json(temp_path, metrics))
@@ -0,0 +1,266 @@
+# benchmark_create_grid.py
+# This is a pytest-benchmark suite that benchmarks the different ways
+# create_grid can compute the grid cells (masking the gates once per cell vs.
+# the single pass kernel, which is compiled if numba is installed, each with
+# and without planar distances). By default it builds synthetic radars (see
+# synthetic_radar.py) and times create_grid across grid specs, numbers of
+# radars, and the fraction of gates with data, also recording the peak memory
+# of each call (measured with tracemalloc), the fraction of cells filled, and
+# the maximum difference from the original grid in each benchmark's
+# extra_info. Run as a script, it is a thin wrapper around pytest that writes
+# the results to JSON and compares them against an earlier run to catch
+# regressions between commits.
+# Author: Team Celestial Blue
+# Spring 2025
+# Usage: python -m pytest radars/benchmark_create_grid.py [pytest-benchmark options]
+#    or: python benchmark_create_grid.py [-radar_file FILE] [-o OUTPUT_JSON] [-compare OLD_JSON]
+#       -radar_file: Benchmark with copies of a real radar file rather than
+#                    synthetic radars
+#       -o: Write the results to OUTPUT_JSON
+#       -compare: Print the change in time and memory of each case from OLD_JSON
+
+import copy
+import functools
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+import numpy as np
+import pytest
+import quiet_pyart as pyart
+from create_grid import create_grid
+from grid_kernel import NUMBA_AVAILABLE
+from synthetic_radar import make_synthetic_radar
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+# Append to sys path to import grid_config
+sys.path.append(os.path.join(DIRNAME, ".."))
+
+from grid_config.grid_spec import GRID_SPECS
+
+NUM_REPEATS = 3
+GRID_SPEC_NAMES = ["low_res", "full"]
+NUM_RADARS_LIST = [1, 2, 5]
+COVERAGES = [0.1, 0.5, 1.0]
+
+# Set by -radar_file to benchmark with copies of a real radar file
+RADAR_FILE_VARIABLE = "BENCHMARK_RADAR_FILE"
+RADAR_FILE = os.environ.get(RADAR_FILE_VARIABLE)
+
+# The synthetic radars are placed in a ring this many degrees from the grid
+SYNTHETIC_RADAR_DISTANCE = 0.5
+SYNTHETIC_GRID_ORIGIN = (1500.0, 36.5, -97.5)
+
+# The different ways of calling create_grid, all compared to the first
+METHODS = {
+    "masks": dict(),
+    "masks_planar": dict(planar_distance=True),
+    "kernel": dict(use_kernel=True),
+    "kernel_planar": dict(use_kernel=True, planar_distance=True),
+}
+
+
+def usage():
+    print(f"Usage: python {sys.argv[0]} [-radar_file FILE] [-o OUTPUT_JSON] [-compare OLD_JSON]")
+    exit(1)
+
+
+def call_create_grid(radars, grid_spec, grid_origin, **kwargs):
+    return create_grid(radars=radars,
+        grid_shape=grid_spec.grid_shape,
+        alt_range=grid_spec.alt_range,
+        lat_range=grid_spec.lat_range,
+        lon_range=grid_spec.lon_range,
+        grid_origin=grid_origin,
+        fields=list(grid_spec.fields),
+        **kwargs)
+
+
+def get_peak_memory(radars, grid_spec, grid_origin, **kwargs):
+    """
+    Calls create_grid once with tracemalloc running (which slows it down, so
+    it is not timed)
+    Returns:
+        The peak memory (in bytes) allocated during the call
+    """
+    tracemalloc.start()
+    call_create_grid(radars, grid_spec, grid_origin, **kwargs)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak_memory
+
+
+def max_abs_difference(grid, expected_grid, fields):
+    """
+    Returns the maximum absolute difference between the fields of two grids
+    (or inf if they do not have nan values in the same cells)
+    """
+    max_diff = 0.0
+    for f in fields:
+        expected = expected_grid[f].values
+        actual = grid[f].values
+        if not np.array_equal(np.isnan(expected), np.isnan(actual)):
+            return np.inf
+        if np.all(np.isnan(expected)):
+            continue
+        max_diff = max(max_diff, float(np.nanmax(np.abs(expected - actual))))
+    return max_diff
+
+
+# Only the radars of one coverage are kept, since 5 full size synthetic
+# radars take ~1GB (the benchmarks of each coverage run together)
+@functools.lru_cache(maxsize=1)
+def make_synthetic_radars(num_radars, coverage):
+    """
+    Builds num_radars synthetic radars evenly spaced in a ring around the
+    synthetic grid origin
+    """
+    _, origin_lat, origin_lon = SYNTHETIC_GRID_ORIGIN
+    radars = []
+    for i in range(num_radars):
+        angle = 2 * np.pi * i / num_radars
+        radars.append(make_synthetic_radar(
+            coverage=coverage,
+            latitude=origin_lat + SYNTHETIC_RADAR_DISTANCE * np.sin(angle),
+            longitude=origin_lon + SYNTHETIC_RADAR_DISTANCE * np.cos(angle),
+            seed=i))
+    return tuple(radars)
+
+
+@functools.lru_cache(maxsize=1)
+def read_radar_file(radar_file):
+    return pyart.io.read_nexrad_archive(radar_file)
+
+
+def get_radars(num_radars, coverage):
+    """
+    Returns the radars and grid origin of a case: the first num_radars
+    synthetic radars with coverage, or num_radars copies of RADAR_FILE
+    """
+    if RADAR_FILE is not None:
+        radar = read_radar_file(RADAR_FILE)
+        # Grid around a point ~15km from the radar at ~5000ft, where most cells
+        # contain gates
+        grid_origin = (1500.0, float(radar.latitude['data'][0]) + 0.1,
+                       float(radar.longitude['data'][0]) + 0.1)
+        # Shallow copies share the (read only) data of the radar, so that 5 of
+        # them fit in memory
+        return tuple(copy.copy(radar) for _ in range(num_radars)), grid_origin
+    return make_synthetic_radars(max(NUM_RADARS_LIST), coverage)[:num_radars], SYNTHETIC_GRID_ORIGIN
+
+
+@functools.lru_cache(maxsize=1)
+def get_expected_grid(grid_spec_name, num_radars, coverage):
+    """
+    Returns the grid of the original method for a case (cached, since every
+    method of a case is compared to it)
+    """
+    radars, grid_origin = get_radars(num_radars, coverage)
+    return call_create_grid(radars, GRID_SPECS[grid_spec_name], grid_origin)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def compile_kernel():
+    if NUMBA_AVAILABLE:
+        # Compile the kernel before timing it
+        call_create_grid(make_synthetic_radar(ngates=10, rays_per_sweep=10, nsweeps=2),
+                         GRID_SPECS["low_res"], SYNTHETIC_GRID_ORIGIN, use_kernel=True)
+
+
+# Ordered so the benchmarks of each case run together, followed by each
+# coverage in turn (the coverage of a real radar file is whatever it is)
+@pytest.mark.parametrize("method", list(METHODS))
+@pytest.mark.parametrize("grid_spec_name", GRID_SPEC_NAMES)
+@pytest.mark.parametrize("num_radars", NUM_RADARS_LIST)
+@pytest.mark.parametrize("coverage", COVERAGES if RADAR_FILE is None else [None])
+def test_create_grid(benchmark, method, grid_spec_name, num_radars, coverage):
+    radars, grid_origin = get_radars(num_radars, coverage)
+    grid_spec = GRID_SPECS[grid_spec_name]
+    kwargs = METHODS[method]
+    # The gate lat/lon/alts are computed lazily on first access, so make the
+    # untimed call that produces the grid to compare against first
+    expected_grid = get_expected_grid(grid_spec_name, num_radars, coverage)
+
+    grid = benchmark.pedantic(call_create_grid, args=(radars, grid_spec, grid_origin), kwargs=kwargs,
+                              rounds=NUM_REPEATS, iterations=1)
+
+    benchmark.extra_info["numba"] = NUMBA_AVAILABLE
+    benchmark.extra_info["radar_file"] = os.path.basename(RADAR_FILE) if RADAR_FILE is not None else None
+    benchmark.extra_info["gates_per_radar"] = int(radars[0].fields['reflectivity']['data'].size)
+    benchmark.extra_info["peak_memory_mb"] = get_peak_memory(radars, grid_spec, grid_origin, **kwargs) / 2**20
+    benchmark.extra_info["filled_fraction"] = \
+        float(expected_grid['reflectivity'].notnull().mean()) if expected_grid else 0.0
+    benchmark.extra_info["max_diff"] = \
+        max_abs_difference(grid, expected_grid, grid_spec.fields) if expected_grid else 0.0
+
+
+def get_case_key(benchmark):
+    params = benchmark["params"]
+    return (params["method"], benchmark["extra_info"]["radar_file"], params["grid_spec_name"],
+            params["num_radars"], params["coverage"])
+
+
+def compare_results(results_path, old_results_path):
+    """
+    Prints the ratio of the mean time and peak memory of each benchmark to the
+    matching benchmark in an earlier JSON output (from -o or --benchmark-json)
+    """
+    with open(results_path) as results_file:
+        results = json.load(results_file)
+    with open(old_results_path) as old_results_file:
+        old_results = json.load(old_results_file)
+    print(f"\nComparing to {old_results_path} (commit {old_results['commit_info'].get('id')})")
+    old_by_key = {get_case_key(b): b for b in old_results["benchmarks"]}
+    for benchmark in results["benchmarks"]:
+        old = old_by_key.get(get_case_key(benchmark))
+        if old is None:
+            continue
+        params = benchmark["params"]
+        time_ratio = benchmark["stats"]["mean"] / old["stats"]["mean"]
+        memory_ratio = benchmark["extra_info"]["peak_memory_mb"] / old["extra_info"]["peak_memory_mb"]
+        flag = "  <-- slower" if time_ratio > 1.2 else ""
+        print(f"{params['method']:<15}{params['grid_spec_name']:>9}{params['num_radars']:>4}"
+              f"{str(params['coverage']):>6}   time: {time_ratio:>5.2f}x   memory: {memory_ratio:>5.2f}x{flag}")
+
+
+def main():
+    radar_file = output_path = old_results_path = None
+    i = 1
+    while i < len(sys.argv):
+        if i + 1 >= len(sys.argv):
+            usage()
+        if sys.argv[i] == "-radar_file":
+            radar_file = sys.argv[i + 1]
+        elif sys.argv[i] == "-o":
+            output_path = sys.argv[i + 1]
+        elif sys.argv[i] == "-compare":
+            old_results_path = sys.argv[i + 1]
+        else:
+            usage()
+        i += 2
+
+    if radar_file is not None:
+        # The cases are parametrized when pytest imports this file, so the
+        # radar file is passed in the environment
+        os.environ[RADAR_FILE_VARIABLE] = os.path.abspath(radar_file)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # The results are compared from JSON, so write them somewhere even
+        # without -o
+        results_path = output_path or os.path.join(temp_dir, "results.json")
+        exit_code = pytest.main([os.path.abspath(__file__), "-q", "-p", "no:cacheprovider",
+                                 f"--benchmark-json={results_path}",
+                                 "--benchmark-columns=mean,stddev,min,max,rounds",
+                                 "--benchmark-group-by=param:grid_spec_name,param:num_radars,param:coverage",
+                                 "--benchmark-sort=name"])
+        if exit_code != 0:
+            exit(int(exit_code))
+        if output_path is not None:
+            print(f"Wrote results to {output_path}")
+        if old_results_path is not None:
+            compare_results(results_path, old_results_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,10 @@ import inspect
 from typing import Union
 import xarray as xr
 import quiet_pyart as pyart
+from grid_kernel import NUMBA_AVAILABLE, accumulate_grid, get_cell_indices
+
+# Mean radius of the earth (in meters), the same value haversine uses
+EARTH_RADIUS_METERS = 6371008.8
 
 
 def get_barnes2_weights(dist2: np.typing.ArrayLike, r2: np.float32) -> np.typing.ArrayLike:
@@ -32,6 +36,50 @@ def get_barnes2_weights(dist2: np.typing.ArrayLike, r2: np.float32) -> np.typing
     return np.exp(-dist2 / (r2 / 4)) + 1e-5
 
 
+def get_meters_per_degree(origin_lat: np.float64) -> tuple[np.float64, np.float64]:
+    """
+    Determines the number of meters per degree of latitude and longitude
+    for an equirectangular projection about the latitude origin_lat
+    Parameters:
+        origin_lat -- The latitude (in degrees) to center the projection on
+    Returns:
+        A 2-tuple (meters per degree latitude, meters per degree longitude)
+    """
+    meters_per_deg_lat = EARTH_RADIUS_METERS * math.pi / 180
+    meters_per_deg_lon = meters_per_deg_lat * math.cos(math.radians(origin_lat))
+    return meters_per_deg_lat, meters_per_deg_lon
+
+
+def project_to_local_enu(
+    lat: np.typing.ArrayLike,
+    lon: np.typing.ArrayLike,
+    alt: np.typing.ArrayLike,
+    origin: tuple[float, float, float]
+) -> tuple[np.typing.NDArray, np.typing.NDArray, np.typing.NDArray]:
+    """
+    Projects lat/lon/alt points into local east/north/up offsets (in meters)
+    about origin using an equirectangular approximation. Within a 0.25 degree
+    box, distances between a gate and the center of its grid cell computed
+    from these offsets are within 0.25% of the haversine distance for all
+    CONUS latitudes (the error grows with latitude), i.e., within 1.5m for
+    the cells of the full 16x16 grid (see test_create_grid.py)
+    Parameters:
+        lat -- The latitudes (in degrees) of the points to project
+        lon -- The longitudes (in degrees) of the points to project
+        alt -- The altitudes (in meters) of the points to project
+        origin -- (alt, lat, lon) A 3-tuple representing the origin of the
+            projection. alt should be in meters and lat/lon in degrees
+    Returns:
+        A 3-tuple (east, north, up) of arrays of offsets in meters from origin
+    """
+    origin_alt, origin_lat, origin_lon = origin
+    meters_per_deg_lat, meters_per_deg_lon = get_meters_per_degree(origin_lat)
+    east = (np.asarray(lon, dtype=np.float64) - origin_lon) * meters_per_deg_lon
+    north = (np.asarray(lat, dtype=np.float64) - origin_lat) * meters_per_deg_lat
+    up = np.asarray(alt, dtype=np.float64) - origin_alt
+    return east, north, up
+
+
 def initialize_mask(min : np.int64, max : np.int64, values : np.typing.ArrayLike)\
     -> np.typing.ArrayLike:
     """
@@ -94,6 +142,8 @@ def create_grid(
     grid_origin : tuple[float, float, float], 
     fields : list[str] = ["reflectivity"],
     map_roi : bool = False,
+    planar_distance : bool = False,
+    use_kernel : bool = False,
     verbose : bool = False
 ) -> dict:
     """
@@ -113,11 +163,21 @@ def create_grid(
             to grid around the grid_origin
         grid_origin -- (alt, lat, lon) A 3-tuple representing the origin of
             the grid. alt should be in meters and lat/lon in degrees
-        fields -- A list of all fields of the radar object to grid
+        fields -- A list of all fields of the radar object to grid. All fields
+            share the same assignment of gates to cells and Barnes2 weights.
+            Gates where a field is masked are left out of that field's average
         map_roi -- A bool indicating whether or not to return the radius of
             influence used for each grid cell as part of the output grid
             (note that these roi's are not actually used for gridding, but
             rather only for the weighted average)
+        planar_distance -- A bool indicating whether to compute the Barnes2
+            distances from gates projected once into local east/north/up
+            meters about grid_origin (see project_to_local_enu) rather than
+            calling haversine for every grid cell
+        use_kernel -- A bool indicating whether to compute every grid cell in a
+            single pass over the gates (compiled with numba if it is
+            installed, see grid_kernel.py) rather than masking the gates once
+            per grid cell. The resulting grid is float32
         verbose -- A bool indicating we should print verbose logging messages
 
     Returns:
@@ -219,7 +279,9 @@ def create_grid(
         gate_lat[start_idx:end_idx] = radar.gate_latitude['data'].ravel()[curr_radar_mask]
         gate_alt[start_idx:end_idx] = radar.gate_altitude['data'].ravel()[curr_radar_mask]
         for j, f in enumerate(fields):
-            field_data[j][start_idx:end_idx] = radar.fields[f]['data'].ravel()[curr_radar_mask]
+            # Values that are masked in a field (e.g., velocity at gates with
+            # no velocity estimate) are stored as nan so they are not averaged
+            field_data[j][start_idx:end_idx] = np.ma.filled(radar.fields[f]['data'].ravel()[curr_radar_mask], np.nan)
 
 
     # Find center of initial grid cell
@@ -232,88 +294,159 @@ def create_grid(
     lon_step = (lon_stop - lon_start) / n_lon
     center_lon_start = lon_start + lon_step / 2  # on edge, so move start to center
 
-    verboseprint("Initializing masks to find which data resides in which cells")
-    lon_masks = initialize_masks(n_lon, center_lon_start, lon_step, grid_origin_lon, gate_lon)
-    lat_masks = initialize_masks(n_lat, center_lat_start, lat_step, grid_origin_lat, gate_lat)
-    alt_masks = initialize_masks(n_alt, center_alt_start, alt_step, grid_origin_alt, gate_alt)
-    most_of_mask = np.empty(filtered_arr_length, dtype=bool)
-
-    num_nan = 0
-    verboseprint("Beginning to calculate grid cells")
-    for iz, iy, ix in np.ndindex(n_alt, n_lat, n_lon):
-        # Calculate the grid point
-        lon = center_lon_start + lon_step * ix
-        lat = center_lat_start + lat_step * iy
-        alt = center_alt_start + alt_step * iz
-
-        lon_max = lon + lon_step / 2
-        lat_max = lat + lat_step / 2
-        alt_max = alt + alt_step / 2
-
-        # Finds the absolute lon, lat and altitude (e.g., 37.82 vs. -0.125)
-        absolute_lon = lon + grid_origin_lon
-        absolute_lat = lat + grid_origin_lat
-        absolute_alt = alt + grid_origin_alt
-
-        absolute_lon_max = lon_max + grid_origin_lon
-        absolute_lat_max = lat_max + grid_origin_lat
-        absolute_alt_max = alt_max + grid_origin_alt
-
-        # Determine distance to furthest point in grid (corner)
-        xy_dist = (haversine((absolute_lat, absolute_lon), (absolute_lat_max, absolute_lon_max), unit='m'))
-
-        # Store the total distance squared for Barnes2 weighting algorithm later
-        r2 = xy_dist ** 2 + (absolute_alt_max - absolute_alt) ** 2
+    # If requested, project every gate into local meters about the origin once
+    # so that no trig is needed per grid cell. In this projection the distance
+    # from the center of a cell to its corner is the same for every cell
+    if planar_distance:
+        verboseprint("Projecting gates into local ENU meters about the grid origin")
+        gate_x, gate_y, gate_z = project_to_local_enu(gate_lat, gate_lon, gate_alt, grid_origin)
+        meters_per_deg_lat, meters_per_deg_lon = get_meters_per_degree(grid_origin_lat)
+        planar_r2 = (lon_step / 2 * meters_per_deg_lon) ** 2 + \
+            (lat_step / 2 * meters_per_deg_lat) ** 2 + (alt_step / 2) ** 2
+
+    ncells = n_alt * n_lat * n_lon
+    if use_kernel:
+        verboseprint(f"Calculating grid cells in one pass over the gates (numba: {NUMBA_AVAILABLE})")
+        # Find which cell each gate is in
+        lon_idx = get_cell_indices(gate_lon, absolute_lon_start, lon_step, n_lon)
+        lat_idx = get_cell_indices(gate_lat, absolute_lat_start, lat_step, n_lat)
+        alt_idx = get_cell_indices(gate_alt, absolute_alt_start, alt_step, n_alt)
+        cell_idx = (alt_idx * n_lat + lat_idx) * n_lon + lon_idx
+
+        # Find the centers of the cells (as offsets from the origin)
+        cell_lons = center_lon_start + lon_step * np.arange(n_lon)
+        cell_lats = center_lat_start + lat_step * np.arange(n_lat)
+        cell_alts = center_alt_start + alt_step * np.arange(n_alt)
+
+        # Calculate the distance squared from each gate to the center of its
+        # cell, and from the center of each cell to its corner
+        if planar_distance:
+            dist2 = (gate_x - cell_lons[lon_idx] * meters_per_deg_lon) ** 2 + \
+                (gate_y - cell_lats[lat_idx] * meters_per_deg_lat) ** 2 + \
+                (gate_z - cell_alts[alt_idx]) ** 2
+            cell_r2 = np.full(ncells, planar_r2, dtype=np.float64)
+        else:
+            gate_cell_centers = np.column_stack((cell_lats[lat_idx] + grid_origin_lat,
+                                                 cell_lons[lon_idx] + grid_origin_lon))
+            pt_xy_dist = haversine_vector(gate_cell_centers, np.column_stack((gate_lat, gate_lon)), unit='m')
+            dist2 = pt_xy_dist ** 2 + (gate_alt - (cell_alts[alt_idx] + grid_origin_alt)) ** 2
+
+            # The distance from the center of a cell to its corner only depends
+            # on the latitude of the cell
+            row_centers = np.column_stack((cell_lats + grid_origin_lat,
+                                           np.full(n_lat, grid_origin_lon)))
+            row_corners = np.column_stack((cell_lats + lat_step / 2 + grid_origin_lat,
+                                           np.full(n_lat, grid_origin_lon + lon_step / 2)))
+            row_xy_dist = haversine_vector(row_centers, row_corners, unit='m')
+            cell_r2 = np.broadcast_to(row_xy_dist[np.newaxis, :, np.newaxis] ** 2 + (alt_step / 2) ** 2,
+                                      (n_alt, n_lat, n_lon)).ravel()
+
+        grid_data = accumulate_grid(cell_idx, dist2, cell_r2, field_data, ncells)
+        grid_data = grid_data.reshape(n_alt, n_lat, n_lon, nfields)
         if map_roi:
-            roi[iz, iy, ix] = math.sqrt(r2)
+            roi = np.sqrt(cell_r2).reshape(n_alt, n_lat, n_lon)
+        num_nan = np.count_nonzero(np.isnan(grid_data[..., 0]))
+    else:
+        verboseprint("Initializing masks to find which data resides in which cells")
+        lon_masks = initialize_masks(n_lon, center_lon_start, lon_step, grid_origin_lon, gate_lon)
+        lat_masks = initialize_masks(n_lat, center_lat_start, lat_step, grid_origin_lat, gate_lat)
+        alt_masks = initialize_masks(n_alt, center_alt_start, alt_step, grid_origin_alt, gate_alt)
+        most_of_mask = np.empty(filtered_arr_length, dtype=bool)
+
+        num_nan = 0
+        verboseprint("Beginning to calculate grid cells")
+        for iz, iy, ix in np.ndindex(n_alt, n_lat, n_lon):
+            # Calculate the grid point
+            lon = center_lon_start + lon_step * ix
+            lat = center_lat_start + lat_step * iy
+            alt = center_alt_start + alt_step * iz
+
+            lon_max = lon + lon_step / 2
+            lat_max = lat + lat_step / 2
+            alt_max = alt + alt_step / 2
+
+            # Finds the absolute lon, lat and altitude (e.g., 37.82 vs. -0.125)
+            absolute_lon = lon + grid_origin_lon
+            absolute_lat = lat + grid_origin_lat
+            absolute_alt = alt + grid_origin_alt
+
+            absolute_lon_max = lon_max + grid_origin_lon
+            absolute_lat_max = lat_max + grid_origin_lat
+            absolute_alt_max = alt_max + grid_origin_alt
+
+            if planar_distance:
+                r2 = planar_r2
+            else:
+                # Determine distance to furthest point in grid (corner)
+                xy_dist = (haversine((absolute_lat, absolute_lon), (absolute_lat_max, absolute_lon_max), unit='m'))
+
+                # Store the total distance squared for Barnes2 weighting algorithm later
+                r2 = xy_dist ** 2 + (absolute_alt_max - absolute_alt) ** 2
+            if map_roi:
+                roi[iz, iy, ix] = math.sqrt(r2)
         
-        # If the x index has reset to 0, recompute most of the mask as at least
-        # one of iy or iz has changed (optimization)
-        if ix == 0:
-            most_of_mask = lat_masks[iy] & alt_masks[iz]
-
-        # Compute the mask for which indices are in the cell
-        in_cell_mask = lon_masks[ix] & most_of_mask
-
-        total_pts = 0
-        # If there are any points inside the current cell
-        if np.any(in_cell_mask):
-            # Store the relevant lats, lons, and alts for the points in cell
-            rel_gate_lats = gate_lat[in_cell_mask]
-            rel_gate_lons = gate_lon[in_cell_mask]
-            rel_gate_alts = gate_alt[in_cell_mask]
-
-            # Determine how many points are in the cell
-            total_pts = rel_gate_lats.shape[0]
-
-            # Create an array of the lat/lon points in the cell, e.g., if the
-            # cell contains the lat pts [1, 2] and lon pts [3, 4], this results
-            # in the array: [[1, 3], [2, 4]]
-            lat_lon_pts_in_cell = np.column_stack((rel_gate_lats, rel_gate_lons))
+            # If the x index has reset to 0, recompute most of the mask as at least
+            # one of iy or iz has changed (optimization)
+            if ix == 0:
+                most_of_mask = lat_masks[iy] & alt_masks[iz]
+
+            # Compute the mask for which indices are in the cell
+            in_cell_mask = lon_masks[ix] & most_of_mask
+
+            total_pts = 0
+            # If there are any points inside the current cell
+            if np.any(in_cell_mask):
+                if planar_distance:
+                    # The cell center in projected coordinates is just its offset
+                    # from the origin scaled to meters
+                    dist2 = (gate_x[in_cell_mask] - lon * meters_per_deg_lon) ** 2 + \
+                        (gate_y[in_cell_mask] - lat * meters_per_deg_lat) ** 2 + \
+                        (gate_z[in_cell_mask] - alt) ** 2
+                    total_pts = dist2.shape[0]
+                else:
+                    # Store the relevant lats, lons, and alts for the points in cell
+                    rel_gate_lats = gate_lat[in_cell_mask]
+                    rel_gate_lons = gate_lon[in_cell_mask]
+                    rel_gate_alts = gate_alt[in_cell_mask]
+
+                    # Determine how many points are in the cell
+                    total_pts = rel_gate_lats.shape[0]
+
+                    # Create an array of the lat/lon points in the cell, e.g., if the
+                    # cell contains the lat pts [1, 2] and lon pts [3, 4], this results
+                    # in the array: [[1, 3], [2, 4]]
+                    lat_lon_pts_in_cell = np.column_stack((rel_gate_lats, rel_gate_lons))
             
-            # Store the center of the cell (lat, lon) in an array
-            center_of_cell = np.full((total_pts, 2), (absolute_lat, absolute_lon), dtype=np.float64)
+                    # Store the center of the cell (lat, lon) in an array
+                    center_of_cell = np.full((total_pts, 2), (absolute_lat, absolute_lon), dtype=np.float64)
             
-            # Calc the xy distance from the center to all pts in cell (in m)
-            pt_xy_dist = haversine_vector(center_of_cell, lat_lon_pts_in_cell, unit='m')
+                    # Calc the xy distance from the center to all pts in cell (in m)
+                    pt_xy_dist = haversine_vector(center_of_cell, lat_lon_pts_in_cell, unit='m')
             
-            # Calc the total distance (incl. vertical) for pts in cell w/ pythag
-            pt_total_dist = np.sqrt(pt_xy_dist ** 2 + (rel_gate_alts - absolute_alt) ** 2)
+                    # Calc the total distance (incl. vertical) for pts in cell w/ pythag
+                    pt_total_dist = np.sqrt(pt_xy_dist ** 2 + (rel_gate_alts - absolute_alt) ** 2)
             
-            # Store the dists^2 for use in the Barnes2 weighting algo
-            dist2 = pt_total_dist ** 2
-
-            # Calculate the weights using Barnes2
-            weights = get_barnes2_weights(dist2, r2)
-            for i, f in enumerate(fields):
-                grid_data[iz, iy, ix, i] = np.average(field_data[i][in_cell_mask], weights=weights, axis=0)
-        else:
-            grid_data[iz, iy, ix] = np.nan
-            num_nan += 1
-
-        # (Possibly) print useful logging message about current cell
-        # val_str = ', '.join([f"{field}: {val:>6.2f}" for field, val in zip(fields, grid_data[iz, iy, ix].tolist())])
-        # verboseprint(f"Cell ({ix:>2}, {iy:>2}, {iz:>2}): pts in cell: {total_pts:>3} | value(s): [{val_str}] | (Lon: {absolute_lon:.2f}°, Lat: {absolute_lat:.2f}°, Alt: {absolute_alt:.2f}m)")
+                    # Store the dists^2 for use in the Barnes2 weighting algo
+                    dist2 = pt_total_dist ** 2
+
+                # Calculate the weights using Barnes2
+                weights = get_barnes2_weights(dist2, r2)
+
+                # Compute the weighted average of every field at once, only
+                # including the values of each field that are not nan
+                cell_field_data = field_data[:, in_cell_mask]
+                valid = ~np.isnan(cell_field_data)
+                weighted_sums = np.where(valid, cell_field_data, 0) @ weights
+                weight_sums = valid @ weights
+                grid_data[iz, iy, ix] = np.divide(weighted_sums, weight_sums,
+                    out=np.full(nfields, np.nan), where=weight_sums > 0)
+            else:
+                grid_data[iz, iy, ix] = np.nan
+                num_nan += 1
+
+            # (Possibly) print useful logging message about current cell
+            # val_str = ', '.join([f"{field}: {val:>6.2f}" for field, val in zip(fields, grid_data[iz, iy, ix].tolist())])
+            # verboseprint(f"Cell ({ix:>2}, {iy:>2}, {iz:>2}): pts in cell: {total_pts:>3} | value(s): [{val_str}] | (Lon: {absolute_lon:.2f}°, Lat: {absolute_lat:.2f}°, Alt: {absolute_alt:.2f}m)")
     verboseprint(f"Finished calculating values for grid cells, {num_nan}/{n_alt * n_lon * n_lat} are nan")
     verboseprint("Converting grid to dictionary")
 
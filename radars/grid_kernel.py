@@ -0,0 +1,122 @@
+# grid_kernel.py
+# This python file exports the functions used by create_grid to compute every
+# grid cell in a single pass over the gates (rather than one masked pass per
+# cell). If numba is installed the pass is compiled, otherwise an equivalent
+# pure-numpy version using np.bincount is used.
+# Author: Team Celestial Blue
+# Spring 2025
+
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+def get_cell_indices(
+    values: np.typing.NDArray,
+    absolute_start: np.float64,
+    step: np.float64,
+    n: np.int64
+) -> np.typing.NDArray:
+    """
+    Determines which cell along one dimension of the grid each value is in
+    Parameters:
+        values -- The values (e.g., gate longitudes) to find the cells of
+        absolute_start -- The absolute value of the edge of the first cell
+            (e.g., the longitude of the western edge of the grid)
+        step -- The size of a grid cell in this dimension
+        n -- The number of cells in this dimension
+    Returns:
+        An int64 array of the same shape as values where each entry is the
+        index (0 <= index < n) of the cell the corresponding value is in
+    """
+    indices = np.floor((values - absolute_start) / step).astype(np.int64)
+    # Values within floating point error of the far edge belong to the last cell
+    return np.clip(indices, 0, n - 1)
+
+
+def _accumulate_grid_numpy(
+    cell_idx: np.typing.NDArray,
+    dist2: np.typing.NDArray,
+    cell_r2: np.typing.NDArray,
+    field_data: np.typing.NDArray,
+    ncells: np.int64
+) -> tuple[np.typing.NDArray, np.typing.NDArray]:
+    """
+    Pure-numpy version of the single pass, see accumulate_grid
+    """
+    nfields = field_data.shape[0]
+    weights = np.exp(-dist2 / (cell_r2[cell_idx] / 4)) + 1e-5
+    weighted_sums = np.empty((ncells, nfields), dtype=np.float64)
+    weight_sums = np.empty((ncells, nfields), dtype=np.float64)
+    for i in range(nfields):
+        valid = ~np.isnan(field_data[i])
+        field_weights = np.where(valid, weights, 0)
+        weight_sums[:, i] = np.bincount(cell_idx, weights=field_weights, minlength=ncells)
+        weighted_sums[:, i] = np.bincount(cell_idx, minlength=ncells,
+            weights=field_weights * np.where(valid, field_data[i], 0))
+    return weighted_sums, weight_sums
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _accumulate_grid_numba(cell_idx, dist2, cell_r2, field_data, ncells):
+        """
+        Compiled version of the single pass, see accumulate_grid
+        """
+        nfields = field_data.shape[0]
+        weighted_sums = np.zeros((ncells, nfields), dtype=np.float64)
+        weight_sums = np.zeros((ncells, nfields), dtype=np.float64)
+        for g in range(cell_idx.shape[0]):
+            c = cell_idx[g]
+            w = np.exp(-dist2[g] / (cell_r2[c] / 4)) + 1e-5
+            for i in range(nfields):
+                value = field_data[i, g]
+                if not np.isnan(value):
+                    weighted_sums[c, i] += w * value
+                    weight_sums[c, i] += w
+        return weighted_sums, weight_sums
+
+
+def accumulate_grid(
+    cell_idx: np.typing.NDArray,
+    dist2: np.typing.NDArray,
+    cell_r2: np.typing.NDArray,
+    field_data: np.typing.NDArray,
+    ncells: np.int64,
+    use_numba: bool = True
+) -> np.typing.NDArray:
+    """
+    In one pass over the gates, accumulates the Barnes2 weighted sum of each
+    field and the sum of the weights for every grid cell, then divides them to
+    find the weighted average of each field in each cell. Every field shares
+    the same weight for a gate, but nan values of a field are left out of
+    that field's sums
+    Parameters:
+        cell_idx -- An int64 array of the flat index of the cell each gate is in
+        dist2 -- An array of the distance squared from each gate to the
+            center of the cell it is in
+        cell_r2 -- An array of length ncells of the distance squared from the
+            center of each cell to its corner
+        field_data -- An array of shape (nfields, ngates) of the field values
+        ncells -- The total number of cells in the grid
+        use_numba -- A bool indicating whether to use the compiled kernel
+            (ignored if numba is not installed)
+    Returns:
+        A float32 array of shape (ncells, nfields) of the weighted average of
+        each field in each cell, which is nan for cells without any gates
+        (or without any valid values of that field)
+    """
+    if use_numba and NUMBA_AVAILABLE:
+        weighted_sums, weight_sums = _accumulate_grid_numba(
+            cell_idx, dist2, cell_r2, field_data, ncells)
+    else:
+        weighted_sums, weight_sums = _accumulate_grid_numpy(
+            cell_idx, dist2, cell_r2, field_data, ncells)
+
+    grid_data = np.full((ncells, field_data.shape[0]), np.nan, dtype=np.float32)
+    np.divide(weighted_sums, weight_sums, out=grid_data, where=weight_sums > 0, casting="unsafe")
+    return grid_data
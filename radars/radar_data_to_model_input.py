@@ -16,29 +16,18 @@ DIRNAME = os.path.dirname(sys.argv[0])
 sys.path.append(os.path.join(DIRNAME, ".."))
 
 from plane_weights.scale_turbulence import scale_turbulence
+from grid_config.grid_spec import DEFAULT_GRID_SPEC, get_grid_spec
 from get_radars_for_pirep import get_file_time
 
 
 def ft_to_meters(dist_in_ft):
     return dist_in_ft/3.281
 
-NUM_Z_POINTS = 10
-NUM_Y_POINTS = 16
-NUM_X_POINTS = 16
-grid_shape = (NUM_Z_POINTS, NUM_Y_POINTS, NUM_X_POINTS) # Number of points in the grid (z, y, x).
-
-# Determine grid limits
-DEGREES = 0.25
-Z_SIZE = 3048 # 3048m (10000 ft)
-alt_limits_meters = (-Z_SIZE/2.0, Z_SIZE/2.0)
-lat_limits_degrees = (-DEGREES/2.0, DEGREES/2.0)
-lon_limits_degrees = (-DEGREES/2.0, DEGREES/2.0)
-
 nexrad_sites_path = os.path.join(DIRNAME, "nexrad_sites.csv")
 nexrad_sites_df = pd.read_csv(nexrad_sites_path)
 
 
-def output_to_netcdf(pirep, output_dirname, num_inputs, verbose=False):
+def output_to_netcdf(pirep, output_dirname, num_inputs, grid_spec, verbose=False):
     radar_files = pirep['aws_files'].strip("[]").replace("'", "").replace(" ", "").split(',')
     radar = pyart.io.read_nexrad_archive(radar_files[0])
 
@@ -60,12 +49,12 @@ def output_to_netcdf(pirep, output_dirname, num_inputs, verbose=False):
     radar_t = get_file_time(radar_file, dt)
 
     grid = create_grid(radars=radar,
-        grid_shape=grid_shape,
-        alt_range=alt_limits_meters,
-        lat_range=lat_limits_degrees, 
-        lon_range=lon_limits_degrees,
+        grid_shape=grid_spec.grid_shape,
+        alt_range=grid_spec.alt_range,
+        lat_range=grid_spec.lat_range, 
+        lon_range=grid_spec.lon_range,
         grid_origin=pirep_location, 
-        fields=["reflectivity"],
+        fields=list(grid_spec.fields),
         map_roi=False,
         verbose=False)
 
@@ -89,6 +78,8 @@ def output_to_netcdf(pirep, output_dirname, num_inputs, verbose=False):
     attrs["ALT"] = pirep["FL"]
     attrs["DELTA_T"] = (pirep_t - radar_t).seconds
     attrs['TURB'] = scale_turbulence(pirep['turbulence_intensity'], pirep['Plane Weight'])
+    # Store the grid spec so the dataloader can check all inputs match
+    attrs.update(grid_spec.to_attrs())
     grid.attrs = attrs
 
     output_filename = f"{pirep.name:07}_{pirep_t.year}_{pirep_t.month}_df_row.nc"
@@ -101,26 +92,30 @@ def output_to_netcdf(pirep, output_dirname, num_inputs, verbose=False):
     
 
 def usage():
-    print(f"Error: Incorrect number of command line arguments. Expected 2 but got {len(sys.argv) - 1}")
-    print(f"Usage: python {sys.argv[0]} <input_file> <output_dir>")
+    print(f"Error: Incorrect number of command line arguments. Expected 2 or 3 but got {len(sys.argv) - 1}")
+    print(f"Usage: python {sys.argv[0]} <input_file> <output_dir> [grid_spec]")
+    print("grid_spec: Optionally the name of a grid spec in grid_config/grid_spec.py (e.g., full or low_res)")
+    print("           or a path to a JSON grid spec. Defaults to full")
     exit(1)
 
-if len(sys.argv) != 3:
+if len(sys.argv) not in (3, 4):
     usage()
 input_filename = sys.argv[1]
 output_dirname = sys.argv[2]
+grid_spec = get_grid_spec(sys.argv[3]) if len(sys.argv) == 4 else DEFAULT_GRID_SPEC
 
 print(f"Reading from file: {input_filename} and outputting to directory: {output_dirname}")
+print(f"Using grid spec: {grid_spec}")
 
 # Important to index_col=0 if reading just a part! - Otherwise remove
 pireps_df = pd.read_csv(input_filename, index_col=0)
 num_completed = 0
 
-def safe_output_to_netcdf(pirep, output_dirname, num_inputs):
+def safe_output_to_netcdf(pirep, output_dirname, num_inputs, grid_spec):
     try:
-        output_to_netcdf(pirep, output_dirname, num_inputs)
+        output_to_netcdf(pirep, output_dirname, num_inputs, grid_spec)
     except Exception as e:
         print(f"Error processing row {pirep.name}: {e}")
 
-pireps_df.apply(safe_output_to_netcdf, args=(output_dirname, len(pireps_df)), axis=1)
+pireps_df.apply(safe_output_to_netcdf, args=(output_dirname, len(pireps_df), grid_spec), axis=1)
 
@@ -0,0 +1,80 @@
+# synthetic_radar.py
+# This python file exports the function make_synthetic_radar, which builds a
+# PyART radar object filled with random data, for benchmarking create_grid
+# (and anything built on it) without needing to download NEXRAD files
+# Author: Team Celestial Blue
+# Spring 2025
+
+import numpy as np
+import quiet_pyart as pyart
+
+# Ranges of random values for each field, roughly the ranges seen in NEXRAD data
+FIELD_VALUE_RANGES = {
+    "reflectivity": (-10.0, 60.0),              # dBZ
+    "spectrum_width": (0.0, 15.0),              # m/s
+    "velocity": (-30.0, 30.0),                  # m/s
+    "differential_reflectivity": (-4.0, 8.0),   # dB
+}
+
+
+def make_synthetic_radar(
+    ngates: int = 720,
+    rays_per_sweep: int = 360,
+    nsweeps: int = 9,
+    coverage: float = 1.0,
+    latitude: float = 36.5,
+    longitude: float = -97.5,
+    max_range: float = 180000.0,
+    max_elevation: float = 19.5,
+    fields: list[str] = list(FIELD_VALUE_RANGES),
+    seed: int = 0
+) -> pyart.core.Radar:
+    """
+    Builds a PPI radar object with random field data
+    Parameters:
+        ngates -- The number of gates in each ray
+        rays_per_sweep -- The number of rays (evenly spaced azimuths) in each sweep
+        nsweeps -- The number of sweeps (elevation angles evenly spaced from
+            0.5 degrees to max_elevation)
+        coverage -- The fraction (0 to 1) of gates with valid data. The
+            remaining gates are masked in every field
+        latitude -- The latitude of the radar (in degrees)
+        longitude -- The longitude of the radar (in degrees)
+        max_range -- The range (in meters) of the last gate in each ray
+        max_elevation -- The elevation angle (in degrees) of the last sweep
+        fields -- The fields to fill with random data
+        seed -- The seed for the random data
+    Returns:
+        A pyart Radar object with ngates * rays_per_sweep * nsweeps gates
+    """
+    rng = np.random.default_rng(seed)
+    radar = pyart.testing.make_empty_ppi_radar(ngates, rays_per_sweep, nsweeps)
+    nrays = rays_per_sweep * nsweeps
+
+    radar.latitude['data'] = np.array([latitude], dtype=np.float64)
+    radar.longitude['data'] = np.array([longitude], dtype=np.float64)
+    radar.range['data'] = np.linspace(0, max_range, ngates).astype(np.float32)
+
+    elevations = np.linspace(0.5, max_elevation, nsweeps).astype(np.float32)
+    radar.fixed_angle['data'] = elevations
+    radar.elevation['data'] = np.repeat(elevations, rays_per_sweep)
+    radar.azimuth['data'] = np.tile(np.linspace(0, 360, rays_per_sweep, endpoint=False),
+                                    nsweeps).astype(np.float32)
+
+    # The gate locations are computed lazily from the values set above
+    radar.init_gate_x_y_z()
+    radar.init_gate_longitude_latitude()
+    radar.init_gate_altitude()
+
+    # The same gates are missing from every field, like gates with no return
+    missing = rng.random((nrays, ngates)) >= coverage
+    for f in fields:
+        low, high = FIELD_VALUE_RANGES.get(f, (0.0, 1.0))
+        data = rng.uniform(low, high, (nrays, ngates)).astype(np.float32)
+        field = pyart.config.get_metadata(f)
+        # Each field gets its own copy of the mask, so masking more gates of
+        # one field does not mask them in the others
+        field['data'] = np.ma.masked_array(data, mask=missing.copy())
+        radar.add_field(f, field)
+
+    return radar
@@ -0,0 +1,123 @@
+# test_create_grid.py
+# Tests for create_grid.py. Checks that the planar (local ENU) distances used
+# with planar_distance=True stay within the documented error of the haversine
+# distances, and that the grids create_grid produces with each agree within the
+# documented tolerance, for every grid spec and across CONUS latitudes
+# Author: Team Celestial Blue
+# Spring 2025
+# Usage: python -m pytest radars/test_create_grid.py
+
+import os
+import sys
+import numpy as np
+import pytest
+from haversine import haversine_vector
+from create_grid import create_grid, get_meters_per_degree, project_to_local_enu
+from grid_kernel import get_cell_indices
+from synthetic_radar import make_synthetic_radar
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+# Append to sys path to import grid_config
+sys.path.append(os.path.join(DIRNAME, ".."))
+
+from grid_config.grid_spec import GRID_SPECS
+
+# The documented error of the planar gate-to-cell-center distances: within
+# 0.25% of the haversine distance for any grid spec, and within 1.5m for the
+# cells of the full 16x16 grid
+MAX_RELATIVE_ERROR = 0.0025
+MAX_ABSOLUTE_ERROR_METERS = {"full": 1.5}
+# The documented difference this makes to the gridded values: the planar
+# distances shift each gate's Barnes2 weight so little that every cell agrees
+# within this (in the field's units, e.g., dBZ), under 0.1% of the range of
+# reflectivity
+MAX_GRID_DIFFERENCE = 0.05
+GRID_FIELDS = ["reflectivity", "spectrum_width", "velocity", "differential_reflectivity"]
+
+# The southern and northern edges of CONUS, and a latitude in between (the
+# error grows with latitude)
+CONUS_LATITUDES = [24.5, 37.0, 49.5]
+
+
+def get_gate_to_cell_center_distances(grid_spec, grid_origin, gate_lat, gate_lon, gate_alt):
+    """
+    Finds the distance from each gate inside the grid to the center of its cell,
+    computed both from the planar projection (as create_grid does with
+    planar_distance=True) and with haversine (as it does otherwise)
+    Returns:
+        A 2-tuple (planar distances, haversine distances) in meters
+    """
+    origin_alt, origin_lat, origin_lon = grid_origin
+    n_alt, n_lat, n_lon = grid_spec.grid_shape
+    (alt_start, alt_stop), (lat_start, lat_stop), (lon_start, lon_stop) = \
+        grid_spec.alt_range, grid_spec.lat_range, grid_spec.lon_range
+
+    in_grid = (origin_lat + lat_start <= gate_lat) & (gate_lat < origin_lat + lat_stop) & \
+        (origin_lon + lon_start <= gate_lon) & (gate_lon < origin_lon + lon_stop) & \
+        (origin_alt + alt_start <= gate_alt) & (gate_alt < origin_alt + alt_stop)
+    gate_lat, gate_lon, gate_alt = gate_lat[in_grid], gate_lon[in_grid], gate_alt[in_grid]
+
+    # The offset of the center of each gate's cell from the origin
+    lat_step = (lat_stop - lat_start) / n_lat
+    lon_step = (lon_stop - lon_start) / n_lon
+    alt_step = (alt_stop - alt_start) / n_alt
+    cell_lat = lat_start + lat_step / 2 + lat_step * get_cell_indices(gate_lat, origin_lat + lat_start, lat_step, n_lat)
+    cell_lon = lon_start + lon_step / 2 + lon_step * get_cell_indices(gate_lon, origin_lon + lon_start, lon_step, n_lon)
+    cell_alt = alt_start + alt_step / 2 + alt_step * get_cell_indices(gate_alt, origin_alt + alt_start, alt_step, n_alt)
+
+    gate_x, gate_y, gate_z = project_to_local_enu(gate_lat, gate_lon, gate_alt, grid_origin)
+    meters_per_deg_lat, meters_per_deg_lon = get_meters_per_degree(origin_lat)
+    planar = np.sqrt((gate_x - cell_lon * meters_per_deg_lon) ** 2 +
+                     (gate_y - cell_lat * meters_per_deg_lat) ** 2 +
+                     (gate_z - cell_alt) ** 2)
+
+    xy_dist = haversine_vector(np.column_stack((cell_lat + origin_lat, cell_lon + origin_lon)),
+                               np.column_stack((gate_lat, gate_lon)), unit='m')
+    exact = np.sqrt(xy_dist ** 2 + (gate_alt - (cell_alt + origin_alt)) ** 2)
+    return planar, exact
+
+
+@pytest.mark.parametrize("grid_spec_name", ["full", "low_res"])
+@pytest.mark.parametrize("latitude", CONUS_LATITUDES)
+def test_planar_distance_matches_haversine(grid_spec_name, latitude):
+    grid_spec = GRID_SPECS[grid_spec_name]
+    radar = make_synthetic_radar(latitude=latitude, max_range=60000.0, fields=["reflectivity"])
+    # A grid near (but not centered on) the radar, so it is filled with gates
+    grid_origin = (1500.0, latitude + 0.2, -97.5 + 0.2)
+    planar, exact = get_gate_to_cell_center_distances(
+        grid_spec, grid_origin,
+        radar.gate_latitude['data'].ravel().astype(np.float64),
+        radar.gate_longitude['data'].ravel().astype(np.float64),
+        radar.gate_altitude['data'].ravel().astype(np.float64))
+    assert planar.size > 1000
+
+    error = np.abs(planar - exact)
+    assert np.max(error / exact) < MAX_RELATIVE_ERROR
+    if grid_spec_name in MAX_ABSOLUTE_ERROR_METERS:
+        assert np.max(error) < MAX_ABSOLUTE_ERROR_METERS[grid_spec_name]
+
+
+@pytest.mark.parametrize("grid_spec_name", ["full", "low_res"])
+@pytest.mark.parametrize("latitude", CONUS_LATITUDES)
+def test_planar_distance_grid_matches_haversine_grid(grid_spec_name, latitude):
+    grid_spec = GRID_SPECS[grid_spec_name]
+    radar = make_synthetic_radar(latitude=latitude, max_range=60000.0, fields=GRID_FIELDS)
+    grid_origin = (1500.0, latitude + 0.2, -97.5 + 0.2)
+    grid_kwargs = dict(radars=(radar,),
+        grid_shape=grid_spec.grid_shape,
+        alt_range=grid_spec.alt_range,
+        lat_range=grid_spec.lat_range,
+        lon_range=grid_spec.lon_range,
+        grid_origin=grid_origin,
+        fields=GRID_FIELDS)
+    expected = create_grid(**grid_kwargs)
+    actual = create_grid(planar_distance=True, **grid_kwargs)
+    assert expected["reflectivity"].notnull().mean() > 0.25
+
+    for f in GRID_FIELDS:
+        # The same cells are filled, since the gates are assigned to cells
+        # the same way
+        np.testing.assert_array_equal(np.isnan(actual[f].values), np.isnan(expected[f].values))
+        np.testing.assert_allclose(actual[f].values, expected[f].values, rtol=0, atol=MAX_GRID_DIFFERENCE,
+                                   equal_nan=True)
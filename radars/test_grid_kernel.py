@@ -0,0 +1,102 @@
+# test_grid_kernel.py
+# Tests for grid_kernel.py. Checks that create_grid(use_kernel=True), both
+# compiled with numba and with the pure-numpy fallback, produces the same
+# grid as the original mask loop, for multiple fields with masked and nan gates
+# Author: Team Celestial Blue
+# Spring 2025
+# Usage: python -m pytest radars/test_grid_kernel.py
+
+import os
+import sys
+import numpy as np
+import pytest
+import grid_kernel
+from create_grid import create_grid
+from synthetic_radar import make_synthetic_radar
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+# Append to sys path to import grid_config
+sys.path.append(os.path.join(DIRNAME, ".."))
+
+from grid_config.grid_spec import GRID_SPECS
+
+# The kernel's grid is float32 while the mask loop's is float64, so they agree
+# to float32 precision (the fields are at most ~60 in magnitude)
+GRID_RTOL = 1e-5
+GRID_ATOL = 1e-4
+
+GRID_ORIGIN = (1500.0, 36.5, -97.5)
+FIELDS = ["reflectivity", "spectrum_width", "velocity", "differential_reflectivity"]
+
+
+def make_test_radars():
+    """
+    Builds two synthetic radars on either side of the grid where each field is
+    missing at different gates: some gates are masked in every field, others
+    only in velocity (randomly, and within 0.05 degrees of the grid origin, so
+    some cells have gates but no valid velocity), and some spectrum_width
+    values are nan rather than masked. Only fields the gate filter ignores
+    are changed, since it drops gates with masked or nan reflectivity or
+    differential_reflectivity altogether
+    """
+    radars = []
+    for i, longitude_offset in enumerate([-0.3, 0.3]):
+        radar = make_synthetic_radar(ngates=400, rays_per_sweep=180, nsweeps=6, coverage=0.7,
+                                     latitude=GRID_ORIGIN[1], longitude=GRID_ORIGIN[2] + longitude_offset,
+                                     max_range=60000.0, fields=FIELDS, seed=i)
+        rng = np.random.default_rng(100 + i)
+        shape = radar.fields["velocity"]["data"].shape
+        near_origin = (np.abs(radar.gate_latitude["data"] - GRID_ORIGIN[1]) < 0.05) & \
+            (np.abs(radar.gate_longitude["data"] - GRID_ORIGIN[2]) < 0.05)
+        velocity = radar.fields["velocity"]["data"]
+        velocity.mask = velocity.mask | (rng.random(shape) < 0.3) | near_origin
+        spectrum_width = radar.fields["spectrum_width"]["data"]
+        spectrum_width.data[rng.random(shape) < 0.2] = np.nan
+        radars.append(radar)
+    return tuple(radars)
+
+
+@pytest.fixture(scope="module")
+def radars():
+    return make_test_radars()
+
+
+def call_create_grid(radars, grid_spec, **kwargs):
+    return create_grid(radars=radars,
+        grid_shape=grid_spec.grid_shape,
+        alt_range=grid_spec.alt_range,
+        lat_range=grid_spec.lat_range,
+        lon_range=grid_spec.lon_range,
+        grid_origin=GRID_ORIGIN,
+        fields=FIELDS,
+        **kwargs)
+
+
+@pytest.mark.parametrize("use_numba", [
+    pytest.param(True, marks=pytest.mark.skipif(not grid_kernel.NUMBA_AVAILABLE, reason="numba is not installed")),
+    False,
+])
+@pytest.mark.parametrize("planar_distance", [False, True])
+@pytest.mark.parametrize("grid_spec_name", ["low_res", "full"])
+def test_kernel_matches_mask_loop(radars, grid_spec_name, planar_distance, use_numba, monkeypatch):
+    grid_spec = GRID_SPECS[grid_spec_name]
+    if not use_numba:
+        # Force the pure-numpy fallback, as if numba were not installed
+        monkeypatch.setattr(grid_kernel, "NUMBA_AVAILABLE", False)
+    expected = call_create_grid(radars, grid_spec, planar_distance=planar_distance)
+    actual = call_create_grid(radars, grid_spec, planar_distance=planar_distance, use_kernel=True)
+
+    for f in FIELDS:
+        assert actual[f].dtype == np.float32
+        np.testing.assert_array_equal(np.isnan(actual[f].values), np.isnan(expected[f].values))
+        np.testing.assert_allclose(actual[f].values, expected[f].values, rtol=GRID_RTOL, atol=GRID_ATOL,
+                                   equal_nan=True)
+    for coord in ("alt", "lat", "lon"):
+        np.testing.assert_allclose(actual[coord].values, expected[coord].values)
+
+    # The test radars fill a good part of the cells, and leave some cells with
+    # gates but no valid velocity
+    filled = expected["reflectivity"].notnull().values
+    assert filled.mean() > 0.25
+    assert np.any(filled & expected["velocity"].isnull().values)
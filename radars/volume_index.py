@@ -0,0 +1,197 @@
+# volume_index.py
+# This python file exports the class VolumeIndex, which gathers the gates of
+# one radar volume (one or more radars at one time) once and buckets them by
+# latitude/longitude, so that many grids (e.g., one around every point of a
+# lattice covering a map) can be created without filtering every gate of every
+# radar again for each grid. The grids are computed in a single pass over the
+# gates of a whole batch of grids, in the same way as
+# create_grid(use_kernel=True, planar_distance=True)
+# Author: Team Celestial Blue
+# Spring 2025
+
+import math
+from typing import Union
+import numpy as np
+import quiet_pyart as pyart
+from create_grid import get_meters_per_degree
+from grid_kernel import accumulate_grid, get_cell_indices
+
+
+class VolumeIndex:
+
+    def __init__(
+        self,
+        radars: Union[pyart.core.Radar, tuple[pyart.core.Radar]],
+        fields: list[str],
+        bucket_degrees: float
+    ):
+        """
+        Gathers the valid gates of every radar and sorts them by the
+        latitude/longitude bucket they are in
+        Parameters:
+            radars -- The pyart radar(s) of the volume
+            fields -- The fields to grid, as in create_grid
+            bucket_degrees -- The width (in degrees of latitude and longitude)
+                of each bucket. Using the width of the grids makes each grid
+                overlap at most 2x2 buckets
+        """
+        if isinstance(radars, pyart.core.Radar):
+            radars = (radars,)
+        if len(radars) == 0:
+            raise ValueError("Length of radars tuple cannot be zero")
+        self.fields = list(fields)
+        self.bucket_degrees = bucket_degrees
+
+        # The same gates create_grid keeps (before checking they are in the grid)
+        gate_lat, gate_lon, gate_alt, field_data = [], [], [], []
+        for radar in radars:
+            included = pyart.filters.moment_based_gate_filter(radar).gate_included.ravel()
+            gate_lat.append(radar.gate_latitude['data'].ravel()[included])
+            gate_lon.append(radar.gate_longitude['data'].ravel()[included])
+            gate_alt.append(radar.gate_altitude['data'].ravel()[included])
+            # Values that are masked in a field are stored as nan so they are not averaged
+            field_data.append(np.stack([np.ma.filled(radar.fields[f]['data'].ravel()[included], np.nan)
+                                        .astype(np.float32) for f in self.fields]))
+        gate_lat = np.concatenate(gate_lat)
+        gate_lon = np.concatenate(gate_lon)
+        gate_alt = np.concatenate(gate_alt)
+        field_data = np.concatenate(field_data, axis=1)
+
+        # Sort the gates by bucket, so the gates of each row of buckets are
+        # contiguous and each bucket is a slice of the sorted gates
+        self.lat_start = math.floor(gate_lat.min() / bucket_degrees) * bucket_degrees if gate_lat.size else 0.0
+        self.lon_start = math.floor(gate_lon.min() / bucket_degrees) * bucket_degrees if gate_lon.size else 0.0
+        lat_bucket = ((gate_lat - self.lat_start) // bucket_degrees).astype(np.int64)
+        lon_bucket = ((gate_lon - self.lon_start) // bucket_degrees).astype(np.int64)
+        self.n_lat_buckets = int(lat_bucket.max()) + 1 if gate_lat.size else 0
+        self.n_lon_buckets = int(lon_bucket.max()) + 1 if gate_lon.size else 0
+        bucket = lat_bucket * self.n_lon_buckets + lon_bucket
+        order = np.argsort(bucket, kind="stable")
+        self.gate_lat = gate_lat[order]
+        self.gate_lon = gate_lon[order]
+        self.gate_alt = gate_alt[order]
+        self.field_data = np.ascontiguousarray(field_data[:, order])
+        # bucket_offsets[b]:bucket_offsets[b + 1] are the gates in bucket b
+        self.bucket_offsets = np.zeros(self.n_lat_buckets * self.n_lon_buckets + 1, dtype=np.int64)
+        np.cumsum(np.bincount(bucket, minlength=self.n_lat_buckets * self.n_lon_buckets),
+                  out=self.bucket_offsets[1:])
+
+    def __len__(self):
+        return self.gate_lat.size
+
+    @property
+    def bounds(self) -> tuple[float, float, float, float]:
+        """(min lat, max lat, min lon, max lon) of the gates in the volume"""
+        return (float(self.gate_lat.min()), float(self.gate_lat.max()),
+                float(self.gate_lon.min()), float(self.gate_lon.max()))
+
+    def _get_bucket_range(self, start: float, stop: float, bucket_start: float, n_buckets: int) -> range:
+        first = max(math.floor((start - bucket_start) / self.bucket_degrees), 0)
+        last = min(math.floor((stop - bucket_start) / self.bucket_degrees), n_buckets - 1)
+        return range(first, last + 1)
+
+    def query(
+        self,
+        lat_bounds: tuple[float, float],
+        lon_bounds: tuple[float, float],
+        alt_bounds: tuple[float, float]
+    ) -> np.typing.NDArray:
+        """
+        Finds the gates in a box, i.e., with start <= value < stop in every
+        dimension (the same bounds create_grid uses)
+        Parameters:
+            lat_bounds -- The (start, stop) latitude of the box in degrees
+            lon_bounds -- The (start, stop) longitude of the box in degrees
+            alt_bounds -- The (start, stop) altitude of the box in meters
+        Returns:
+            An array of the indices of the gates in the box
+        """
+        lon_buckets = self._get_bucket_range(*lon_bounds, self.lon_start, self.n_lon_buckets)
+        if len(lon_buckets) == 0:
+            return np.empty(0, dtype=np.int64)
+        # The buckets of a row overlapping the box are contiguous
+        candidates = [np.arange(self.bucket_offsets[row * self.n_lon_buckets + lon_buckets[0]],
+                                self.bucket_offsets[row * self.n_lon_buckets + lon_buckets[-1] + 1])
+                      for row in self._get_bucket_range(*lat_bounds, self.lat_start, self.n_lat_buckets)]
+        if not candidates:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.concatenate(candidates)
+        lat, lon, alt = self.gate_lat[candidates], self.gate_lon[candidates], self.gate_alt[candidates]
+        in_box = (lat_bounds[0] <= lat) & (lat < lat_bounds[1]) & \
+            (lon_bounds[0] <= lon) & (lon < lon_bounds[1]) & \
+            (alt_bounds[0] <= alt) & (alt < alt_bounds[1])
+        return candidates[in_box]
+
+    def grid_points(
+        self,
+        grid_origins: np.typing.NDArray,
+        grid_shape: tuple[int, int, int],
+        alt_range: tuple[float, float],
+        lat_range: tuple[float, float],
+        lon_range: tuple[float, float]
+    ) -> tuple[np.typing.NDArray, np.typing.NDArray]:
+        """
+        Creates a grid around each of grid_origins, as
+        create_grid(use_kernel=True, planar_distance=True) would, but with a
+        single pass over the gates of all of the grids
+        Parameters:
+            grid_origins -- An array of shape (npoints, 3) of the (alt, lat,
+                lon) origin of each grid. alt should be in meters and lat/lon
+                in degrees
+            grid_shape, alt_range, lat_range, lon_range -- The shape and
+                extent of each grid, as in create_grid
+        Returns:
+            A float32 array of shape (npoints, n_alt, n_lat, n_lon, nfields) of
+            the weighted average of each field in each cell of each grid (nan
+            for cells without any gates), and a bool array of shape (npoints)
+            that is False for the grids without any gates, for which
+            create_grid would return an empty dataset
+        """
+        grid_origins = np.asarray(grid_origins, dtype=np.float64)
+        npoints = len(grid_origins)
+        n_alt, n_lat, n_lon = grid_shape
+        ncells = n_alt * n_lat * n_lon
+        alt_step = (alt_range[1] - alt_range[0]) / n_alt
+        lat_step = (lat_range[1] - lat_range[0]) / n_lat
+        lon_step = (lon_range[1] - lon_range[0]) / n_lon
+
+        # Find the gates of every grid, along with which grid they belong to
+        gate_indices = [self.query((lat + lat_range[0], lat + lat_range[1]),
+                                   (lon + lon_range[0], lon + lon_range[1]),
+                                   (alt + alt_range[0], alt + alt_range[1]))
+                        for alt, lat, lon in grid_origins]
+        has_data = np.array([indices.size > 0 for indices in gate_indices], dtype=bool)
+        point_idx = np.repeat(np.arange(npoints), [indices.size for indices in gate_indices])
+        gate_indices = np.concatenate(gate_indices) if npoints else np.empty(0, dtype=np.int64)
+
+        origin_alt, origin_lat, origin_lon = (grid_origins[point_idx, i] for i in range(3))
+        # The gates are checked against the bounds of each grid at full
+        # precision, but gridded in float32, as in create_grid
+        gate_lat = self.gate_lat[gate_indices].astype(np.float32)
+        gate_lon = self.gate_lon[gate_indices].astype(np.float32)
+        gate_alt = self.gate_alt[gate_indices].astype(np.float32)
+
+        # Find which cell of its grid each gate is in
+        lon_idx = get_cell_indices(gate_lon, lon_range[0] + origin_lon, lon_step, n_lon)
+        lat_idx = get_cell_indices(gate_lat, lat_range[0] + origin_lat, lat_step, n_lat)
+        alt_idx = get_cell_indices(gate_alt, alt_range[0] + origin_alt, alt_step, n_alt)
+        cell_idx = point_idx * ncells + (alt_idx * n_lat + lat_idx) * n_lon + lon_idx
+
+        # Calculate the distance squared from each gate to the center of its
+        # cell in local east/north/up meters about the origin of its grid (see
+        # project_to_local_enu), and from the center of each cell to its corner
+        meters_per_deg_lat = get_meters_per_degree(0.0)[0] # The same at every latitude
+        meters_per_deg_lon = np.array([get_meters_per_degree(lat)[1] for lat in grid_origins[:, 1]])
+        gate_meters_per_deg_lon = meters_per_deg_lon[point_idx]
+        cell_lon = lon_range[0] + lon_step / 2 + lon_step * lon_idx
+        cell_lat = lat_range[0] + lat_step / 2 + lat_step * lat_idx
+        cell_alt = alt_range[0] + alt_step / 2 + alt_step * alt_idx
+        dist2 = ((gate_lon - origin_lon) * gate_meters_per_deg_lon - cell_lon * gate_meters_per_deg_lon) ** 2 + \
+            ((gate_lat - origin_lat) * meters_per_deg_lat - cell_lat * meters_per_deg_lat) ** 2 + \
+            ((gate_alt - origin_alt) - cell_alt) ** 2
+        planar_r2 = (lon_step / 2 * meters_per_deg_lon) ** 2 + \
+            (lat_step / 2 * meters_per_deg_lat) ** 2 + (alt_step / 2) ** 2
+        cell_r2 = np.repeat(planar_r2, ncells)
+
+        grid_data = accumulate_grid(cell_idx, dist2, cell_r2, self.field_data[:, gate_indices], npoints * ncells)
+        return grid_data.reshape(npoints, n_alt, n_lat, n_lon, len(self.fields)), has_data